@@ -42,8 +42,9 @@ batch_size = args.batch_size
 
 
 def setup(rank, world_size):
-    os.environ["MASTER_ADDR"] = "localhost"
-    os.environ["MASTER_PORT"] = "12355"
+    # 'kaitian run --nodes' sets a port per device type
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", "12355")
     dist.init_process_group("kaitian", rank=rank, world_size=world_size)
     torch_kaitian.set_device(rank)
 
@@ -70,13 +71,16 @@ def run(rank, world_size):
         train_set,
         batch_size=optimize_batch_size(batch_size),
         sampler=train_sampler,
-        num_workers=2,
+        num_workers=torch_kaitian.num_workers(),
     )
 
     test_set = datasets.CIFAR10(root="./data", train=False, transform=transform)
     test_sampler = DistributedSampler(test_set, batch_size, shuffle=False)
     test_loader = DataLoader(
-        test_set, batch_size=batch_size, sampler=test_sampler, num_workers=2
+        test_set,
+        batch_size=batch_size,
+        sampler=test_sampler,
+        num_workers=torch_kaitian.num_workers(),
     )
 
     model = models.mobilenet_v2(weights="MobileNet_V2_Weights.DEFAULT")
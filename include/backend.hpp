@@ -10,16 +10,30 @@
 #include <torch/csrc/distributed/c10d/Utils.hpp>
 #include <torch/csrc/distributed/c10d/Work.hpp>
 
+#include <condition_variable>
+#include <deque>
+#include <functional>
+#include <mutex>
+#include <thread>
+
+#include "compression.hpp"
 #include "gloo.hpp"
 constexpr const char* BACKEND_NAME = "kaitian";
 
 namespace c10d {
 
+class WorkKaiTian;
+
+// Collectives are queued to a single progress thread and executed there in
+// call order, so the returned work completes asynchronously while the caller
+// (e.g. DDP during backward) keeps going.
 class ProcessGroupKaiTian : public ProcessGroup {
    public:
     ProcessGroupKaiTian(const c10::intrusive_ptr<c10d::Store>& store, int rank,
                         int size);
 
+    ~ProcessGroupKaiTian() override;
+
     c10::intrusive_ptr<Work> broadcast(
         std::vector<at::Tensor>& data,
         const BroadcastOptions& opts = BroadcastOptions()) override;
@@ -28,11 +42,53 @@ class ProcessGroupKaiTian : public ProcessGroup {
         std::vector<at::Tensor>& tensors,
         const AllreduceOptions& opts = AllreduceOptions()) override;
 
+    c10::intrusive_ptr<Work> allreduce_coalesced(
+        std::vector<at::Tensor>& tensors,
+        const AllreduceCoalescedOptions& opts =
+            AllreduceCoalescedOptions()) override;
+
+    // The collectives below run across all device types when their sizes
+    // cover the global world (KAITIAN_GLOBAL_WORLD_SIZE ranks), e.g. an
+    // allgather output list with one tensor per global rank, and inside the
+    // group otherwise.
     c10::intrusive_ptr<Work> allgather(
         std::vector<std::vector<at::Tensor>>& outputTensors,
         std::vector<at::Tensor>& inputTensors,
         const AllgatherOptions& opts = AllgatherOptions()) override;
 
+    c10::intrusive_ptr<Work> _allgather_base(
+        at::Tensor& outputBuffer, at::Tensor& inputBuffer,
+        const AllgatherOptions& opts = AllgatherOptions()) override;
+
+    c10::intrusive_ptr<Work> reduce_scatter(
+        std::vector<at::Tensor>& outputTensors,
+        std::vector<std::vector<at::Tensor>>& inputTensors,
+        const ReduceScatterOptions& opts = ReduceScatterOptions()) override;
+
+    c10::intrusive_ptr<Work> _reduce_scatter_base(
+        at::Tensor& outputBuffer, at::Tensor& inputBuffer,
+        const ReduceScatterOptions& opts = ReduceScatterOptions()) override;
+
+    c10::intrusive_ptr<Work> alltoall_base(
+        at::Tensor& outputTensor, at::Tensor& inputTensor,
+        std::vector<int64_t>& outputSplitSizes,
+        std::vector<int64_t>& inputSplitSizes,
+        const AllToAllOptions& opts = AllToAllOptions()) override;
+
+    c10::intrusive_ptr<Work> alltoall(
+        std::vector<at::Tensor>& outputTensors,
+        std::vector<at::Tensor>& inputTensors,
+        const AllToAllOptions& opts = AllToAllOptions()) override;
+
+    c10::intrusive_ptr<Work> barrier(
+        const BarrierOptions& opts = BarrierOptions()) override;
+
+    // Sum allreduce of DDP gradient bucket number bucket, the only allreduce
+    // that is compressed (see torch_kaitian.compression_hook). reset drops the
+    // error feedback of the bucket.
+    c10::intrusive_ptr<Work> allreduceBucket(at::Tensor& tensor, int64_t bucket,
+                                             bool reset);
+
     static c10::intrusive_ptr<ProcessGroup> createProcessGroupKaiTian(
         const c10::intrusive_ptr<::c10d::Store>& store, int rank, int size,
         const std::chrono::duration<float>& timeout);
@@ -50,15 +106,67 @@ class ProcessGroupKaiTian : public ProcessGroup {
     }
 
    private:
+    using Collective = std::function<std::vector<at::Tensor>()>;
+
+    // Queues fn on the progress thread. The returned work completes with the
+    // tensors returned by fn, or with the exception it throws. The call is
+    // recorded in the telemetry as op with the size and dtype of tensors.
+    c10::intrusive_ptr<Work> enqueue(const at::Device& device, const char* op,
+                                     const std::vector<at::Tensor>& tensors,
+                                     Collective fn);
+    void runLoop();
+
+    // Synchronous bodies of the collectives, run on the progress thread.
+    // bucket >= 0 compresses the inter-group hop, see allreduceBucket
+    void runAllreduce(std::vector<at::Tensor>& tensors,
+                      const AllreduceOptions& opts, int64_t bucket = -1,
+                      bool reset = false);
+    void runHierarchicalAllreduce(at::Tensor& tensor,
+                                  const AllreduceOptions& opts);
+    void divideByGlooWorldSize(at::Tensor& tensor);
+    // Gathers the flattened input of every global rank, numels[g] elements
+    // from global rank g, into one flat tensor ordered by global rank.
+    at::Tensor runGlobalAllgather(const at::Tensor& input,
+                                  const std::vector<int64_t>& numels);
+    // Sends send_numels[g] consecutive elements of input to global rank g and
+    // writes what every rank sent here into output, ordered by source rank.
+    void runGlobalAlltoall(at::Tensor& output, const at::Tensor& input,
+                           const std::vector<int64_t>& send_numels);
+    // Sums the flat input, one block of output.numel() elements per global
+    // rank, over all ranks and writes the block of this rank to output.
+    void runGlobalReduceScatter(at::Tensor& output, const at::Tensor& input,
+                                const ReduceScatterOptions& opts);
+    void exchangeGroupSizes();
+    bool isGlobal(size_t global_count, size_t local_count) const;
+
     c10::intrusive_ptr<Store> store_;
+    // leader context, only on local rank 0
     std::shared_ptr<gloo::rendezvous::Context> context;
+    // stripe contexts of this rank's lane, on local ranks below lanes_
+    GlooContexts lane_contexts_;
+    // run the stripes 1..n of lane_contexts_
+    std::unique_ptr<StripeWorkers> stripe_workers_;
+    // KAITIAN_GLOO_LANES, equal to the group size when every device type has
+    // the same number of devices, otherwise 1
+    int lanes_;
+    StagingBufferPool staging_pool_;
+    AlgorithmCache algorithm_cache_{staging_pool_};
+    Compressor compressor_;
     int kaitian_gloo_world_size;
-#ifdef KAITIAN_MLU
-    c10::intrusive_ptr<ProcessGroup> cncl_process_group_;
-#endif
-#ifdef KAITIAN_CUDA
-    c10::intrusive_ptr<ProcessGroup> nccl_process_group_;
-#endif
+    int gloo_rank_;
+    // first global rank of this group and number of ranks of all groups
+    int global_rank_start_;
+    int global_size_;
+    // number of ranks of every group, indexed by gloo rank
+    std::vector<int64_t> group_sizes_;
+    // NCCL on CUDA, CNCL on MLU, gloo on CPU
+    c10::intrusive_ptr<ProcessGroup> intra_process_group_;
+
+    std::thread progress_thread_;
+    std::deque<std::function<void()>> queue_;
+    std::mutex queue_mutex_;
+    std::condition_variable queue_cv_;
+    bool stop_ = false;
 };
 
 class WorkKaiTian : public Work {
@@ -72,14 +180,11 @@ class WorkKaiTian : public Work {
     virtual c10::intrusive_ptr<c10::ivalue::Future> getFuture() override;
 
    private:
+    void finishWork(std::vector<at::Tensor> result);
+    void finishWorkError(std::exception_ptr eptr);
+
     c10::intrusive_ptr<at::ivalue::Future> future_;
     at::Device device_;
-#ifdef KAITIAN_MLU
-    c10::intrusive_ptr<Work> cncl_work_;
-#endif
-#ifdef KAITIAN_CUDA
-    c10::intrusive_ptr<Work> nccl_work_;
-#endif
 };
 
 }  // namespace c10d
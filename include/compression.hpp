@@ -0,0 +1,44 @@
+#pragma once
+#include <gloo/allgather_ring.h>
+#include <gloo/rendezvous/context.h>
+#include <torch/torch.h>
+
+#include <atomic>
+#include <cstdint>
+#include <map>
+#include <string>
+#include <utility>
+
+// Lossy compression of the inter-device-type hop. The intra-group reduction
+// stays lossless, only the payload exchanged over gloo is compressed.
+enum class CompressionMode { NONE, FP16, BF16, INT8, TOPK };
+
+struct CompressionStats {
+    // bytes the uncompressed payloads would have taken on the wire
+    std::atomic<uint64_t> raw_bytes{0};
+    std::atomic<uint64_t> wire_bytes{0};
+};
+
+extern CompressionStats compression_stats;
+
+// Defaults to KAITIAN_COMPRESSION, KAITIAN_TOPK_RATIO and KAITIAN_INT8_CHUNK.
+// Every gloo rank has to use the same settings.
+void set_compression(const std::string& mode, double topk_ratio,
+                     int64_t int8_chunk);
+std::string get_compression();
+bool compression_enabled(const torch::Tensor& tensor);
+
+// Sums a DDP gradient bucket across the gloo context with a compressed
+// payload. The compression error of each bucket is kept on the device and
+// added back before the next compression of the same bucket (error feedback).
+class Compressor {
+   public:
+    // bucket is the DDP bucket index. reset drops its residual, which no
+    // longer matches once DDP rebuilt its buckets.
+    void allreduce(const std::shared_ptr<gloo::rendezvous::Context>& context,
+                   torch::Tensor& tensor, int64_t bucket, bool reset);
+
+   private:
+    // keyed by the bucket index
+    std::map<int64_t, at::Tensor> residuals_;
+};
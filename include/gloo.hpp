@@ -4,6 +4,8 @@
 #include <gloo/allgather_ring.h>
 #include <gloo/allgatherv.h>
 #include <gloo/allreduce.h>
+#include <gloo/allreduce_bcube.h>
+#include <gloo/allreduce_halving_doubling.h>
 #include <gloo/allreduce_ring.h>
 #include <gloo/alltoall.h>
 #include <gloo/alltoallv.h>
@@ -15,6 +17,7 @@
 #include <gloo/context.h>
 #include <gloo/gather.h>
 #include <gloo/reduce.h>
+#include <gloo/reduce_scatter.h>
 #include <gloo/rendezvous/context.h>
 #include <gloo/rendezvous/file_store.h>
 #include <gloo/rendezvous/prefix_store.h>
@@ -24,36 +27,257 @@
 #include <gloo/transport/tcp/device.h>
 #include <torch/torch.h>
 
+#include <condition_variable>
+#include <exception>
+#include <list>
+#include <map>
+#include <mutex>
 #include <stdexcept>
+#include <thread>
+#include <tuple>
+
+#include "staging.hpp"
 
 enum GlooFunction { BROADCAST, ALLREDUCE };
 
-void gloo_entry(const std::shared_ptr<gloo::rendezvous::Context> &context,
-                torch::Tensor &tensor, GlooFunction op);
+enum GlooAlgorithm { ONE_TO_ALL, RING, HALVING_DOUBLING, BCUBE, DIRECT };
+
+// One context per stripe; large messages are split over all of them and run
+// in parallel, each stripe over its own TCP connections.
+using GlooContexts = std::vector<std::shared_ptr<gloo::rendezvous::Context>>;
+
+// Chooses the algorithm for one chunk. Depends only on the arguments and the
+// environment, so every gloo rank makes the same choice:
+//   KAITIAN_GLOO_ALGORITHM        auto (default), ring, halving_doubling,
+//                                 bcube or direct
+//   KAITIAN_GLOO_DIRECT_MAX       direct exchange up to this size when there
+//                                 are two device types (default 256 KiB)
+//   KAITIAN_GLOO_HD_MAX           halving-doubling up to this size (1 MiB)
+//   KAITIAN_GLOO_BCUBE_MIN        bcube from this size on (0, disabled)
+GlooAlgorithm select_algorithm(GlooFunction op, int context_size,
+                               size_t nbytes);
+// Number of stripes used for one chunk:
+//   KAITIAN_GLOO_STRIPES          contexts per lane (default 2)
+//   KAITIAN_GLOO_STRIPE_MIN       stripe chunks from this size on (4 MiB)
+size_t select_stripes(size_t nbytes, size_t available);
+size_t gloo_stripes();
+std::string GlooAlgorithmToString(GlooAlgorithm algorithm);
+
+struct AlgorithmCacheStats {
+    std::atomic<uint64_t> hits{0};
+    std::atomic<uint64_t> misses{0};
+    std::atomic<uint64_t> evictions{0};
+};
+
+extern AlgorithmCacheStats algorithm_cache_stats;
+
+struct AlgorithmKey {
+    GlooFunction op;
+    c10::ScalarType dtype;
+    int64_t numel;
+    int64_t chunk_numel;
+
+    bool operator<(const AlgorithmKey &other) const {
+        return std::tie(op, dtype, numel, chunk_numel) <
+               std::tie(other.op, other.dtype, other.numel, other.chunk_numel);
+    }
+};
+
+// gloo algorithms bound to a persistent pinned staging buffer, one per chunk
+// and stripe
+struct CachedAlgorithm {
+    at::Tensor buffer;
+    std::vector<std::vector<std::unique_ptr<gloo::Algorithm>>> algorithms;
+    std::vector<GlooAlgorithm> selected;
+    // recorded after the last H2D copy out of buffer
+    std::shared_ptr<c10::Event> ready;
+};
+
+// LRU cache of gloo algorithms, so that steady-state training reuses the
+// registered buffers and pairs instead of creating them on every call.
+// NB: Creating an algorithm consumes a gloo slot, so hits and misses have to
+// be identical on every gloo rank. They are, as long as all ranks issue the
+// same collectives and use the same capacity and staging pool capacity.
+class AlgorithmCache {
+   public:
+    // capacity defaults to KAITIAN_ALGORITHM_CACHE_SIZE (64 if unset)
+    explicit AlgorithmCache(StagingBufferPool &pool);
+    AlgorithmCache(StagingBufferPool &pool, size_t capacity);
+    ~AlgorithmCache();
+
+    // Takes the entry for key out of the cache, building it on a miss.
+    std::shared_ptr<CachedAlgorithm> acquire(const AlgorithmKey &key,
+                                             const GlooContexts &contexts,
+                                             const at::Device &device);
+    // Puts the entry back as the most recently used one.
+    void release(const AlgorithmKey &key,
+                 std::shared_ptr<CachedAlgorithm> entry);
+
+   private:
+    using Entry = std::pair<AlgorithmKey, std::shared_ptr<CachedAlgorithm>>;
+
+    StagingBufferPool &pool_;
+    size_t capacity_;
+    // most recently used first
+    std::list<Entry> entries_;
+    std::map<AlgorithmKey, std::list<Entry>::iterator> index_;
+};
+
+// Threads that run the stripes 1..n of a chunk while the calling thread runs
+// stripe 0. Created once together with the stripe contexts, so the hot path
+// only hands over work instead of starting threads.
+class StripeWorkers {
+   public:
+    explicit StripeWorkers(size_t workers);
+    ~StripeWorkers();
+
+    // Runs algorithms[s] on worker s - 1 and algorithms[0] on the calling
+    // thread, and rethrows the first error once all of them are done.
+    void run(std::vector<std::unique_ptr<gloo::Algorithm>> &algorithms);
+
+   private:
+    struct Worker {
+        std::thread thread;
+        gloo::Algorithm *task = nullptr;
+        std::exception_ptr error;
+    };
+
+    void loop(size_t index);
+
+    std::mutex mutex_;
+    std::condition_variable start_cv_;
+    std::condition_variable done_cv_;
+    std::vector<Worker> workers_;
+    size_t pending_ = 0;
+    bool stop_ = false;
+};
+
+// Throws for dtypes the gloo path cannot reduce.
+void check_gloo_dtype(c10::ScalarType dtype);
+// Sums the contiguous CPU tensor over the context, leaving only the
+// recv_counts[rank] elements of this rank, at their offset, summed.
+void gloo_reduce_scatter(
+    const std::shared_ptr<gloo::rendezvous::Context> &context,
+    torch::Tensor &tensor_cpu, const std::vector<int> &recv_counts);
+void gloo_entry(const GlooContexts &contexts, StripeWorkers &workers,
+                AlgorithmCache &cache, torch::Tensor &tensor, GlooFunction op);
 void time_spend();
+// Chunk size in bytes of the pipelined D2H / gloo / H2D path, 0 disables it.
+// Defaults to KAITIAN_CHUNK_SIZE.
+void set_chunk_size(size_t nbytes);
+size_t get_chunk_size();
 
+// Sums 16-bit floating point values element by element in float32, so the
+// payload stays 16-bit on the wire without accumulating in 16-bit.
 template <typename T>
-void _entry(const std::shared_ptr<gloo::rendezvous::Context> &context,
-            torch::Tensor &tensor, GlooFunction op) {
+void sum_in_float(T *x, const T *y, size_t n) {
+    for (size_t i = 0; i < n; ++i) {
+        x[i] =
+            static_cast<T>(static_cast<float>(x[i]) + static_cast<float>(y[i]));
+    }
+}
+
+template <typename T>
+const gloo::ReductionFunction<T> *sum_function() {
+    return gloo::ReductionFunction<T>::sum;
+}
+
+template <>
+inline const gloo::ReductionFunction<c10::Half> *sum_function() {
+    static gloo::ReductionFunction<c10::Half> fn(gloo::SUM,
+                                                 &sum_in_float<c10::Half>);
+    return &fn;
+}
+
+template <>
+inline const gloo::ReductionFunction<c10::BFloat16> *sum_function() {
+    static gloo::ReductionFunction<c10::BFloat16> fn(
+        gloo::SUM, &sum_in_float<c10::BFloat16>);
+    return &fn;
+}
+
+// Allreduce for two ranks: both sides send their whole buffer to the peer
+// and add what they receive, a single round trip.
+template <typename T>
+class AllreduceDirect : public gloo::Algorithm {
+   public:
+    AllreduceDirect(const std::shared_ptr<gloo::Context> &context, T *ptr,
+                    int count, const gloo::ReductionFunction<T> *fn)
+        : gloo::Algorithm(context),
+          ptr_(ptr),
+          count_(count),
+          fn_(fn),
+          inbox_(count) {
+        if (this->contextSize_ != 2) {
+            throw std::runtime_error(
+                "[KaiTian] Direct allreduce requires two gloo ranks.");
+        }
+        auto &pair = this->context_->getPair(1 - this->contextRank_);
+        auto slot = this->context_->nextSlot();
+        sendDataBuf_ = pair->createSendBuffer(slot, ptr_, count_ * sizeof(T));
+        recvDataBuf_ =
+            pair->createRecvBuffer(slot, inbox_.data(), count_ * sizeof(T));
+        auto notificationSlot = this->context_->nextSlot();
+        sendNotificationBuf_ =
+            pair->createSendBuffer(notificationSlot, &dummy_, sizeof(dummy_));
+        recvNotificationBuf_ =
+            pair->createRecvBuffer(notificationSlot, &dummy_, sizeof(dummy_));
+    }
+
+    void run() override {
+        sendDataBuf_->send();
+        recvDataBuf_->waitRecv();
+        sendDataBuf_->waitSend();
+        fn_->call(ptr_, inbox_.data(), count_);
+        // the peer may only send again once both inboxes have been consumed
+        sendNotificationBuf_->send();
+        recvNotificationBuf_->waitRecv();
+        sendNotificationBuf_->waitSend();
+    }
+
+   private:
+    T *ptr_;
+    const int count_;
+    const gloo::ReductionFunction<T> *fn_;
+    std::vector<T> inbox_;
+    int dummy_ = 0;
+    std::unique_ptr<gloo::transport::Buffer> sendDataBuf_;
+    std::unique_ptr<gloo::transport::Buffer> recvDataBuf_;
+    std::unique_ptr<gloo::transport::Buffer> sendNotificationBuf_;
+    std::unique_ptr<gloo::transport::Buffer> recvNotificationBuf_;
+};
+
+template <typename T>
+std::unique_ptr<gloo::Algorithm> _entry(
+    const std::shared_ptr<gloo::rendezvous::Context> &context,
+    torch::Tensor &tensor, GlooAlgorithm algorithm_type) {
     std::unique_ptr<gloo::Algorithm> algorithm;
-    switch (op) {
-        case BROADCAST:
+    auto ptrs = std::vector<T *>{reinterpret_cast<T *>(tensor.data_ptr())};
+    switch (algorithm_type) {
+        case ONE_TO_ALL:
             algorithm = std::make_unique<gloo::BroadcastOneToAll<T>>(
-                context,
-                std::vector<T *>{reinterpret_cast<T *>(tensor.data_ptr())},
-                tensor.numel(), 0, 0);
+                context, ptrs, tensor.numel(), 0, 0);
             break;
-        case ALLREDUCE:
+        case RING:
             algorithm = std::make_unique<gloo::AllreduceRing<T>>(
-                context,
-                std::vector<T *>{reinterpret_cast<T *>(tensor.data_ptr())},
-                tensor.numel());
+                context, ptrs, tensor.numel(), sum_function<T>());
+            break;
+        case HALVING_DOUBLING:
+            algorithm = std::make_unique<gloo::AllreduceHalvingDoubling<T>>(
+                context, ptrs, tensor.numel(), sum_function<T>());
+            break;
+        case BCUBE:
+            algorithm = std::make_unique<gloo::AllreduceBcube<T>>(
+                context, ptrs, tensor.numel(), sum_function<T>());
+            break;
+        case DIRECT:
+            algorithm = std::make_unique<AllreduceDirect<T>>(
+                context, ptrs[0], tensor.numel(), sum_function<T>());
             break;
     }
-    if (algorithm) {
-        algorithm->run();
-    } else {
+    if (!algorithm) {
         throw std::runtime_error(
             "[KaiTian] Internal Error: gloo algorithm is nullptr.");
     }
+    return algorithm;
 }
\ No newline at end of file
@@ -0,0 +1,56 @@
+#pragma once
+#include <c10/core/Event.h>
+#include <torch/torch.h>
+
+#include <atomic>
+#include <cstdint>
+#include <list>
+#include <memory>
+#include <mutex>
+
+struct StagingStats {
+    std::atomic<uint64_t> hits{0};
+    std::atomic<uint64_t> misses{0};
+    std::atomic<uint64_t> evictions{0};
+    // bytes of pinned memory allocated over the whole run
+    std::atomic<uint64_t> allocated_bytes{0};
+    // bytes of pinned memory currently owned by the pool
+    std::atomic<uint64_t> pooled_bytes{0};
+};
+
+extern StagingStats staging_stats;
+
+// Pool of pinned host buffers used to stage tensors for gloo. Buffers are
+// rounded up to power-of-two size classes and kept in LRU order; the least
+// recently used free buffers are evicted once the pool exceeds its capacity.
+class StagingBufferPool {
+   public:
+    // capacity defaults to KAITIAN_STAGING_POOL_MB (1024 MiB if unset)
+    StagingBufferPool();
+    explicit StagingBufferPool(size_t capacity);
+
+    // Returns a byte tensor of at least nbytes bytes, pinned for device.
+    at::Tensor acquire(size_t nbytes, const at::Device& device);
+    // Gives the buffer back; it is reused only after ready has completed.
+    void release(at::Tensor buffer,
+                 std::shared_ptr<c10::Event> ready = nullptr);
+    // Whether the buffers handed out, e.g. to the algorithm cache, exceed the
+    // capacity on their own, so that evicting free buffers cannot help.
+    bool overCapacity();
+
+   private:
+    // Drops least recently used free buffers until the pool fits its capacity
+    // or only keep free buffers are left. Requires mutex_ to be held.
+    void evict(size_t keep);
+
+    struct Entry {
+        at::Tensor buffer;
+        std::shared_ptr<c10::Event> ready;
+    };
+
+    size_t capacity_;
+    size_t total_bytes_ = 0;
+    // free buffers, most recently used first
+    std::list<Entry> free_;
+    std::mutex mutex_;
+};
@@ -6,4 +6,8 @@
 
 #ifdef KAITIAN_MLU
 #include "mlu/mlu.hpp"
+#endif
+
+#ifdef KAITIAN_CPU
+#include <torch/csrc/distributed/c10d/ProcessGroupGloo.hpp>
 #endif
\ No newline at end of file
@@ -0,0 +1,126 @@
+#pragma once
+#include <c10/core/Device.h>
+#include <torch/torch.h>
+
+#include <array>
+#include <chrono>
+#include <cstdint>
+#include <map>
+#include <mutex>
+#include <string>
+#include <utility>
+#include <vector>
+
+// Per-collective communication telemetry, kept in a bounded ring so that it
+// can stay on in production. Configured by:
+//   KAITIAN_TELEMETRY           on (default), off, or sync. sync waits for
+//                               the device at every phase boundary, so
+//                               asynchronous device work is attributed to
+//                               the phase that issued it.
+//   KAITIAN_TELEMETRY_RECORDS   ring capacity (default 4096)
+enum TelemetryPhase {
+    INTRA_REDUCE,
+    D2H,
+    INTER,
+    H2D,
+    INTRA_BROADCAST,
+    NUM_PHASES
+};
+
+std::string TelemetryPhaseToString(TelemetryPhase phase);
+
+struct CollectiveRecord {
+    std::string op;
+    std::string dtype;
+    uint64_t bytes = 0;
+    // microseconds since the process started
+    int64_t start_us = 0;
+    int64_t duration_us = 0;
+    // first start relative to start_us and summed duration of every phase,
+    // the start is -1 if the phase was not entered
+    std::array<int64_t, NUM_PHASES> phase_start_us;
+    std::array<int64_t, NUM_PHASES> phase_us;
+};
+
+// Latency histogram of one op and log2 size bucket. counts[i] holds calls
+// that took [2^i, 2^(i+1)) microseconds.
+struct LatencyHistogram {
+    std::string op;
+    // messages of [2^size_bucket, 2^(size_bucket+1)) bytes
+    int size_bucket = 0;
+    uint64_t calls = 0;
+    int64_t total_us = 0;
+    std::vector<uint64_t> counts;
+    // summed duration of every phase over all calls
+    std::array<int64_t, NUM_PHASES> phase_us{};
+};
+
+struct TelemetrySnapshot {
+    // oldest first
+    std::vector<CollectiveRecord> records;
+    std::vector<LatencyHistogram> histograms;
+    // records pushed out of the ring
+    uint64_t dropped = 0;
+};
+
+class Telemetry {
+   public:
+    Telemetry();
+
+    bool enabled() const { return mode_ != OFF; }
+    bool synchronizing() const { return mode_ == SYNC; }
+    int64_t now_us() const;
+    void add(CollectiveRecord record);
+    TelemetrySnapshot snapshot();
+    // the histograms alone, cheap enough to poll while training
+    std::vector<LatencyHistogram> histograms();
+    void reset();
+
+   private:
+    enum Mode { OFF, ON, SYNC };
+
+    Mode mode_;
+    std::chrono::steady_clock::time_point epoch_;
+    size_t capacity_;
+    std::vector<CollectiveRecord> ring_;
+    // next slot to write once the ring is full
+    size_t head_ = 0;
+    uint64_t dropped_ = 0;
+    std::map<std::pair<std::string, int>, LatencyHistogram> histograms_;
+    std::mutex mutex_;
+};
+
+extern Telemetry telemetry;
+
+// Records one collective on the calling thread for its lifetime. Phases run
+// by the collective, also inside gloo_entry, attach to it through
+// PhaseTimer.
+class CollectiveScope {
+   public:
+    CollectiveScope(const char* op, const std::vector<at::Tensor>& tensors,
+                    const at::Device& device);
+    ~CollectiveScope();
+
+   private:
+    friend class PhaseTimer;
+    CollectiveRecord record_;
+    at::Device device_;
+    bool active_;
+};
+
+// Adds the time until it goes out of scope to phase of the collective
+// recorded on this thread, does nothing outside of a CollectiveScope.
+class PhaseTimer {
+   public:
+    explicit PhaseTimer(TelemetryPhase phase);
+    ~PhaseTimer();
+
+   private:
+    CollectiveScope* scope_;
+    TelemetryPhase phase_;
+    int64_t start_us_;
+};
+
+TelemetrySnapshot get_telemetry();
+std::vector<LatencyHistogram> get_telemetry_histograms();
+void reset_telemetry();
@@ -60,6 +60,12 @@ def cuda_support():
     define_macros.extend([("KAITIAN_CUDA", None), ("USE_C10D_NCCL", None)])
 
 
+def cpu_support():
+    # Every device-type group runs on the CPU and reduces with gloo, used to
+    # benchmark and test the backend without accelerators.
+    define_macros.append(("KAITIAN_CPU", None))
+
+
 def setup_extension():
     device_type = os.environ.get("DEVICE")
     ext_modules = []
@@ -71,6 +77,8 @@ def setup_extension():
                 mlu_support()
             case "CUDA":
                 cuda_support()
+            case "CPU":
+                cpu_support()
             case _:
                 raise EnvironmentError(f"Unsupported DEVICE type: {device_type}")
         ext_modules = [
@@ -87,7 +95,8 @@ def setup_extension():
             )
         ]
         cmdclass = {"build_ext": cpp_extension.BuildExtension}
-    else:
+    # a CPU host runs both the launcher and the workers
+    if device_type in (None, "CPU"):
         entry_points = {"console_scripts": ["kaitian=torch_kaitian.cli:main"]}
 
     return ext_modules, cmdclass, entry_points
@@ -2,147 +2,843 @@
 
 #include <ATen/core/TensorBody.h>
 #include <c10/core/Device.h>
+#include <c10/core/StreamGuard.h>
+#include <c10/core/impl/VirtualGuardImpl.h>
 #include <pybind11/chrono.h>
 #include <torch/torch.h>
 #include <torch/types.h>
 
+#include <torch/csrc/utils/tensor_flatten.h>
+
+#include <algorithm>
+#include <chrono>
 #include <cstdlib>
+#include <map>
+#include <numeric>
+#include <sstream>
+#include <string>
+#include <thread>
 
 #include "gloo.hpp"
 #include "support.hpp"
+#include "telemetry.hpp"
 
 namespace c10d {
 WorkKaiTian::WorkKaiTian(at::Device device) : device_(device) {
+    // futures only track streams of accelerators
     future_ = c10::make_intrusive<at::ivalue::Future>(
         c10::ListType::create(c10::TensorType::get()),
-        std::vector<at::Device>{device});
+        device.is_cpu() ? std::vector<at::Device>()
+                        : std::vector<at::Device>{device});
 }
+
 bool WorkKaiTian::isCompleted() {
-    throw std::runtime_error("[kaitian] error: not supported isCompleted");
+    std::lock_guard<std::mutex> lock(mutex_);
+    return completed_;
 }
 
 bool WorkKaiTian::isSuccess() const {
-    throw std::runtime_error("[kaitian] error: not supported isSuccess");
+    std::lock_guard<std::mutex> lock(mutex_);
+    return completed_ && !exception_;
 }
 
-bool WorkKaiTian::wait(std::chrono::milliseconds) { return true; }
+bool WorkKaiTian::wait(std::chrono::milliseconds timeout) {
+    std::unique_lock<std::mutex> lock(mutex_);
+    if (timeout == kUnsetTimeout || timeout == kNoTimeout) {
+        cv_.wait(lock, [&] { return completed_; });
+    } else if (!cv_.wait_for(lock, timeout, [&] { return completed_; })) {
+        throw std::runtime_error("[KaiTian] Operation timed out!");
+    }
+    if (exception_) {
+        std::rethrow_exception(exception_);
+    }
+    lock.unlock();
+    // make the current streams wait for the device work of the collective
+    future_->wait();
+    return true;
+}
 
 c10::intrusive_ptr<c10::ivalue::Future> WorkKaiTian::getFuture() {
     return future_;
 }
 
+void WorkKaiTian::finishWork(std::vector<at::Tensor> result) {
+    future_->markCompleted(c10::IValue(std::move(result)));
+    finish();
+}
+
+void WorkKaiTian::finishWorkError(std::exception_ptr eptr) {
+    future_->setError(eptr);
+    finish(eptr);
+}
+
+// Rendezvous store of the gloo contexts between device types: a directory
+// shared by all processes in KAITIAN_GLOO_FILE_STORE, or the redis server at
+// KAITIAN_REDIS_HOST:KAITIAN_REDIS_PORT (kaitian_redis:6379).
+static std::shared_ptr<gloo::rendezvous::Store> gloo_store() {
+    const char* path = getenv("KAITIAN_GLOO_FILE_STORE");
+    if (path) {
+        return std::make_shared<gloo::rendezvous::FileStore>(path);
+    }
+    const char* host = getenv("KAITIAN_REDIS_HOST");
+    const char* port = getenv("KAITIAN_REDIS_PORT");
+    // The launcher starts redis together with the device containers, so it
+    // may not accept connections yet. Retry for KAITIAN_REDIS_WAIT seconds.
+    const char* wait = getenv("KAITIAN_REDIS_WAIT");
+    auto deadline = std::chrono::steady_clock::now() +
+                    std::chrono::seconds(wait ? atoi(wait) : 60);
+    while (true) {
+        try {
+            return std::make_shared<gloo::rendezvous::RedisStore>(
+                host ? host : "kaitian_redis", port ? atoi(port) : 6379);
+        } catch (const std::exception&) {
+            if (std::chrono::steady_clock::now() > deadline) {
+                throw;
+            }
+            std::this_thread::sleep_for(std::chrono::milliseconds(100));
+        }
+    }
+}
+
+// Address the gloo devices listen on, KAITIAN_GLOO_HOSTNAME or the container
+// hostname, which is the device type.
+static std::string gloo_hostname() {
+    const char* hostname = getenv("KAITIAN_GLOO_HOSTNAME");
+    return hostname ? hostname : getenv("DEVICE");
+}
+
+// Across hosts the devices may bind to a network interface instead, set by
+// KAITIAN_GLOO_IFACE.
+static gloo::transport::tcp::attr gloo_attr() {
+    gloo::transport::tcp::attr attr;
+    const char* iface = getenv("KAITIAN_GLOO_IFACE");
+    if (iface) {
+        attr.iface = iface;
+    } else {
+        attr.hostname = gloo_hostname();
+    }
+    return attr;
+}
+
 ProcessGroupKaiTian::ProcessGroupKaiTian(
     const c10::intrusive_ptr<c10d::Store>& store, int rank, int size)
     : ProcessGroup(rank, size), store_(store) {
 #ifdef KAITIAN_MLU
-    cncl_process_group_ = torch_mlu::ProcessGroupCNCL::createProcessGroupCNCL(
+    intra_process_group_ = torch_mlu::ProcessGroupCNCL::createProcessGroupCNCL(
         store, rank, size, std::chrono::seconds(60));
 #endif
 #ifdef KAITIAN_CUDA
-    nccl_process_group_ =
+    intra_process_group_ =
         c10::make_intrusive<ProcessGroupNCCL>(store, rank, size);
 #endif
-    if (rank == 0) {
-        gloo::rendezvous::RedisStore redis("kaitian_redis");
-        auto dev = gloo::transport::tcp::CreateDevice(getenv("DEVICE"));
-        kaitian_gloo_world_size = atoi(getenv("KAITIAN_GLOO_WORLD_SIZE"));
-        context = std::make_shared<gloo::rendezvous::Context>(
-            atoi(getenv("KAITIAN_GLOO_RANK")), kaitian_gloo_world_size);
-        context->connectFullMesh(redis, dev);
-        std::cout
-            << "\033[1;92mKaitian connection established successfully.\033[0m"
-            << std::endl;
-    }
-}
-// NB: allgather only used by verify_params_across_processes(), so temporarily
-// skip it.
-c10::intrusive_ptr<Work> ProcessGroupKaiTian::allgather(
-    std::vector<std::vector<at::Tensor>>& outputTensors,
-    std::vector<at::Tensor>& inputTensors, const AllgatherOptions& opts) {
-    auto work = c10::make_intrusive<WorkKaiTian>(outputTensors[0][0].device());
-#ifdef KAITIAN_MLU
-    work->cncl_work_ =
-        cncl_process_group_->allgather(outputTensors, inputTensors, opts);
-    work->cncl_work_->wait();
-    auto result = work->cncl_work_->result();
-#endif
-#ifdef KAITIAN_CUDA
-    work->nccl_work_ =
-        nccl_process_group_->allgather(outputTensors, inputTensors, opts);
-    work->nccl_work_->wait();
-    auto result = work->nccl_work_->result();
+#ifdef KAITIAN_CPU
+    auto gloo_options = ProcessGroupGloo::Options::create();
+    const char* iface = getenv("KAITIAN_GLOO_IFACE");
+    gloo_options->devices.push_back(
+        iface ? ProcessGroupGloo::createDeviceForInterface(iface)
+              : ProcessGroupGloo::createDeviceForHostname(gloo_hostname()));
+    intra_process_group_ =
+        c10::make_intrusive<ProcessGroupGloo>(store, rank, size, gloo_options);
 #endif
+    kaitian_gloo_world_size = atoi(getenv("KAITIAN_GLOO_WORLD_SIZE"));
+    gloo_rank_ = atoi(getenv("KAITIAN_GLOO_RANK"));
+    global_rank_start_ = atoi(getenv("KAITIAN_GLOBAL_RANK_START"));
+    global_size_ = atoi(getenv("KAITIAN_GLOBAL_WORLD_SIZE"));
+    const char* lanes = getenv("KAITIAN_GLOO_LANES");
+    lanes_ = lanes ? std::max(1, std::min(atoi(lanes), size)) : 1;
+    // 'kaitian calibrate' times every device type on its own, so the groups
+    // never connect and all collectives stay inside the group.
+    const bool calibrating = getenv("KAITIAN_CALIBRATE_STEPS") != nullptr;
+    if (calibrating) {
+        lanes_ = 1;
+        global_size_ = size;
+        group_sizes_.assign(1, size);
+    }
+    if (!calibrating && rank < lanes_) {
+        // Local rank r connects to local rank r of the other device types,
+        // lane 0 doubles as the leader context. Every stripe gets its own
+        // device and thus its own sockets and event loop.
+        auto rendezvous = gloo_store();
+        auto attr = gloo_attr();
+        for (size_t stripe = 0; stripe < gloo_stripes(); ++stripe) {
+            std::string prefix = "kaitian_lane" + std::to_string(rank);
+            if (stripe > 0) {
+                prefix += "_stripe" + std::to_string(stripe);
+            }
+            gloo::rendezvous::PrefixStore lane_store(prefix, *rendezvous);
+            auto dev = gloo::transport::tcp::CreateDevice(attr);
+            auto lane_context = std::make_shared<gloo::rendezvous::Context>(
+                gloo_rank_, kaitian_gloo_world_size);
+            lane_context->connectFullMesh(lane_store, dev);
+            lane_contexts_.push_back(lane_context);
+        }
+        stripe_workers_ =
+            std::make_unique<StripeWorkers>(lane_contexts_.size() - 1);
+        if (rank == 0) {
+            context = lane_contexts_[0];
+            std::cout << "\033[1;92mKaitian connection established "
+                         "successfully.\033[0m"
+                      << std::endl;
+        }
+    }
+    if (!calibrating) {
+        exchangeGroupSizes();
+    }
+    progress_thread_ = std::thread(&ProcessGroupKaiTian::runLoop, this);
+}
+
+// The leaders allgather the group sizes over gloo and hand them to the rest
+// of their group through the local store.
+void ProcessGroupKaiTian::exchangeGroupSizes() {
+    const std::string key = "kaitian_group_sizes";
+    group_sizes_.resize(kaitian_gloo_world_size);
     if (context) {
+        int64_t local_size = size_;
+        gloo::AllgatherOptions gather_opts(context);
+        gather_opts.setInput(&local_size, 1);
+        gather_opts.setOutput(group_sizes_.data(), group_sizes_.size());
+        gloo::allgather(gather_opts);
+        std::ostringstream sizes;
+        for (auto group_size : group_sizes_) {
+            sizes << group_size << " ";
+        }
+        auto value = sizes.str();
+        store_->set(key, std::vector<uint8_t>(value.begin(), value.end()));
+    } else {
+        auto value = store_->get(key);
+        std::istringstream sizes(std::string(value.begin(), value.end()));
+        for (auto& group_size : group_sizes_) {
+            sizes >> group_size;
+        }
+    }
+    if (std::accumulate(group_sizes_.begin(), group_sizes_.end(), int64_t(0)) !=
+        global_size_) {
+        throw std::runtime_error(
+            "[KaiTian] Group sizes do not add up to the global world size.");
     }
-    work->future_->markCompleted(result);
-    return work;
 }
 
-c10::intrusive_ptr<Work> ProcessGroupKaiTian::allreduce(
-    std::vector<at::Tensor>& tensors, const AllreduceOptions& opts) {
-    auto work = c10::make_intrusive<WorkKaiTian>(tensors[0].device());
+bool ProcessGroupKaiTian::isGlobal(size_t global_count,
+                                   size_t local_count) const {
+    if (global_size_ == size_) {
+        return false;
+    }
+    if (global_count == static_cast<size_t>(global_size_)) {
+        return true;
+    }
+    if (global_count != local_count) {
+        throw std::invalid_argument(
+            "[KaiTian] Collective sizes match neither the group size (" +
+            std::to_string(size_) + ") nor the global world size (" +
+            std::to_string(global_size_) + ").");
+    }
+    return false;
+}
+
+static at::Device current_device() {
 #ifdef KAITIAN_MLU
-    work->cncl_work_ = cncl_process_group_->allreduce(tensors, opts);
-    work->cncl_work_->wait();
+    return at::Device(at::kMLU, torch_mlu::current_device());
 #endif
 #ifdef KAITIAN_CUDA
-    work->nccl_work_ = nccl_process_group_->allreduce(tensors, opts);
-    work->nccl_work_->wait();
+    return at::Device(at::kCUDA, c10::cuda::current_device());
 #endif
+#ifdef KAITIAN_CPU
+    return at::Device(at::kCPU);
+#endif
+    throw std::runtime_error("[KaiTian] No available devices.");
+}
+
+ProcessGroupKaiTian::~ProcessGroupKaiTian() {
+    {
+        std::lock_guard<std::mutex> lock(queue_mutex_);
+        stop_ = true;
+    }
+    queue_cv_.notify_all();
+    progress_thread_.join();
+}
+
+void ProcessGroupKaiTian::runLoop() {
+    while (true) {
+        std::function<void()> task;
+        {
+            std::unique_lock<std::mutex> lock(queue_mutex_);
+            queue_cv_.wait(lock, [&] { return stop_ || !queue_.empty(); });
+            // pending collectives are drained before the thread exits
+            if (queue_.empty()) {
+                return;
+            }
+            task = std::move(queue_.front());
+            queue_.pop_front();
+        }
+        task();
+    }
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::enqueue(
+    const at::Device& device, const char* op,
+    const std::vector<at::Tensor>& tensors, Collective fn) {
+    auto work = c10::make_intrusive<WorkKaiTian>(device);
+    // run on the caller's current stream so that device work stays ordered
+    // after whatever produced the input tensors
+    auto stream = c10::impl::VirtualGuardImpl(device.type()).getStream(device);
+    auto task = [work, stream, device, op, tensors, fn = std::move(fn)]() {
+        c10::StreamGuard guard(stream);
+        try {
+            std::vector<at::Tensor> result;
+            {
+                // recorded before the work completes, so that it is visible
+                // once wait() returns
+                CollectiveScope scope(op, tensors, device);
+                result = fn();
+            }
+            work->finishWork(std::move(result));
+        } catch (...) {
+            work->finishWorkError(std::current_exception());
+        }
+    };
+    {
+        std::lock_guard<std::mutex> lock(queue_mutex_);
+        queue_.push_back(std::move(task));
+    }
+    queue_cv_.notify_one();
+    return work;
+}
+
+// Allgather inside the group first, padding to the largest input of the
+// group, then the leaders exchange the group blocks with gloo allgatherv and
+// broadcast the result inside the group. Moves bytes, so every dtype the
+// intra-group backend supports works.
+at::Tensor ProcessGroupKaiTian::runGlobalAllgather(
+    const at::Tensor& input, const std::vector<int64_t>& numels) {
+    auto flat = input.reshape(-1);
+    std::vector<int64_t> offsets(global_size_ + 1, 0);
+    std::partial_sum(numels.begin(), numels.end(), offsets.begin() + 1);
+    if (flat.numel() != numels[global_rank_start_ + rank_]) {
+        throw std::invalid_argument(
+            "[KaiTian] Input size does not match the output size of this "
+            "rank.");
+    }
+
+    auto local_begin = numels.begin() + global_rank_start_;
+    int64_t local_max = *std::max_element(local_begin, local_begin + size_);
+    auto padded = at::zeros({local_max}, flat.options());
+    padded.narrow(0, 0, flat.numel()).copy_(flat);
+    auto gathered = at::empty({local_max * size_}, flat.options());
+    {
+        // the intra-group step before the inter-group hop
+        PhaseTimer timer(INTRA_REDUCE);
+        intra_process_group_->_allgather_base(gathered, padded)->wait();
+    }
+
+    auto output = at::empty({offsets.back()}, flat.options());
+    for (int r = 0; r < size_; ++r) {
+        int global_rank = global_rank_start_ + r;
+        output.narrow(0, offsets[global_rank], numels[global_rank])
+            .copy_(gathered.narrow(0, r * local_max, numels[global_rank]));
+    }
+    if (context) {
+        // the blocks of a group are contiguous, ordered like the gloo ranks
+        size_t element_size = flat.element_size();
+        std::vector<size_t> counts;
+        int start = 0;
+        for (auto group_size : group_sizes_) {
+            counts.push_back((offsets[start + group_size] - offsets[start]) *
+                             element_size);
+            start += group_size;
+        }
+        at::Tensor output_cpu;
+        {
+            PhaseTimer timer(D2H);
+            output_cpu = output.cpu();
+        }
+        auto local_cpu =
+            output_cpu.view(at::kByte)
+                .narrow(0, offsets[global_rank_start_] * element_size,
+                        counts[gloo_rank_])
+                .clone();
+        auto bytes = output_cpu.view(at::kByte);
+        gloo::AllgathervOptions gather_opts(context);
+        gather_opts.setInput(local_cpu.data_ptr<uint8_t>(), local_cpu.numel());
+        gather_opts.setOutput(bytes.data_ptr<uint8_t>(), counts);
+        {
+            PhaseTimer timer(INTER);
+            gloo::allgatherv(gather_opts);
+        }
+        PhaseTimer timer(H2D);
+        output.copy_(output_cpu);
+    }
+    std::vector<at::Tensor> outputs{output};
+    PhaseTimer timer(INTRA_BROADCAST);
+    intra_process_group_->broadcast(outputs)->wait();
+    return output;
+}
+
+// Two global allgathers: the send counts of every rank, so that every rank
+// knows where its part of every other rank's input starts, then the inputs.
+void ProcessGroupKaiTian::runGlobalAlltoall(
+    at::Tensor& output, const at::Tensor& input,
+    const std::vector<int64_t>& send_numels) {
+    auto counts = at::tensor(send_numels, at::kLong).to(input.device());
+    auto all_counts =
+        runGlobalAllgather(counts,
+                           std::vector<int64_t>(global_size_, global_size_))
+            .cpu();
+    auto matrix = all_counts.data_ptr<int64_t>();
+    std::vector<int64_t> input_numels(global_size_);
+    for (int src = 0; src < global_size_; ++src) {
+        input_numels[src] =
+            std::accumulate(matrix + src * global_size_,
+                            matrix + (src + 1) * global_size_, int64_t(0));
+    }
+    auto data = runGlobalAllgather(input, input_numels);
+
+    int me = global_rank_start_ + rank_;
+    int64_t src_offset = 0;
+    int64_t output_offset = 0;
+    for (int src = 0; src < global_size_; ++src) {
+        auto row = matrix + src * global_size_;
+        int64_t within = std::accumulate(row, row + me, int64_t(0));
+        if (output_offset + row[me] > output.numel()) {
+            throw std::invalid_argument(
+                "[KaiTian] alltoall output is smaller than the data sent to "
+                "this rank.");
+        }
+        output.narrow(0, output_offset, row[me])
+            .copy_(data.narrow(0, src_offset + within, row[me]));
+        output_offset += row[me];
+        src_offset += input_numels[src];
+    }
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::allgather(
+    std::vector<std::vector<at::Tensor>>& outputTensors,
+    std::vector<at::Tensor>& inputTensors, const AllgatherOptions& opts) {
+    return enqueue(
+        outputTensors[0][0].device(), "allgather", inputTensors,
+        [this, outputTensors, inputTensors, opts]() mutable {
+            auto& outputs = outputTensors[0];
+            // verify_params_across_processes() gathers inside the group
+            if (!isGlobal(outputs.size(), size_)) {
+                intra_process_group_
+                    ->allgather(outputTensors, inputTensors, opts)
+                    ->wait();
+                return outputs;
+            }
+            std::vector<int64_t> numels;
+            for (const auto& output : outputs) {
+                numels.push_back(output.numel());
+            }
+            auto gathered = runGlobalAllgather(inputTensors[0], numels);
+            int64_t offset = 0;
+            for (auto& output : outputs) {
+                output.copy_(gathered.narrow(0, offset, output.numel())
+                                 .view(output.sizes()));
+                offset += output.numel();
+            }
+            return outputs;
+        });
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::_allgather_base(
+    at::Tensor& outputBuffer, at::Tensor& inputBuffer,
+    const AllgatherOptions& opts) {
+    return enqueue(
+        outputBuffer.device(), "allgather", {inputBuffer},
+        [this, outputBuffer, inputBuffer, opts]() mutable {
+            if (!isGlobal(outputBuffer.numel() /
+                              std::max<int64_t>(1, inputBuffer.numel()),
+                          size_)) {
+                intra_process_group_
+                    ->_allgather_base(outputBuffer, inputBuffer, opts)
+                    ->wait();
+                return std::vector<at::Tensor>{outputBuffer};
+            }
+            auto gathered = runGlobalAllgather(
+                inputBuffer,
+                std::vector<int64_t>(global_size_, inputBuffer.numel()));
+            outputBuffer.copy_(gathered.view(outputBuffer.sizes()));
+            return std::vector<at::Tensor>{outputBuffer};
+        });
+}
+
+// Only the group blocks cross the gloo hop. With a lane per local rank, the
+// input is rearranged into one row per local rank that holds the block of that
+// local rank of every group. The rows are reduce-scattered inside the group and
+// every lane reduce-scatters its row with gloo, gloo rank j keeping the block
+// of group j, which is the block of this rank. Otherwise the group reduces to
+// its leader, the leaders reduce-scatter the group ranges with gloo and
+// broadcast the range of their group. Like allreduce, the result is pre-divided
+// by the number of groups.
+void ProcessGroupKaiTian::runGlobalReduceScatter(
+    at::Tensor& output, const at::Tensor& input,
+    const ReduceScatterOptions& opts) {
+    int64_t block = output.numel();
+    auto flat = input.reshape(-1);
+    if (flat.numel() != block * global_size_) {
+        throw std::invalid_argument(
+            "[KaiTian] reduce_scatter input must hold one output-sized block "
+            "per global rank.");
+    }
+    int groups = kaitian_gloo_world_size;
+    std::vector<int64_t> starts(groups + 1, 0);
+    std::partial_sum(group_sizes_.begin(), group_sizes_.end(),
+                     starts.begin() + 1);
+    at::Tensor result;
+    if (lanes_ == size_) {
+        // every group has size_ ranks
+        auto rows =
+            flat.view({groups, size_, block}).transpose(0, 1).contiguous();
+        auto row = at::empty({groups * block}, flat.options());
+        {
+            PhaseTimer timer(INTRA_REDUCE);
+            intra_process_group_->_reduce_scatter_base(row, rows.view(-1), opts)
+                ->wait();
+        }
+        at::Tensor row_cpu;
+        {
+            PhaseTimer timer(D2H);
+            row_cpu = row.cpu();
+        }
+        {
+            PhaseTimer timer(INTER);
+            gloo_reduce_scatter(lane_contexts_[0], row_cpu,
+                                std::vector<int>(groups, block));
+        }
+        PhaseTimer timer(H2D);
+        result =
+            row_cpu.narrow(0, gloo_rank_ * block, block).to(output.device());
+    } else {
+        // the leader keeps the input intact, reduce() writes in place
+        std::vector<at::Tensor> reduced{rank_ == 0 ? flat.clone() : flat};
+        ReduceOptions reduce_opts;
+        reduce_opts.reduceOp = opts.reduceOp;
+        reduce_opts.rootRank = 0;
+        {
+            PhaseTimer timer(INTRA_REDUCE);
+            intra_process_group_->reduce(reduced, reduce_opts)->wait();
+        }
+        std::vector<at::Tensor> range{
+            rank_ == 0 ? reduced[0].narrow(0, starts[gloo_rank_] * block,
+                                           size_ * block)
+                       : at::empty({size_ * block}, flat.options())};
+        if (context) {
+            at::Tensor reduced_cpu;
+            {
+                PhaseTimer timer(D2H);
+                reduced_cpu = reduced[0].cpu();
+            }
+            std::vector<int> recv_counts;
+            for (auto group_size : group_sizes_) {
+                recv_counts.push_back(group_size * block);
+            }
+            {
+                PhaseTimer timer(INTER);
+                gloo_reduce_scatter(context, reduced_cpu, recv_counts);
+            }
+            PhaseTimer timer(H2D);
+            range[0].copy_(reduced_cpu.narrow(0, starts[gloo_rank_] * block,
+                                              size_ * block));
+        }
+        {
+            PhaseTimer timer(INTRA_BROADCAST);
+            intra_process_group_->broadcast(range)->wait();
+        }
+        result = range[0].narrow(0, rank_ * block, block);
+    }
+    divideByGlooWorldSize(result);
+    output.copy_(result.view(output.sizes()));
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::reduce_scatter(
+    std::vector<at::Tensor>& outputTensors,
+    std::vector<std::vector<at::Tensor>>& inputTensors,
+    const ReduceScatterOptions& opts) {
+    return enqueue(
+        outputTensors[0].device(), "reduce_scatter", inputTensors[0],
+        [this, outputTensors, inputTensors, opts]() mutable {
+            auto& inputs = inputTensors[0];
+            if (!isGlobal(inputs.size(), size_)) {
+                intra_process_group_
+                    ->reduce_scatter(outputTensors, inputTensors, opts)
+                    ->wait();
+                return outputTensors;
+            }
+            for (const auto& input : inputs) {
+                if (input.numel() != outputTensors[0].numel()) {
+                    throw std::invalid_argument(
+                        "[KaiTian] reduce_scatter inputs must match the output "
+                        "size.");
+                }
+            }
+            runGlobalReduceScatter(outputTensors[0],
+                                   torch::utils::flatten_dense_tensors(inputs),
+                                   opts);
+            return outputTensors;
+        });
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::_reduce_scatter_base(
+    at::Tensor& outputBuffer, at::Tensor& inputBuffer,
+    const ReduceScatterOptions& opts) {
+    return enqueue(
+        outputBuffer.device(), "reduce_scatter", {inputBuffer},
+        [this, outputBuffer, inputBuffer, opts]() mutable {
+            if (!isGlobal(inputBuffer.numel() /
+                              std::max<int64_t>(1, outputBuffer.numel()),
+                          size_)) {
+                intra_process_group_
+                    ->_reduce_scatter_base(outputBuffer, inputBuffer, opts)
+                    ->wait();
+                return std::vector<at::Tensor>{outputBuffer};
+            }
+            runGlobalReduceScatter(outputBuffer, inputBuffer, opts);
+            return std::vector<at::Tensor>{outputBuffer};
+        });
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::alltoall_base(
+    at::Tensor& outputTensor, at::Tensor& inputTensor,
+    std::vector<int64_t>& outputSplitSizes,
+    std::vector<int64_t>& inputSplitSizes, const AllToAllOptions& opts) {
+    return enqueue(
+        outputTensor.device(), "alltoall", {inputTensor},
+        [this, outputTensor, inputTensor, outputSplitSizes, inputSplitSizes,
+         opts]() mutable {
+            // without split sizes the input is split evenly over the global
+            // world
+            if (!isGlobal(inputSplitSizes.empty() ? global_size_
+                                                  : inputSplitSizes.size(),
+                          size_)) {
+                intra_process_group_
+                    ->alltoall_base(outputTensor, inputTensor, outputSplitSizes,
+                                    inputSplitSizes, opts)
+                    ->wait();
+                return std::vector<at::Tensor>{outputTensor};
+            }
+            int64_t rows = inputTensor.dim() > 0 ? inputTensor.size(0) : 1;
+            int64_t row_numel = rows > 0 ? inputTensor.numel() / rows : 0;
+            std::vector<int64_t> send_numels;
+            if (inputSplitSizes.empty()) {
+                send_numels.assign(global_size_,
+                                   inputTensor.numel() / global_size_);
+            } else {
+                for (auto split : inputSplitSizes) {
+                    send_numels.push_back(split * row_numel);
+                }
+            }
+            auto output =
+                at::empty({outputTensor.numel()}, outputTensor.options());
+            runGlobalAlltoall(output, inputTensor, send_numels);
+            outputTensor.copy_(output.view(outputTensor.sizes()));
+            return std::vector<at::Tensor>{outputTensor};
+        });
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::alltoall(
+    std::vector<at::Tensor>& outputTensors,
+    std::vector<at::Tensor>& inputTensors, const AllToAllOptions& opts) {
+    return enqueue(
+        outputTensors[0].device(), "alltoall", inputTensors,
+        [this, outputTensors, inputTensors, opts]() mutable {
+            if (!isGlobal(inputTensors.size(), size_)) {
+                intra_process_group_
+                    ->alltoall(outputTensors, inputTensors, opts)
+                    ->wait();
+                return outputTensors;
+            }
+            std::vector<int64_t> send_numels;
+            for (const auto& input : inputTensors) {
+                send_numels.push_back(input.numel());
+            }
+            int64_t output_numel = 0;
+            for (const auto& output : outputTensors) {
+                output_numel += output.numel();
+            }
+            auto output = at::empty({output_numel}, outputTensors[0].options());
+            runGlobalAlltoall(output,
+                              torch::utils::flatten_dense_tensors(inputTensors),
+                              send_numels);
+            int64_t offset = 0;
+            for (auto& tensor : outputTensors) {
+                tensor.copy_(output.narrow(0, offset, tensor.numel())
+                                 .view(tensor.sizes()));
+                offset += tensor.numel();
+            }
+            return outputTensors;
+        });
+}
+
+// The leaders only enter the gloo barrier once their whole group arrived, and
+// the rest of the group only leaves once its leader is through.
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::barrier(
+    const BarrierOptions& opts) {
+    return enqueue(current_device(), "barrier", {}, [this, opts]() mutable {
+        {
+            PhaseTimer timer(INTRA_REDUCE);
+            intra_process_group_->barrier(opts)->wait();
+        }
+        if (context) {
+            PhaseTimer timer(INTER);
+            gloo::BarrierOptions barrier_opts(context);
+            gloo::barrier(barrier_opts);
+        }
+        PhaseTimer timer(INTRA_BROADCAST);
+        intra_process_group_->barrier(opts)->wait();
+        return std::vector<at::Tensor>();
+    });
+}
+
+// Here we do division in advance because the world_size in pytorch is
+// incorrect. And then pytorch will do division again.
+void ProcessGroupKaiTian::divideByGlooWorldSize(at::Tensor& tensor) {
+    if (tensor.scalar_type() == c10::ScalarType::Int ||
+        tensor.scalar_type() == c10::ScalarType::Long) {
+        auto t = tensor.to(torch::kFloat32);
+        t.div_(kaitian_gloo_world_size);
+        tensor.copy_(t.round().to(tensor.scalar_type()));
+    } else {
+        tensor.div_(kaitian_gloo_world_size);
+    }
+}
+
+static size_t hierarchical_min_bytes() {
+    const char* env = getenv("KAITIAN_HIERARCHICAL_MIN_SIZE");
+    return env ? static_cast<size_t>(std::strtoull(env, nullptr, 10))
+               : (1 << 20);
+}
+
+// Reduce-scatter inside the group, allreduce every shard over its own lane
+// with the shard owners of the other device types, then allgather inside the
+// group. Every local rank carries 1/size of the inter-group traffic and the
+// full intra-group broadcast is gone.
+void ProcessGroupKaiTian::runHierarchicalAllreduce(
+    at::Tensor& tensor, const AllreduceOptions& opts) {
+    auto flat = tensor.reshape(-1);
+    int64_t shard_numel = (flat.numel() + size_ - 1) / size_;
+    auto padded = at::zeros({shard_numel * size_}, flat.options());
+    padded.narrow(0, 0, flat.numel()).copy_(flat);
+    auto shard = at::empty({shard_numel}, flat.options());
+
+    ReduceScatterOptions reduce_scatter_opts;
+    reduce_scatter_opts.reduceOp = opts.reduceOp;
+    {
+        PhaseTimer timer(INTRA_REDUCE);
+        intra_process_group_
+            ->_reduce_scatter_base(shard, padded, reduce_scatter_opts)
+            ->wait();
+    }
+    gloo_entry(lane_contexts_, *stripe_workers_, algorithm_cache_, shard,
+               GlooFunction::ALLREDUCE);
+    divideByGlooWorldSize(shard);
+    PhaseTimer timer(INTRA_BROADCAST);
+    intra_process_group_->_allgather_base(padded, shard)->wait();
+    tensor.copy_(padded.narrow(0, 0, flat.numel()).view(tensor.sizes()));
+}
+
+void ProcessGroupKaiTian::runAllreduce(std::vector<at::Tensor>& tensors,
+                                       const AllreduceOptions& opts,
+                                       int64_t bucket, bool reset) {
+    static const size_t min_bytes = hierarchical_min_bytes();
+    auto& tensor = tensors[0];
+    const bool compress = bucket >= 0 && compression_enabled(tensor);
+    // all ranks of all groups take the same branch, it only depends on the
+    // tensor and the environment
+    if (lanes_ == size_ && size_ > 1 && tensors.size() == 1 && !compress &&
+        tensor.numel() * tensor.element_size() >= min_bytes) {
+        runHierarchicalAllreduce(tensor, opts);
+        return;
+    }
+
+    {
+        PhaseTimer timer(INTRA_REDUCE);
+        intra_process_group_->allreduce(tensors, opts)->wait();
+    }
     if (context) {
-        // NB: Temporarily not considering vector length.
-        gloo_entry(context, tensors[0], GlooFunction::ALLREDUCE);
-
-        // Here we do division in advance because the world_size in pytorch is
-        // incorrect. And then pytorch will do division again.
-        if (tensors[0].scalar_type() == c10::ScalarType::Int ||
-            tensors[0].scalar_type() == c10::ScalarType::Long) {
-            auto t = tensors[0].to(torch::kFloat32);
-            t.div_(kaitian_gloo_world_size);
-            tensors[0].copy_(t.round().to(tensors[0].scalar_type()));
+        // NB: The vector holds one tensor per local device, which are equal
+        // after the intra-group allreduce. Use allreduce_coalesced to reduce
+        // several different tensors at once.
+        if (compress) {
+            PhaseTimer timer(INTER);
+            compressor_.allreduce(context, tensor, bucket, reset);
         } else {
-            tensors[0].div_(kaitian_gloo_world_size);
+            gloo_entry(lane_contexts_, *stripe_workers_, algorithm_cache_,
+                       tensor, GlooFunction::ALLREDUCE);
         }
+        divideByGlooWorldSize(tensor);
     }
-#ifdef KAITIAN_MLU
-    work->cncl_work_ = cncl_process_group_->broadcast(tensors);
-    work->cncl_work_->wait();
-    auto result = work->cncl_work_->result();
-#endif
-#ifdef KAITIAN_CUDA
-    work->nccl_work_ = nccl_process_group_->broadcast(tensors);
-    work->nccl_work_->wait();
-    auto result = work->nccl_work_->result();
-#endif
-    work->future_->markCompleted(result);
-    return work;
+    PhaseTimer timer(INTRA_BROADCAST);
+    intra_process_group_->broadcast(tensors)->wait();
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::allreduce(
+    std::vector<at::Tensor>& tensors, const AllreduceOptions& opts) {
+    return enqueue(tensors[0].device(), "allreduce", tensors,
+                   [this, tensors, opts]() mutable {
+                       runAllreduce(tensors, opts);
+                       return tensors;
+                   });
+}
+
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::allreduceBucket(
+    at::Tensor& tensor, int64_t bucket, bool reset) {
+    std::vector<at::Tensor> tensors{tensor};
+    return enqueue(tensor.device(), "allreduce", tensors,
+                   [this, tensors, bucket, reset]() mutable {
+                       runAllreduce(tensors, AllreduceOptions(), bucket, reset);
+                       return tensors;
+                   });
+}
+
+// Tensors of the same dtype are flattened into one contiguous buffer, so every
+// dtype costs a single intra-group allreduce, D2H copy, gloo run, H2D copy and
+// intra-group broadcast instead of one of each per tensor.
+c10::intrusive_ptr<Work> ProcessGroupKaiTian::allreduce_coalesced(
+    std::vector<at::Tensor>& tensors, const AllreduceCoalescedOptions& opts) {
+    return enqueue(
+        tensors[0].device(), "allreduce_coalesced", tensors,
+        [this, tensors, opts]() mutable {
+            std::vector<c10::ScalarType> dtypes;
+            std::map<c10::ScalarType, std::vector<at::Tensor>> buckets;
+            for (const auto& tensor : tensors) {
+                auto dtype = tensor.scalar_type();
+                if (buckets.find(dtype) == buckets.end()) {
+                    dtypes.push_back(dtype);
+                }
+                buckets[dtype].push_back(tensor);
+            }
+            for (const auto& dtype : dtypes) {
+                auto& bucket = buckets[dtype];
+                std::vector<at::Tensor> flat{
+                    torch::utils::flatten_dense_tensors(bucket)};
+                runAllreduce(flat, opts);
+                auto outputs =
+                    torch::utils::unflatten_dense_tensors(flat[0], bucket);
+                for (size_t i = 0; i < bucket.size(); ++i) {
+                    bucket[i].copy_(outputs[i]);
+                }
+            }
+            return tensors;
+        });
 }
 
-// NB: Currently broadcast don't use future.
 c10::intrusive_ptr<Work> ProcessGroupKaiTian::broadcast(
     std::vector<at::Tensor>& tensors, const BroadcastOptions& opts) {
-    auto work = c10::make_intrusive<WorkKaiTian>(tensors[0].device());
-#ifdef KAITIAN_MLU
-    work->cncl_work_ = cncl_process_group_->broadcast(tensors, opts);
-    work->cncl_work_->wait();
-#endif
-#ifdef KAITIAN_CUDA
-    work->nccl_work_ = nccl_process_group_->broadcast(tensors, opts);
-    work->nccl_work_->wait();
-#endif
-    if (context) {
-        // NB: Temporarily not considering vector length.
-        gloo_entry(context, tensors[0], GlooFunction::BROADCAST);
-    }
-#ifdef KAITIAN_MLU
-    work->cncl_work_ = cncl_process_group_->broadcast(tensors);
-    work->cncl_work_->wait();
-#endif
-#ifdef KAITIAN_CUDA
-    work->nccl_work_ = nccl_process_group_->broadcast(tensors);
-    work->nccl_work_->wait();
-#endif
-    return work;
+    return enqueue(
+        tensors[0].device(), "broadcast", tensors,
+        [this, tensors, opts]() mutable {
+            {
+                PhaseTimer timer(INTRA_BROADCAST);
+                intra_process_group_->broadcast(tensors, opts)->wait();
+            }
+            if (context) {
+                // NB: Temporarily not considering vector length.
+                gloo_entry(lane_contexts_, *stripe_workers_, algorithm_cache_,
+                           tensors[0], GlooFunction::BROADCAST);
+            }
+            PhaseTimer timer(INTRA_BROADCAST);
+            intra_process_group_->broadcast(tensors)->wait();
+            return tensors;
+        });
 }
 
 c10::intrusive_ptr<ProcessGroup> ProcessGroupKaiTian::createProcessGroupKaiTian(
@@ -157,4 +853,66 @@ PYBIND11_MODULE(_C, m) {
     m.def("createProcessGroupKaiTian",
           &c10d::ProcessGroupKaiTian::createProcessGroupKaiTian);
     m.def("time_spend", &time_spend);
+    m.def("set_chunk_size", &set_chunk_size);
+    m.def("get_chunk_size", &get_chunk_size);
+    m.def("set_compression", &set_compression);
+    m.def("get_compression", &get_compression);
+    m.def(
+        "allreduce_bucket",
+        [](const c10::intrusive_ptr<c10d::ProcessGroup>& process_group,
+           at::Tensor tensor, int64_t bucket, bool reset) {
+            auto kaitian =
+                c10::dynamic_intrusive_pointer_cast<c10d::ProcessGroupKaiTian>(
+                    process_group);
+            if (!kaitian) {
+                throw std::invalid_argument(
+                    "[KaiTian] allreduce_bucket needs a kaitian process "
+                    "group.");
+            }
+            return kaitian->allreduceBucket(tensor, bucket, reset);
+        });
+
+    py::class_<CollectiveRecord>(m, "CollectiveRecord")
+        .def_readonly("op", &CollectiveRecord::op)
+        .def_readonly("dtype", &CollectiveRecord::dtype)
+        .def_readonly("bytes", &CollectiveRecord::bytes)
+        .def_readonly("start_us", &CollectiveRecord::start_us)
+        .def_readonly("duration_us", &CollectiveRecord::duration_us)
+        // phase name -> (start relative to start_us, duration), entered
+        // phases only
+        .def_property_readonly("phases", [](const CollectiveRecord& record) {
+            py::dict phases;
+            for (int phase = 0; phase < NUM_PHASES; ++phase) {
+                if (record.phase_start_us[phase] >= 0) {
+                    phases[py::str(TelemetryPhaseToString(
+                        static_cast<TelemetryPhase>(phase)))] =
+                        py::make_tuple(record.phase_start_us[phase],
+                                       record.phase_us[phase]);
+                }
+            }
+            return phases;
+        });
+    py::class_<LatencyHistogram>(m, "LatencyHistogram")
+        .def_readonly("op", &LatencyHistogram::op)
+        .def_readonly("size_bucket", &LatencyHistogram::size_bucket)
+        .def_readonly("calls", &LatencyHistogram::calls)
+        .def_readonly("total_us", &LatencyHistogram::total_us)
+        .def_readonly("counts", &LatencyHistogram::counts)
+        // phase name -> summed duration
+        .def_property_readonly("phases", [](const LatencyHistogram& histogram) {
+            py::dict phases;
+            for (int phase = 0; phase < NUM_PHASES; ++phase) {
+                phases[py::str(TelemetryPhaseToString(
+                    static_cast<TelemetryPhase>(phase)))] =
+                    histogram.phase_us[phase];
+            }
+            return phases;
+        });
+    py::class_<TelemetrySnapshot>(m, "TelemetrySnapshot")
+        .def_readonly("records", &TelemetrySnapshot::records)
+        .def_readonly("histograms", &TelemetrySnapshot::histograms)
+        .def_readonly("dropped", &TelemetrySnapshot::dropped);
+    m.def("get_telemetry", &get_telemetry);
+    m.def("get_telemetry_histograms", &get_telemetry_histograms);
+    m.def("reset_telemetry", &reset_telemetry);
 }
\ No newline at end of file
@@ -0,0 +1,176 @@
+#include "compression.hpp"
+
+#include <cmath>
+#include <cstdlib>
+#include <stdexcept>
+
+CompressionStats compression_stats;
+
+namespace {
+
+CompressionMode parse_mode(const std::string& mode) {
+    if (mode == "none") return CompressionMode::NONE;
+    if (mode == "fp16") return CompressionMode::FP16;
+    if (mode == "bf16") return CompressionMode::BF16;
+    if (mode == "int8") return CompressionMode::INT8;
+    if (mode == "topk") return CompressionMode::TOPK;
+    throw std::invalid_argument("[KaiTian] Unknown compression mode: " + mode);
+}
+
+std::string env_or(const char* name, const std::string& fallback) {
+    const char* env = getenv(name);
+    return env ? std::string(env) : fallback;
+}
+
+std::atomic<CompressionMode> compression_mode(
+    parse_mode(env_or("KAITIAN_COMPRESSION", "none")));
+std::atomic<double> topk_ratio(std::stod(env_or("KAITIAN_TOPK_RATIO", "0.01")));
+std::atomic<int64_t> int8_chunk(std::stoll(env_or("KAITIAN_INT8_CHUNK",
+                                                  "4096")));
+
+// Payload layouts, all of them have a size that only depends on numel:
+//   FP16 / BF16: the down-casted values
+//   INT8: one float32 scale per chunk, then the int8 values (padded)
+//   TOPK: k int32 indices, then k float32 values
+at::Tensor as_bytes(const at::Tensor& t) {
+    return t.contiguous().view(-1).view(at::kByte);
+}
+
+at::Tensor compress(const at::Tensor& x, CompressionMode mode, int64_t k,
+                    int64_t chunk) {
+    switch (mode) {
+        case CompressionMode::FP16:
+            return as_bytes(x.to(at::kHalf));
+        case CompressionMode::BF16:
+            return as_bytes(x.to(at::kBFloat16));
+        case CompressionMode::INT8: {
+            int64_t chunks = (x.numel() + chunk - 1) / chunk;
+            auto padded =
+                at::constant_pad_nd(x, {0, chunks * chunk - x.numel()})
+                    .view({chunks, chunk});
+            auto scale = padded.abs().amax(1, /*keepdim=*/true).div_(127.0);
+            scale.clamp_min_(1e-30);
+            auto q = padded.div(scale).round_().clamp_(-127, 127).to(at::kChar);
+            return at::cat({as_bytes(scale), as_bytes(q)});
+        }
+        case CompressionMode::TOPK: {
+            auto indices = std::get<1>(x.abs().topk(k));
+            auto values = x.index_select(0, indices);
+            return at::cat({as_bytes(indices.to(at::kInt)), as_bytes(values)});
+        }
+        default:
+            throw std::runtime_error(
+                "[KaiTian] Internal Error: unexpected compression mode.");
+    }
+}
+
+// Adds the decompressed payload to out (float32, numel elements).
+void decompress_add(const at::Tensor& payload, at::Tensor& out,
+                    CompressionMode mode, int64_t k, int64_t chunk) {
+    int64_t numel = out.numel();
+    switch (mode) {
+        case CompressionMode::FP16:
+            out.add_(payload.view(at::kHalf).to(at::kFloat));
+            break;
+        case CompressionMode::BF16:
+            out.add_(payload.view(at::kBFloat16).to(at::kFloat));
+            break;
+        case CompressionMode::INT8: {
+            int64_t chunks = (numel + chunk - 1) / chunk;
+            auto scale = payload.narrow(0, 0, chunks * 4)
+                             .view(at::kFloat)
+                             .view({chunks, 1});
+            auto q = payload.narrow(0, chunks * 4, chunks * chunk)
+                         .view(at::kChar)
+                         .view({chunks, chunk});
+            out.add_(q.to(at::kFloat).mul_(scale).view(-1).narrow(0, 0, numel));
+            break;
+        }
+        case CompressionMode::TOPK: {
+            auto indices = payload.narrow(0, 0, k * 4).view(at::kInt);
+            auto values = payload.narrow(0, k * 4, k * 4).view(at::kFloat);
+            out.index_add_(0, indices.to(at::kLong), values);
+            break;
+        }
+        default:
+            throw std::runtime_error(
+                "[KaiTian] Internal Error: unexpected compression mode.");
+    }
+}
+
+}  // namespace
+
+void set_compression(const std::string& mode, double ratio, int64_t chunk) {
+    if (ratio <= 0.0 || ratio > 1.0) {
+        throw std::invalid_argument(
+            "[KaiTian] topk_ratio should be in the interval (0, 1].");
+    }
+    if (chunk <= 0) {
+        throw std::invalid_argument("[KaiTian] int8_chunk should be positive.");
+    }
+    compression_mode = parse_mode(mode);
+    topk_ratio = ratio;
+    int8_chunk = chunk;
+}
+
+std::string get_compression() {
+    switch (compression_mode.load()) {
+        case CompressionMode::FP16:
+            return "fp16";
+        case CompressionMode::BF16:
+            return "bf16";
+        case CompressionMode::INT8:
+            return "int8";
+        case CompressionMode::TOPK:
+            return "topk";
+        default:
+            return "none";
+    }
+}
+
+bool compression_enabled(const torch::Tensor& tensor) {
+    return compression_mode != CompressionMode::NONE &&
+           tensor.is_floating_point();
+}
+
+void Compressor::allreduce(
+    const std::shared_ptr<gloo::rendezvous::Context>& context,
+    torch::Tensor& tensor, int64_t bucket, bool reset) {
+    CompressionMode mode = compression_mode;
+    int64_t chunk = int8_chunk;
+    int64_t numel = tensor.numel();
+    int64_t k = std::max<int64_t>(1, std::llround(numel * topk_ratio.load()));
+
+    // error feedback: compress x + residual and keep what was lost
+    auto& residual = residuals_[bucket];
+    if (reset || !residual.defined() || residual.numel() != numel ||
+        residual.device() != tensor.device()) {
+        residual = at::zeros({numel}, tensor.options().dtype(at::kFloat));
+    }
+    auto x = tensor.reshape(-1)
+                 .to(at::kFloat, /*non_blocking=*/false, /*copy=*/true)
+                 .add_(residual);
+    auto payload = compress(x, mode, k, chunk);
+    auto approx = at::zeros_like(x);
+    decompress_add(payload, approx, mode, k, chunk);
+    residual.copy_(x.sub_(approx));
+
+    auto payload_cpu = payload.to(at::kCPU);
+    int64_t payload_bytes = payload_cpu.numel();
+    auto gathered =
+        at::empty({context->size * payload_bytes}, payload_cpu.options());
+    gloo::AllgatherRing<uint8_t>(
+        context, {reinterpret_cast<const uint8_t*>(payload_cpu.data_ptr())},
+        reinterpret_cast<uint8_t*>(gathered.data_ptr()), payload_bytes)
+        .run();
+
+    auto sum = at::zeros({numel}, payload_cpu.options().dtype(at::kFloat));
+    for (int i = 0; i < context->size; ++i) {
+        decompress_add(gathered.narrow(0, i * payload_bytes, payload_bytes),
+                       sum, mode, k, chunk);
+    }
+    tensor.copy_(sum.view(tensor.sizes()).to(tensor.device()));
+
+    compression_stats.raw_bytes += numel * tensor.element_size();
+    compression_stats.wire_bytes += payload_bytes;
+}
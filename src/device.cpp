@@ -46,6 +46,10 @@ at::Tensor kaitian_empty_strided(at::IntArrayRef size, at::IntArrayRef stride,
     at::Tensor ret = at::native::empty_strided_cuda(
         size, stride, dtype, layout, optional_cuda_device, pin_memory);
     return ret;
+#endif
+#ifdef KAITIAN_CPU
+    return at::detail::empty_strided_cpu(size, stride, dtype, layout,
+                                         at::Device(at::kCPU), pin_memory);
 #endif
     throw std::runtime_error("empty_strided: no available devices");
 }
@@ -1,8 +1,19 @@
 #include "gloo.hpp"
 
+#include <c10/core/impl/VirtualGuardImpl.h>
+
+#include "compression.hpp"
+#include "telemetry.hpp"
+
+#include <algorithm>
+#include <atomic>
 #include <chrono>
 #include <cstdint>
+#include <cstdlib>
+#include <exception>
 #include <iostream>
+#include <mutex>
+#include <thread>
 
 std::string GlooFunctionToString(GlooFunction op) {
     switch (op) {
@@ -15,32 +26,433 @@ std::string GlooFunctionToString(GlooFunction op) {
     }
 }
 
+std::string GlooAlgorithmToString(GlooAlgorithm algorithm) {
+    switch (algorithm) {
+        case ONE_TO_ALL:
+            return "ONE_TO_ALL";
+        case RING:
+            return "RING";
+        case HALVING_DOUBLING:
+            return "HALVING_DOUBLING";
+        case BCUBE:
+            return "BCUBE";
+        case DIRECT:
+            return "DIRECT";
+        default:
+            return "UNKNOWN";
+    }
+}
+
+static size_t env_size(const char *name, size_t default_value) {
+    const char *env = getenv(name);
+    return env ? static_cast<size_t>(std::strtoull(env, nullptr, 10))
+               : default_value;
+}
+
+struct AlgorithmTuning {
+    std::string forced;
+    size_t direct_max;
+    size_t halving_doubling_max;
+    size_t bcube_min;
+    size_t stripes;
+    size_t stripe_min;
+};
+
+static const AlgorithmTuning &algorithm_tuning() {
+    static const AlgorithmTuning tuning = [] {
+        const char *forced = getenv("KAITIAN_GLOO_ALGORITHM");
+        AlgorithmTuning t{
+            forced ? forced : "auto",
+            env_size("KAITIAN_GLOO_DIRECT_MAX", 256 * 1024),
+            env_size("KAITIAN_GLOO_HD_MAX", 1024 * 1024),
+            env_size("KAITIAN_GLOO_BCUBE_MIN", 0),
+            std::max<size_t>(1, env_size("KAITIAN_GLOO_STRIPES", 2)),
+            env_size("KAITIAN_GLOO_STRIPE_MIN", 4 * 1024 * 1024)};
+        if (t.forced != "auto" && t.forced != "ring" &&
+            t.forced != "halving_doubling" && t.forced != "bcube" &&
+            t.forced != "direct") {
+            throw std::runtime_error(
+                "[KaiTian] Unknown KAITIAN_GLOO_ALGORITHM: " + t.forced);
+        }
+        return t;
+    }();
+    return tuning;
+}
+
+GlooAlgorithm select_algorithm(GlooFunction op, int context_size,
+                               size_t nbytes) {
+    if (op == BROADCAST) {
+        return ONE_TO_ALL;
+    }
+    const auto &tuning = algorithm_tuning();
+    if (tuning.forced == "ring") {
+        return RING;
+    } else if (tuning.forced == "halving_doubling") {
+        return HALVING_DOUBLING;
+    } else if (tuning.forced == "bcube") {
+        return BCUBE;
+    } else if (tuning.forced == "direct" && context_size == 2) {
+        return DIRECT;
+    }
+    if (context_size == 2 && nbytes <= tuning.direct_max) {
+        return DIRECT;
+    }
+    // latency bound: log2(n) steps instead of 2(n-1)
+    if (nbytes <= tuning.halving_doubling_max) {
+        return HALVING_DOUBLING;
+    }
+    if (tuning.bcube_min > 0 && nbytes >= tuning.bcube_min) {
+        return BCUBE;
+    }
+    return RING;
+}
+
+size_t gloo_stripes() { return algorithm_tuning().stripes; }
+
+size_t select_stripes(size_t nbytes, size_t available) {
+    if (nbytes < algorithm_tuning().stripe_min) {
+        return 1;
+    }
+    return std::min(available, gloo_stripes());
+}
+
+struct DispatchStats {
+    uint64_t calls = 0;
+    uint64_t bytes = 0;
+    std::chrono::microseconds time{0};
+};
+
+static std::mutex dispatch_mutex;
+static std::map<GlooAlgorithm, DispatchStats> dispatch_stats;
+
 std::chrono::microseconds total_time(0);
 std::map<GlooFunction, std::chrono::microseconds> function_times;
 
+// 0 disables chunking
+std::atomic<size_t> chunk_size([] {
+    const char *env = getenv("KAITIAN_CHUNK_SIZE");
+    return env ? static_cast<size_t>(std::strtoull(env, nullptr, 10)) : 0;
+}());
+
+void set_chunk_size(size_t nbytes) { chunk_size = nbytes; }
+
+size_t get_chunk_size() { return chunk_size; }
+
+AlgorithmCacheStats algorithm_cache_stats;
+
 // https://pytorch.org/docs/stable/tensor_attributes.html#torch.dtype
-void gloo_entry(const std::shared_ptr<gloo::rendezvous::Context> &context,
-                torch::Tensor &tensor, GlooFunction op) {
-    auto start = std::chrono::high_resolution_clock::now();
-    auto tensor_cpu = tensor.to(torch::kCPU);
+static std::unique_ptr<gloo::Algorithm> create_algorithm(
+    const std::shared_ptr<gloo::rendezvous::Context> &context,
+    torch::Tensor &tensor_cpu, GlooAlgorithm algorithm) {
+    switch (tensor_cpu.scalar_type()) {
+        case c10::ScalarType::Float:
+            return _entry<float>(context, tensor_cpu, algorithm);
+        case c10::ScalarType::Double:
+            return _entry<double>(context, tensor_cpu, algorithm);
+        case c10::ScalarType::Long:
+            return _entry<int64_t>(context, tensor_cpu, algorithm);
+        case c10::ScalarType::Int:
+            return _entry<int32_t>(context, tensor_cpu, algorithm);
+        case c10::ScalarType::Half:
+            return _entry<c10::Half>(context, tensor_cpu, algorithm);
+        case c10::ScalarType::BFloat16:
+            return _entry<c10::BFloat16>(context, tensor_cpu, algorithm);
+        default:
+            throw std::runtime_error(
+                std::string("[KaiTian] Unsupported tensor dtype: ") +
+                c10::toString(tensor_cpu.scalar_type()));
+    }
+}
+
+void check_gloo_dtype(c10::ScalarType dtype) {
+    switch (dtype) {
+        case c10::ScalarType::Float:
+        case c10::ScalarType::Double:
+        case c10::ScalarType::Long:
+        case c10::ScalarType::Int:
+        case c10::ScalarType::Half:
+        case c10::ScalarType::BFloat16:
+            return;
+        default:
+            throw std::runtime_error(
+                std::string("[KaiTian] Unsupported tensor dtype: ") +
+                c10::toString(dtype));
+    }
+}
+
+template <typename T>
+static void _reduce_scatter(
+    const std::shared_ptr<gloo::rendezvous::Context> &context,
+    torch::Tensor &tensor_cpu, const std::vector<int> &recv_counts) {
+    gloo::ReduceScatterHalvingDoubling<T>(
+        context, {reinterpret_cast<T *>(tensor_cpu.data_ptr())},
+        tensor_cpu.numel(), recv_counts, sum_function<T>())
+        .run();
+}
+
+void gloo_reduce_scatter(
+    const std::shared_ptr<gloo::rendezvous::Context> &context,
+    torch::Tensor &tensor_cpu, const std::vector<int> &recv_counts) {
     switch (tensor_cpu.scalar_type()) {
         case c10::ScalarType::Float:
-            _entry<float>(context, tensor_cpu, op);
-            break;
+            return _reduce_scatter<float>(context, tensor_cpu, recv_counts);
         case c10::ScalarType::Double:
-            _entry<double>(context, tensor_cpu, op);
-            break;
+            return _reduce_scatter<double>(context, tensor_cpu, recv_counts);
         case c10::ScalarType::Long:
-            _entry<int64_t>(context, tensor_cpu, op);
-            break;
+            return _reduce_scatter<int64_t>(context, tensor_cpu, recv_counts);
         case c10::ScalarType::Int:
-            _entry<int32_t>(context, tensor_cpu, op);
-            break;
+            return _reduce_scatter<int32_t>(context, tensor_cpu, recv_counts);
+        case c10::ScalarType::Half:
+            return _reduce_scatter<c10::Half>(context, tensor_cpu, recv_counts);
+        case c10::ScalarType::BFloat16:
+            return _reduce_scatter<c10::BFloat16>(context, tensor_cpu,
+                                                  recv_counts);
         default:
-            std::cerr << "Unsupported tensor dtype: "
-                      << tensor_cpu.scalar_type() << std::endl;
+            throw std::runtime_error(
+                std::string("[KaiTian] Unsupported tensor dtype: ") +
+                c10::toString(tensor_cpu.scalar_type()));
     }
-    tensor.copy_(tensor_cpu.to(tensor.device()));
+}
+
+static size_t algorithm_cache_capacity() {
+    const char *env = getenv("KAITIAN_ALGORITHM_CACHE_SIZE");
+    return env ? static_cast<size_t>(std::strtoull(env, nullptr, 10)) : 64;
+}
+
+AlgorithmCache::AlgorithmCache(StagingBufferPool &pool)
+    : AlgorithmCache(pool, algorithm_cache_capacity()) {}
+
+AlgorithmCache::AlgorithmCache(StagingBufferPool &pool, size_t capacity)
+    : pool_(pool), capacity_(capacity) {}
+
+AlgorithmCache::~AlgorithmCache() {
+    for (auto &entry : entries_) {
+        pool_.release(entry.second->buffer, entry.second->ready);
+    }
+}
+
+std::shared_ptr<CachedAlgorithm> AlgorithmCache::acquire(
+    const AlgorithmKey &key, const GlooContexts &contexts,
+    const at::Device &device) {
+    auto it = index_.find(key);
+    if (it != index_.end()) {
+        auto entry = std::move(it->second->second);
+        entries_.erase(it->second);
+        index_.erase(it);
+        algorithm_cache_stats.hits++;
+        return entry;
+    }
+    algorithm_cache_stats.misses++;
+    auto entry = std::make_shared<CachedAlgorithm>();
+    size_t element_size = c10::elementSize(key.dtype);
+    entry->buffer = pool_.acquire(key.numel * element_size, device);
+    auto tensor_cpu =
+        entry->buffer.narrow(0, 0, key.numel * element_size).view(key.dtype);
+    for (int64_t offset = 0; offset < key.numel; offset += key.chunk_numel) {
+        auto chunk_cpu = tensor_cpu.narrow(
+            0, offset, std::min(key.chunk_numel, key.numel - offset));
+        // every stripe is a separate context, so slots stay in lockstep
+        // across ranks as long as they all split the chunk the same way
+        int64_t stripes = std::min<int64_t>(
+            select_stripes(chunk_cpu.numel() * element_size, contexts.size()),
+            chunk_cpu.numel());
+        int64_t stripe_numel = (chunk_cpu.numel() + stripes - 1) / stripes;
+        auto selected = select_algorithm(
+            key.op, contexts[0]->size,
+            std::min(chunk_cpu.numel(), stripe_numel) * element_size);
+        std::vector<std::unique_ptr<gloo::Algorithm>> algorithms;
+        for (int64_t s = 0; s * stripe_numel < chunk_cpu.numel(); ++s) {
+            auto stripe_cpu = chunk_cpu.narrow(
+                0, s * stripe_numel,
+                std::min(stripe_numel, chunk_cpu.numel() - s * stripe_numel));
+            algorithms.push_back(
+                create_algorithm(contexts[s], stripe_cpu, selected));
+        }
+        entry->algorithms.push_back(std::move(algorithms));
+        entry->selected.push_back(selected);
+    }
+    return entry;
+}
+
+void AlgorithmCache::release(const AlgorithmKey &key,
+                             std::shared_ptr<CachedAlgorithm> entry) {
+    entries_.emplace_front(key, std::move(entry));
+    index_[key] = entries_.begin();
+    // Cached buffers count against the capacity of the staging pool, so
+    // entries are also dropped while they alone exceed it. All ranks issue the
+    // same collectives, so they evict in lockstep as long as they use the same
+    // KAITIAN_STAGING_POOL_MB.
+    while (entries_.size() > capacity_ ||
+           (entries_.size() > 1 && pool_.overCapacity())) {
+        auto &evicted = entries_.back();
+        pool_.release(evicted.second->buffer, evicted.second->ready);
+        index_.erase(evicted.first);
+        entries_.pop_back();
+        algorithm_cache_stats.evictions++;
+    }
+}
+
+StripeWorkers::StripeWorkers(size_t workers) : workers_(workers) {
+    for (size_t index = 0; index < workers_.size(); ++index) {
+        workers_[index].thread = std::thread(&StripeWorkers::loop, this, index);
+    }
+}
+
+StripeWorkers::~StripeWorkers() {
+    {
+        std::lock_guard<std::mutex> lock(mutex_);
+        stop_ = true;
+    }
+    start_cv_.notify_all();
+    for (auto &worker : workers_) {
+        worker.thread.join();
+    }
+}
+
+void StripeWorkers::loop(size_t index) {
+    auto &worker = workers_[index];
+    std::unique_lock<std::mutex> lock(mutex_);
+    while (true) {
+        start_cv_.wait(lock, [&] { return stop_ || worker.task != nullptr; });
+        if (stop_) {
+            return;
+        }
+        auto task = worker.task;
+        lock.unlock();
+        std::exception_ptr error;
+        try {
+            task->run();
+        } catch (...) {
+            error = std::current_exception();
+        }
+        lock.lock();
+        worker.task = nullptr;
+        worker.error = error;
+        if (--pending_ == 0) {
+            done_cv_.notify_one();
+        }
+    }
+}
+
+void StripeWorkers::run(
+    std::vector<std::unique_ptr<gloo::Algorithm>> &algorithms) {
+    if (algorithms.size() == 1) {
+        algorithms[0]->run();
+        return;
+    }
+    if (algorithms.size() - 1 > workers_.size()) {
+        throw std::runtime_error(
+            "[KaiTian] Internal Error: more stripes than stripe workers.");
+    }
+    {
+        std::lock_guard<std::mutex> lock(mutex_);
+        for (size_t s = 1; s < algorithms.size(); ++s) {
+            workers_[s - 1].task = algorithms[s].get();
+            workers_[s - 1].error = nullptr;
+        }
+        pending_ = algorithms.size() - 1;
+    }
+    start_cv_.notify_all();
+    std::exception_ptr error;
+    try {
+        algorithms[0]->run();
+    } catch (...) {
+        error = std::current_exception();
+    }
+    std::unique_lock<std::mutex> lock(mutex_);
+    done_cv_.wait(lock, [&] { return pending_ == 0; });
+    for (size_t s = 1; s < algorithms.size() && !error; ++s) {
+        error = workers_[s - 1].error;
+    }
+    lock.unlock();
+    if (error) {
+        std::rethrow_exception(error);
+    }
+}
+
+void gloo_entry(const GlooContexts &contexts, StripeWorkers &workers,
+                AlgorithmCache &cache, torch::Tensor &tensor, GlooFunction op) {
+    auto start = std::chrono::high_resolution_clock::now();
+    check_gloo_dtype(tensor.scalar_type());
+    auto device = tensor.device();
+    auto stream = c10::impl::VirtualGuardImpl(device.type()).getStream(device);
+    auto flat =
+        tensor.is_contiguous() ? tensor.view(-1) : tensor.contiguous().view(-1);
+
+    // Split into chunks so that the D2H copy of chunk k+1 and the H2D copy of
+    // chunk k-1 run on the device stream while gloo works on chunk k.
+    int64_t chunk_numel = std::max<int64_t>(1, flat.numel());
+    size_t chunk_bytes = chunk_size;
+    if (chunk_bytes > 0) {
+        chunk_numel = std::max<int64_t>(1, chunk_bytes / tensor.element_size());
+    }
+    AlgorithmKey key{op, tensor.scalar_type(), flat.numel(), chunk_numel};
+    auto entry = cache.acquire(key, contexts, device);
+    if (entry->ready) {
+        entry->ready->synchronize();
+    }
+    size_t nbytes = tensor.numel() * tensor.element_size();
+    auto tensor_cpu =
+        entry->buffer.narrow(0, 0, nbytes).view(tensor.scalar_type());
+
+    int64_t chunks = entry->algorithms.size();
+    auto narrow = [&](torch::Tensor &t, int64_t k) {
+        int64_t offset = k * chunk_numel;
+        return t.narrow(0, offset, std::min(chunk_numel, t.numel() - offset));
+    };
+    // copies from CPU tensors are synchronous, and CPU has no events
+    bool use_events = device.type() != at::kCPU;
+    std::vector<c10::Event> copied;
+    copied.reserve(chunks);
+    auto copy_in = [&](int64_t k) {
+        narrow(tensor_cpu, k).copy_(narrow(flat, k), /*non_blocking=*/true);
+        if (use_events) {
+            copied.emplace_back(device.type());
+            copied.back().record(stream);
+        }
+    };
+
+    {
+        PhaseTimer timer(D2H);
+        copy_in(0);
+    }
+    for (int64_t k = 0; k < chunks; ++k) {
+        {
+            PhaseTimer timer(D2H);
+            if (k + 1 < chunks) {
+                copy_in(k + 1);
+            }
+            if (use_events) {
+                copied[k].synchronize();
+            }
+        }
+        auto chunk_start = std::chrono::high_resolution_clock::now();
+        {
+            PhaseTimer timer(INTER);
+            workers.run(entry->algorithms[k]);
+        }
+        auto chunk_time = std::chrono::duration_cast<std::chrono::microseconds>(
+            std::chrono::high_resolution_clock::now() - chunk_start);
+        {
+            std::lock_guard<std::mutex> lock(dispatch_mutex);
+            auto &stats = dispatch_stats[entry->selected[k]];
+            stats.calls++;
+            stats.bytes += narrow(flat, k).numel() * tensor.element_size();
+            stats.time += chunk_time;
+        }
+        PhaseTimer timer(H2D);
+        narrow(flat, k).copy_(narrow(tensor_cpu, k), /*non_blocking=*/true);
+    }
+    if (!tensor.is_contiguous()) {
+        PhaseTimer timer(H2D);
+        tensor.copy_(flat.view(tensor.sizes()));
+    }
+    // the buffer is reused once the H2D copy has been consumed
+    if (use_events) {
+        entry->ready = std::make_shared<c10::Event>(device.type());
+        entry->ready->record(stream);
+    }
+    cache.release(key, std::move(entry));
     auto end = std::chrono::high_resolution_clock::now();
     std::chrono::microseconds duration =
         std::chrono::duration_cast<std::chrono::microseconds>(end - start);
@@ -69,4 +481,39 @@ void time_spend() {
                   << funcSeconds << std::setw(15) << std::fixed
                   << std::setprecision(3) << percentage << std::endl;
     }
+
+    std::cout << std::string(50, '-') << std::endl;
+    std::cout << "Staging pool: " << staging_stats.hits << " hits, "
+              << staging_stats.misses << " misses, " << staging_stats.evictions
+              << " evictions, " << std::setprecision(1)
+              << staging_stats.allocated_bytes / 1048576.0 << " MiB allocated, "
+              << staging_stats.pooled_bytes / 1048576.0 << " MiB pooled"
+              << std::endl;
+    {
+        std::lock_guard<std::mutex> lock(dispatch_mutex);
+        for (const auto &pair : dispatch_stats) {
+            const auto &stats = pair.second;
+            double seconds = stats.time.count() / 1000000.0;
+            std::cout << "Gloo " << GlooAlgorithmToString(pair.first) << ": "
+                      << stats.calls << " chunks, " << std::setprecision(1)
+                      << stats.bytes / 1048576.0 << " MiB, "
+                      << std::setprecision(3) << seconds << " seconds ("
+                      << std::setprecision(1)
+                      << (seconds > 0 ? stats.bytes / 1048576.0 / seconds : 0.0)
+                      << " MiB/s)" << std::endl;
+        }
+    }
+    uint64_t lookups =
+        algorithm_cache_stats.hits + algorithm_cache_stats.misses;
+    std::cout << "Algorithm cache: " << algorithm_cache_stats.hits << " hits, "
+              << algorithm_cache_stats.misses << " misses, "
+              << algorithm_cache_stats.evictions << " evictions ("
+              << (lookups ? 100.0 * algorithm_cache_stats.hits / lookups : 0.0)
+              << "% hit rate)" << std::endl;
+    if (compression_stats.raw_bytes > 0) {
+        std::cout << "Compression (" << get_compression()
+                  << "): " << compression_stats.raw_bytes / 1048576.0
+                  << " MiB -> " << compression_stats.wire_bytes / 1048576.0
+                  << " MiB on the wire" << std::endl;
+    }
 }
\ No newline at end of file
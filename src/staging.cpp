@@ -0,0 +1,87 @@
+#include "staging.hpp"
+
+#include <cstdlib>
+
+StagingStats staging_stats;
+
+namespace {
+
+constexpr size_t kMinSizeClass = 4096;
+
+size_t sizeClass(size_t nbytes) {
+    size_t size = kMinSizeClass;
+    while (size < nbytes) {
+        size <<= 1;
+    }
+    return size;
+}
+
+size_t defaultCapacity() {
+    const char* env = getenv("KAITIAN_STAGING_POOL_MB");
+    size_t megabytes = env ? std::strtoull(env, nullptr, 10) : 1024;
+    return megabytes << 20;
+}
+
+}  // namespace
+
+StagingBufferPool::StagingBufferPool() : capacity_(defaultCapacity()) {}
+
+StagingBufferPool::StagingBufferPool(size_t capacity) : capacity_(capacity) {}
+
+at::Tensor StagingBufferPool::acquire(size_t nbytes, const at::Device& device) {
+    size_t size = sizeClass(nbytes);
+    std::unique_lock<std::mutex> lock(mutex_);
+    for (auto it = free_.begin(); it != free_.end(); ++it) {
+        if (static_cast<size_t>(it->buffer.numel()) == size) {
+            Entry entry = std::move(*it);
+            free_.erase(it);
+            lock.unlock();
+            staging_stats.hits++;
+            if (entry.ready) {
+                entry.ready->synchronize();
+            }
+            return entry.buffer;
+        }
+    }
+    total_bytes_ += size;
+    evict(0);
+    lock.unlock();
+
+    staging_stats.misses++;
+    staging_stats.allocated_bytes += size;
+    auto buffer = at::empty({static_cast<int64_t>(size)}, at::kByte);
+    if (device.type() != at::kCPU) {
+        buffer = buffer.pin_memory(device);
+    }
+    return buffer;
+}
+
+void StagingBufferPool::release(at::Tensor buffer,
+                                std::shared_ptr<c10::Event> ready) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    free_.push_front(Entry{std::move(buffer), std::move(ready)});
+    evict(1);
+}
+
+bool StagingBufferPool::overCapacity() {
+    std::lock_guard<std::mutex> lock(mutex_);
+    size_t free_bytes = 0;
+    for (const auto& entry : free_) {
+        free_bytes += entry.buffer.numel();
+    }
+    return total_bytes_ - free_bytes > capacity_;
+}
+
+void StagingBufferPool::evict(size_t keep) {
+    while (total_bytes_ > capacity_ && free_.size() > keep) {
+        auto& entry = free_.back();
+        // the pending copy must finish before the memory is handed back
+        if (entry.ready) {
+            entry.ready->synchronize();
+        }
+        total_bytes_ -= entry.buffer.numel();
+        free_.pop_back();
+        staging_stats.evictions++;
+    }
+    staging_stats.pooled_bytes = total_bytes_;
+}
@@ -0,0 +1,191 @@
+#include "telemetry.hpp"
+
+#include <c10/core/impl/VirtualGuardImpl.h>
+
+#include <algorithm>
+#include <cstdio>
+#include <cstdlib>
+
+Telemetry telemetry;
+
+namespace {
+
+constexpr int kLatencyBuckets = 32;
+
+thread_local CollectiveScope* current_scope = nullptr;
+
+int log2_bucket(uint64_t value) {
+    int bucket = 0;
+    while (value > 1) {
+        value >>= 1;
+        ++bucket;
+    }
+    return bucket;
+}
+
+}  // namespace
+
+std::string TelemetryPhaseToString(TelemetryPhase phase) {
+    switch (phase) {
+        case INTRA_REDUCE:
+            return "intra_reduce";
+        case D2H:
+            return "d2h";
+        case INTER:
+            return "inter";
+        case H2D:
+            return "h2d";
+        case INTRA_BROADCAST:
+            return "intra_broadcast";
+        default:
+            return "unknown";
+    }
+}
+
+Telemetry::Telemetry() : epoch_(std::chrono::steady_clock::now()) {
+    const char* mode = getenv("KAITIAN_TELEMETRY");
+    std::string value = mode ? mode : "on";
+    if (value == "on") {
+        mode_ = ON;
+    } else if (value == "off") {
+        mode_ = OFF;
+    } else if (value == "sync") {
+        mode_ = SYNC;
+    } else {
+        // runs during static initialization, where an exception would
+        // terminate the process before Python could report it
+        fprintf(stderr,
+                "[KaiTian][Warning] Unknown KAITIAN_TELEMETRY '%s', using "
+                "'on'. Valid values are on, off and sync.\n",
+                value.c_str());
+        mode_ = ON;
+    }
+    const char* records = getenv("KAITIAN_TELEMETRY_RECORDS");
+    capacity_ = records ? std::strtoull(records, nullptr, 10) : 4096;
+    ring_.reserve(capacity_);
+}
+
+int64_t Telemetry::now_us() const {
+    return std::chrono::duration_cast<std::chrono::microseconds>(
+               std::chrono::steady_clock::now() - epoch_)
+        .count();
+}
+
+void Telemetry::add(CollectiveRecord record) {
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto key = std::make_pair(record.op, log2_bucket(record.bytes));
+    auto& histogram = histograms_[key];
+    if (histogram.counts.empty()) {
+        histogram.op = key.first;
+        histogram.size_bucket = key.second;
+        histogram.counts.resize(kLatencyBuckets);
+    }
+    histogram.calls++;
+    histogram.total_us += record.duration_us;
+    for (int phase = 0; phase < NUM_PHASES; ++phase) {
+        histogram.phase_us[phase] += record.phase_us[phase];
+    }
+    histogram.counts[std::min(kLatencyBuckets - 1,
+                              log2_bucket(record.duration_us))]++;
+
+    if (capacity_ == 0) {
+        dropped_++;
+    } else if (ring_.size() < capacity_) {
+        ring_.push_back(std::move(record));
+    } else {
+        ring_[head_] = std::move(record);
+        head_ = (head_ + 1) % capacity_;
+        dropped_++;
+    }
+}
+
+TelemetrySnapshot Telemetry::snapshot() {
+    std::lock_guard<std::mutex> lock(mutex_);
+    TelemetrySnapshot snapshot;
+    snapshot.records.reserve(ring_.size());
+    for (size_t i = 0; i < ring_.size(); ++i) {
+        snapshot.records.push_back(ring_[(head_ + i) % ring_.size()]);
+    }
+    for (const auto& pair : histograms_) {
+        snapshot.histograms.push_back(pair.second);
+    }
+    snapshot.dropped = dropped_;
+    return snapshot;
+}
+
+std::vector<LatencyHistogram> Telemetry::histograms() {
+    std::lock_guard<std::mutex> lock(mutex_);
+    std::vector<LatencyHistogram> histograms;
+    histograms.reserve(histograms_.size());
+    for (const auto& pair : histograms_) {
+        histograms.push_back(pair.second);
+    }
+    return histograms;
+}
+
+void Telemetry::reset() {
+    std::lock_guard<std::mutex> lock(mutex_);
+    ring_.clear();
+    head_ = 0;
+    dropped_ = 0;
+    histograms_.clear();
+}
+
+CollectiveScope::CollectiveScope(const char* op,
+                                 const std::vector<at::Tensor>& tensors,
+                                 const at::Device& device)
+    : device_(device), active_(telemetry.enabled() && !current_scope) {
+    if (!active_) {
+        return;
+    }
+    record_.op = op;
+    record_.dtype =
+        tensors.empty() ? "" : c10::toString(tensors[0].scalar_type());
+    for (const auto& tensor : tensors) {
+        record_.bytes += tensor.numel() * tensor.element_size();
+    }
+    record_.phase_start_us.fill(-1);
+    record_.phase_us.fill(0);
+    record_.start_us = telemetry.now_us();
+    current_scope = this;
+}
+
+CollectiveScope::~CollectiveScope() {
+    if (!active_) {
+        return;
+    }
+    current_scope = nullptr;
+    record_.duration_us = telemetry.now_us() - record_.start_us;
+    telemetry.add(std::move(record_));
+}
+
+PhaseTimer::PhaseTimer(TelemetryPhase phase)
+    : scope_(current_scope), phase_(phase) {
+    if (scope_) {
+        start_us_ = telemetry.now_us();
+    }
+}
+
+PhaseTimer::~PhaseTimer() {
+    if (!scope_) {
+        return;
+    }
+    if (telemetry.synchronizing() && scope_->device_.type() != at::kCPU) {
+        c10::impl::VirtualGuardImpl(scope_->device_.type())
+            .getStream(scope_->device_)
+            .synchronize();
+    }
+    auto& record = scope_->record_;
+    if (record.phase_start_us[phase_] < 0) {
+        record.phase_start_us[phase_] = start_us_ - record.start_us;
+    }
+    record.phase_us[phase_] += telemetry.now_us() - start_us_;
+}
+
+TelemetrySnapshot get_telemetry() { return telemetry.snapshot(); }
+
+std::vector<LatencyHistogram> get_telemetry_histograms() {
+    return telemetry.histograms();
+}
+
+void reset_telemetry() { telemetry.reset(); }
@@ -0,0 +1,68 @@
+import pytest
+
+
+# Stands in for a docker container. Every reload() moves on to the next of the
+# given states until the last one, which stays.
+class FakeContainer:
+    def __init__(self, client, spec: dict, states: list[dict], output: bytes):
+        self.client = client
+        self.spec = spec
+        self.name = spec["name"]
+        self.states = list(states)
+        self.output = output
+        self.removed = False
+        self.stopped = False
+        self._apply(self.states[0])
+
+    def _apply(self, state: dict):
+        self.status = state["Status"]
+        self.attrs = {"Name": f"/{self.name}", "State": state}
+
+    def reload(self):
+        if len(self.states) > 1:
+            self.states.pop(0)
+        self._apply(self.states[0])
+
+    def logs(self, tail=None, stream=False, follow=False):
+        if stream:
+            return iter([self.output])
+        return self.output
+
+    def stop(self):
+        self.stopped = True
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.created = []
+
+    def run(self, **spec):
+        container = FakeContainer(
+            self.client,
+            spec,
+            self.client.states.get(spec["name"], [{"Status": "running"}]),
+            self.client.output.get(spec["name"], b""),
+        )
+        self.created.append(container)
+        return container
+
+    def list(self, all=False):
+        return [container for container in self.created if not container.removed]
+
+
+# The part of docker.DockerClient the launcher uses. states maps container
+# names to the states their reload() walks through, output to their logs.
+class FakeClient:
+    def __init__(self, states: dict = None, output: dict = None):
+        self.states = states or {}
+        self.output = output or {}
+        self.containers = FakeContainers(self)
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient
@@ -0,0 +1,126 @@
+import json
+import threading
+from argparse import Namespace
+
+import tomlkit
+
+from torch_kaitian import config
+from torch_kaitian.cli import cluster, redis
+
+NODES = """
+[[node]]
+host = "127.0.0.1"
+devices = ["cuda:0"]
+
+[[node]]
+host = "127.0.0.2"
+devices = ["cuda:1"]
+"""
+
+CONFIG = """
+[devices.cuda.cuda0]
+device_number = "cuda:0"
+compute_capability = 10.0
+bus_id = "00000000:3B:00.0"
+
+[devices.cuda.cuda1]
+device_number = "cuda:1"
+compute_capability = 5.0
+bus_id = "00000000:AF:00.0"
+"""
+
+
+# The redis commands of a cluster run, shared by all nodes of the machine.
+class FakeRedis:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.sets = {}
+        self.values = {}
+
+    def ping(self):
+        return True
+
+    def hset(self, name, mapping):
+        with self.lock:
+            self.hashes.setdefault(name, {}).update(mapping)
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self.hashes.get(name, {}))
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def sadd(self, name, value):
+        with self.lock:
+            self.sets.setdefault(name, set()).add(str(value))
+
+    def scard(self, name):
+        with self.lock:
+            return len(self.sets.get(name, set()))
+
+
+def test_loopback_nodes(tmp_path, monkeypatch, fake_client):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, "CONFIG_DIR", tmp_path)
+    monkeypatch.setenv("KAITIAN_PINNING", "0")
+    fake_redis = FakeRedis()
+
+    def connect(host, port):
+        redis.redis_client = fake_redis
+        return fake_redis
+
+    monkeypatch.setattr(redis, "connect", connect)
+    script = tmp_path / "train.py"
+    script.write_text("")
+    nodes_data = tomlkit.loads(NODES)
+    config_data = tomlkit.loads(CONFIG)
+    client = fake_client(
+        output={
+            "kaitian_node0_cuda": b"node 0 done\n",
+            "kaitian_node1_cuda": b"node 1 done\n",
+        }
+    )
+
+    def run(node_rank: int):
+        args = Namespace(
+            command="run",
+            file=str(script),
+            develop=[],
+            node_rank=node_rank,
+            metrics_port=0,
+            quiet=True,
+        )
+        cluster.run_node(args, [], config_data, nodes_data, client)
+
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in (0, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not any(thread.is_alive() for thread in threads)
+
+    assert fake_redis.sets["kaitian_nodes_finished"] == {"0", "1"}
+    specs = {container.name: container.spec for container in client.containers.created}
+    assert sorted(specs) == [
+        cluster.REDIS_NAME,
+        "kaitian_node0_cuda",
+        "kaitian_node1_cuda",
+    ]
+    for node_rank in (0, 1):
+        snapshot = cluster.snapshot_file(node_rank)
+        spec = specs[cluster.container_name(node_rank, "cuda")]
+        assert (
+            f"{snapshot}:{config.CONTAINER_CAPABILITY_SNAPSHOT_FILE}:ro"
+            in spec["volumes"]
+        )
+        assert spec["environment"]["KAITIAN_GLOO_RANK"] == node_rank
+        assert json.loads(snapshot.read_text())["compute_capability"] == {
+            "0": "10.0",
+            "1": "5.0",
+        }
+        log = tmp_path / f"{cluster.log_prefix(node_rank)}_cuda.txt"
+        assert log.read_text() == f"node {node_rank} done\n"
+    assert not (tmp_path / "capability_node0.tmp").exists()
+    assert not client.containers.list(all=True)
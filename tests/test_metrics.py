@@ -0,0 +1,27 @@
+from torch_kaitian.cli import metrics, redis
+
+RANK_DEVICES = ["cuda:0", "mlu:0"]
+
+
+def pushed(batch_size: int) -> dict:
+    return dict(samples=0, batches=0, batch_size=batch_size, time=0.0, collectives={})
+
+
+def render(monkeypatch, capabilities: dict, pushed_metrics: dict) -> list[str]:
+    monkeypatch.setattr(redis, "get_registered_capabilities", lambda: capabilities)
+    monkeypatch.setattr(redis, "get_metrics", lambda: pushed_metrics)
+    return metrics.render([], RANK_DEVICES, None).splitlines()
+
+
+def test_batch_share_follows_pushed_batch_size(monkeypatch):
+    # the registry still holds the capabilities from before a rebalance
+    lines = render(monkeypatch, {0: 5.0, 1: 5.0}, {0: pushed(96), 1: pushed(32)})
+    assert 'kaitian_batch_share{rank="0",device="cuda:0"} 0.75' in lines
+    assert 'kaitian_batch_share{rank="1",device="mlu:0"} 0.25' in lines
+    assert 'kaitian_compute_capability{rank="0",device="cuda:0"} 5.0' in lines
+
+
+def test_batch_share_waits_for_every_rank(monkeypatch):
+    lines = render(monkeypatch, {0: 5.0, 1: 5.0}, {0: pushed(96)})
+    assert not any(line.startswith("kaitian_batch_share{") for line in lines)
+    assert 'kaitian_batch_size{rank="0",device="cuda:0"} 96.0' in lines
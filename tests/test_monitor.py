@@ -0,0 +1,95 @@
+import csv
+import math
+from pathlib import Path
+
+import numpy as np
+
+from torch_kaitian.cli import monitor
+
+FIXTURES = Path(__file__).parent / "fixtures" / "monitor"
+
+
+def parse_fixture(parser, name: str) -> dict[int, dict[str, float]]:
+    return monitor.parse_recorded(parser, (FIXTURES / name).read_text())
+
+
+def test_nvidia_smi_query():
+    updates = parse_fixture(monitor.NvidiaSmiQueryParser(), "nvidia-smi-query.txt")
+    assert updates[0] == {"utilization": 87.0, "memory_used": 10240.0}
+    assert updates[1] == {"utilization": 0.0, "memory_used": 3.0}
+    assert math.isnan(updates[2]["utilization"])
+    assert updates[2]["memory_used"] == 512.0
+
+
+def test_nvidia_smi_dmon_skips_headers():
+    updates = parse_fixture(monitor.NvidiaSmiDmonParser(), "nvidia-smi-dmon.txt")
+    assert sorted(updates) == [0, 1]
+    assert updates[0] == {"pcie_rx": 1203.0, "pcie_tx": 35.0}
+    assert math.isnan(updates[1]["pcie_rx"]) and math.isnan(updates[1]["pcie_tx"])
+
+
+def test_cnmon_pairs_memory_with_card():
+    updates = parse_fixture(monitor.CnmonParser(), "cnmon.txt")
+    assert updates == {
+        0: {"utilization": 35.0, "memory_used": 5120.0},
+        1: {"utilization": 0.0, "memory_used": 0.0},
+    }
+
+
+def test_latest_drops_stale_fields(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(monitor.time, "monotonic", lambda: now[0])
+    latest = monitor.Latest(["cuda:0", "cuda:1"], stale_seconds=5.0)
+    latest.update("cuda", {0: {"utilization": 50.0}, 1: {"utilization": 20.0}})
+    now[0] = 103.0
+    latest.update("cuda", {1: {"utilization": 30.0}})
+    # unknown devices are ignored
+    latest.update("mlu", {0: {"utilization": 99.0}})
+    utilization = monitor.FIELDS.index("utilization")
+    assert latest.copy()[:, utilization].tolist() == [50.0, 30.0]
+    now[0] = 106.0
+    values = latest.copy()
+    assert math.isnan(values[0, utilization])
+    assert values[1, utilization] == 30.0
+    assert np.all(np.isnan(values[:, monitor.FIELDS.index("memory_used")]))
+
+
+def test_csv_round_trip(tmp_path):
+    devices = ["cuda:0", "mlu:0"]
+    path = str(tmp_path / "monitor.csv")
+    with open(path, "w", newline="") as file:
+        csv.writer(file).writerow(["time", "device", *monitor.FIELDS])
+    ring = monitor.RingBuffer(2, len(devices))
+    for step in range(3):
+        values = np.full((len(devices), len(monitor.FIELDS)), np.nan)
+        values[:, 0] = [step, 10 * step]
+        ring.append(1000.0 + step, values)
+        monitor.write_csv(path, devices, *ring.since(ring.count - 1))
+    times, values = monitor.read_csv(path, devices, 100)
+    # the file keeps the sample the ring has overwritten
+    assert times.tolist() == [1000.0, 1001.0, 1002.0]
+    assert values[:, :, 0].tolist() == [[0.0, 0.0], [1.0, 10.0], [2.0, 20.0]]
+    assert np.all(np.isnan(values[:, :, 1:]))
+
+
+def test_read_csv_averages_into_bins(tmp_path):
+    devices = ["cuda:0"]
+    path = str(tmp_path / "monitor.csv")
+    with open(path, "w", newline="") as file:
+        csv.writer(file).writerow(["time", "device", *monitor.FIELDS])
+    values = np.full((1000, 1, len(monitor.FIELDS)), np.nan)
+    values[:, 0, 0] = np.arange(1000) % 10
+    # missing values do not count towards the averages
+    values[::10, 0, 1] = 100.0
+    monitor.write_csv(path, devices, 2000.0 + np.arange(1000), values)
+    times, binned = monitor.read_csv(path, devices, 4)
+    assert binned.shape == (4, 1, len(monitor.FIELDS))
+    assert np.allclose(binned[:, 0, 0], 4.5, atol=0.1)
+    assert binned[:, 0, 1].tolist() == [100.0] * 4
+    assert np.all(np.isnan(binned[:, 0, 2:]))
+    assert times[0] < times[1] < times[2] < times[3]
+    empty = str(tmp_path / "empty.csv")
+    with open(empty, "w", newline="") as file:
+        csv.writer(file).writerow(["time", "device", *monitor.FIELDS])
+    times, binned = monitor.read_csv(empty, devices, 4)
+    assert times.shape == (0,) and binned.shape == (0, 1, len(monitor.FIELDS))
@@ -0,0 +1,88 @@
+import pytest
+
+from torch_kaitian import distributed, rebalance, redis
+
+
+# The redis side of two ranks. The other rank has already published the step
+# times it is given, rank 0 publishes its own through the rebalancer.
+@pytest.fixture
+def ranks(monkeypatch):
+    state = {"capabilities": {}, "step_times": {}, "deleted": []}
+
+    def publish_step_time(epoch, global_rank, num_samples, seconds):
+        state["step_times"].setdefault(epoch, {})[global_rank] = (num_samples, seconds)
+
+    monkeypatch.setattr(distributed, "global_rank", lambda: 0)
+    monkeypatch.setattr(distributed, "global_world_size", lambda: 2)
+    monkeypatch.setattr(redis, "publish_step_time", publish_step_time)
+    monkeypatch.setattr(
+        redis, "get_step_times", lambda epoch: dict(state["step_times"][epoch])
+    )
+    monkeypatch.setattr(redis, "delete_step_times", state["deleted"].append)
+    monkeypatch.setattr(
+        redis, "get_compute_capability", lambda rank: state["capabilities"][rank]
+    )
+    monkeypatch.setattr(
+        redis,
+        "set_compute_capability",
+        lambda rank, capability: state["capabilities"].__setitem__(rank, capability),
+    )
+    return state
+
+
+def run_epoch(ranks, rebalancer, epoch, mine, other):
+    ranks["step_times"][epoch] = {1: other}
+    rebalancer.record(*mine)
+    rebalancer.rebalance(epoch)
+    return [ranks["capabilities"][rank] for rank in range(2)]
+
+
+def test_damping_moves_part_of_the_way(ranks):
+    ranks["capabilities"].update({0: 10.0, 1: 10.0})
+    rebalancer = rebalance.Rebalancer(damping=0.5)
+    # rank 1 takes twice as long for the same samples
+    assert run_epoch(ranks, rebalancer, 0, (100, 1.0), (100, 2.0)) == [10.0, 7.5]
+    rebalancer = rebalance.Rebalancer(damping=1.0)
+    ranks["capabilities"].update({0: 10.0, 1: 10.0})
+    assert run_epoch(ranks, rebalancer, 1, (100, 1.0), (100, 2.0)) == [10.0, 5.0]
+
+
+def test_rescales_to_max_compute_capability(ranks):
+    ranks["capabilities"].update({0: 4.0, 1: 2.0})
+    rebalancer = rebalance.Rebalancer(damping=0.5)
+    # targets 10 and 2.5, damped to 7 and 2.25, scaled by 10 / 7
+    assert run_epoch(ranks, rebalancer, 0, (100, 1.0), (50, 2.0)) == [10.0, 3.2]
+
+
+def test_floor_of_a_tenth(ranks):
+    ranks["capabilities"].update({0: 10.0, 1: 10.0})
+    rebalancer = rebalance.Rebalancer(damping=1.0)
+    assert run_epoch(ranks, rebalancer, 0, (1000, 1.0), (1, 100.0)) == [10.0, 0.1]
+
+
+def test_skips_within_tolerance(ranks):
+    ranks["capabilities"].update({0: 10.0, 1: 6.0})
+    rebalancer = rebalance.Rebalancer(tolerance=0.05)
+    assert run_epoch(ranks, rebalancer, 0, (100, 1.0), (60, 1.04)) == [10.0, 6.0]
+
+
+def test_skips_without_samples_and_drops_consumed_epochs(ranks):
+    ranks["capabilities"].update({0: 10.0, 1: 10.0})
+    rebalancer = rebalance.Rebalancer()
+    assert run_epoch(ranks, rebalancer, 0, (100, 1.0), (0, 0.0)) == [10.0, 10.0]
+    assert ranks["deleted"] == []
+    assert run_epoch(ranks, rebalancer, 1, (100, 1.0), (100, 2.0)) == [10.0, 7.5]
+    assert ranks["deleted"] == [0]
+
+
+def test_step_leaves_out_the_gloo_hop(ranks, monkeypatch):
+    clock = iter([10.0, 12.0])
+    inter_us = iter([5_000_000, 6_500_000])
+    monkeypatch.setattr(rebalance, "synchronize", lambda: None)
+    monkeypatch.setattr(rebalance.time, "perf_counter", lambda: next(clock))
+    monkeypatch.setattr(rebalance, "_inter_us", lambda: next(inter_us))
+    rebalancer = rebalance.Rebalancer()
+    with rebalancer.step(32):
+        pass
+    assert rebalancer.num_samples == 32
+    assert rebalancer.seconds == pytest.approx(0.5)
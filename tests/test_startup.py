@@ -0,0 +1,75 @@
+import pytest
+import redis
+
+from torch_kaitian.cli import startup
+
+
+def specs(*names: str) -> dict[str, dict]:
+    return {name: dict(name=f"kaitian_{name}", image="image") for name in names}
+
+
+def test_start_containers_waits_for_every_probe(fake_client):
+    client = fake_client(
+        states={
+            "kaitian_cuda": [{"Status": "created"}, {"Status": "running"}],
+            "kaitian_mlu": [
+                {"Status": "running", "Health": {"Status": "starting"}},
+                {"Status": "running", "Health": {"Status": "healthy"}},
+            ],
+        }
+    )
+    answers = [redis.exceptions.ConnectionError(), False, True]
+
+    def ping():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    timeline = startup.Timeline()
+    containers = startup.start_containers(
+        client,
+        specs("redis", "cuda", "mlu"),
+        {"redis": startup.redis_probe(ping)},
+        timeline,
+        timeout=5.0,
+    )
+    assert sorted(containers) == ["cuda", "mlu", "redis"]
+    assert containers["mlu"].attrs["State"]["Health"]["Status"] == "healthy"
+    assert answers == []
+    for name in containers:
+        events = [
+            event for _, event_name, event in timeline.events if event_name == name
+        ]
+        assert events == ["create", "started", "ready"]
+
+
+def test_start_containers_accepts_finished_scripts(fake_client):
+    client = fake_client(states={"kaitian_cuda": [{"Status": "exited", "ExitCode": 0}]})
+    containers = startup.start_containers(
+        client, specs("cuda"), {}, startup.Timeline(), timeout=5.0
+    )
+    assert containers["cuda"].status == "exited"
+
+
+def test_start_containers_reports_crashes_with_logs(fake_client):
+    client = fake_client(
+        states={
+            "kaitian_cuda": [{"Status": "exited", "ExitCode": 1}],
+            "kaitian_mlu": [{"Status": "created"}],
+        },
+        output={"kaitian_cuda": b"Traceback: no GPU"},
+    )
+    with pytest.raises(startup.StartupError) as error:
+        startup.start_containers(
+            client, specs("cuda", "mlu"), {}, startup.Timeline(), timeout=0.3
+        )
+    message = str(error.value)
+    assert "kaitian_cuda exited with 1" in message
+    assert "Traceback: no GPU" in message
+    assert "kaitian_mlu not ready after 0.3s" in message
+
+
+def test_wait_ping_gives_up():
+    with pytest.raises(startup.StartupError, match="does not answer PING"):
+        startup.wait_ping(lambda: False, "redis", 0.2)
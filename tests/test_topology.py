@@ -0,0 +1,74 @@
+from pathlib import Path
+
+from torch_kaitian.cli import topology
+
+# Two NUMA nodes with four cores each, cpu N and N + 8 are hyperthreads of
+# one core. 0000:3b:00.0 and 0000:3c:00.0 sit on node 0, 0000:af:00.0 on
+# node 1, and 0000:4f:00.0 reports no node.
+SYSFS = Path(__file__).parent / "fixtures" / "sys"
+
+
+def test_numa_node():
+    # nvidia-smi spelling of the bus ID
+    assert topology.numa_node("00000000:3B:00.0", SYSFS) == 0
+    assert topology.numa_node("0000:af:00.0", SYSFS) == 1
+    assert topology.numa_node("0000:4f:00.0", SYSFS) is None
+    assert topology.numa_node("0000:5e:00.0", SYSFS) is None
+    assert topology.numa_node("N/A", SYSFS) is None
+
+
+def test_cores_groups_hyperthreads():
+    cpus = topology.node_cpus(1, SYSFS)
+    assert cpus == [4, 5, 6, 7, 12, 13, 14, 15]
+    assert topology.cores(cpus, SYSFS) == [[4, 12], [5, 13], [6, 14], [7, 15]]
+    # without topology information every CPU is a core
+    assert topology.cores([0, 1], SYSFS / "missing") == [[0], [1]]
+
+
+def test_split_largest_remainder():
+    cpu_cores = [[cpu] for cpu in range(5)]
+    assert topology.split(cpu_cores, {"cuda": 2, "mlu": 1}) == {
+        "cuda": [0, 1, 2],
+        "mlu": [3, 4],
+    }
+    assert topology.split(cpu_cores[:1], {"cuda": 1, "mlu": 1}) == {
+        "cuda": [0],
+        "mlu": [],
+    }
+
+
+def test_plan_pinning_per_numa_node():
+    pinning = topology.plan_pinning(
+        {"cuda": ["00000000:3B:00.0"], "mlu": ["0000:af:00.0"]}, SYSFS
+    )
+    assert pinning == {
+        "cuda": {"cpuset_cpus": "0-3,8-11", "cpuset_mems": "0", "num_workers": 7},
+        "mlu": {"cpuset_cpus": "4-7,12-15", "cpuset_mems": "1", "num_workers": 7},
+    }
+
+
+def test_plan_pinning_shares_a_node():
+    pinning = topology.plan_pinning(
+        {"cuda": ["0000:3b:00.0", "0000:3c:00.0"], "mlu": ["0000:af:00.0"]}, SYSFS
+    )
+    assert pinning["cuda"] == {
+        "cpuset_cpus": "0-3,8-11",
+        "cpuset_mems": "0",
+        "num_workers": 3,
+    }
+    pinning = topology.plan_pinning(
+        {"cuda": ["0000:3b:00.0"], "mlu": ["0000:3c:00.0"]}, SYSFS
+    )
+    assert pinning["cuda"]["cpuset_cpus"] == "0-1,8-9"
+    assert pinning["mlu"]["cpuset_cpus"] == "2-3,10-11"
+    assert pinning["mlu"]["num_workers"] == 3
+
+
+def test_plan_pinning_without_numa_information():
+    pinning = topology.plan_pinning(
+        {"cuda": ["0000:3b:00.0"], "mlu": ["0000:4f:00.0"]}, SYSFS
+    )
+    assert pinning == {
+        "cuda": {"cpuset_cpus": "0-3,8-11", "cpuset_mems": None, "num_workers": 7},
+        "mlu": {"cpuset_cpus": "4-7,12-15", "cpuset_mems": None, "num_workers": 7},
+    }
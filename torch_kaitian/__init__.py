@@ -2,6 +2,9 @@ import os
 
 import torch
 
+from .compression import CompressionState, compression_hook
+from .telemetry import export_chrome_trace, get_telemetry, reset_telemetry
+
 device_type = os.environ.get("DEVICE", None)
 if device_type:
     from . import _C
@@ -10,6 +13,8 @@ if device_type:
         import torch_mlu
     elif device_type == "CUDA":
         pass
+    elif device_type == "CPU":
+        pass
 
 
 def device():
@@ -19,25 +24,61 @@ def device():
 def set_device(rank: int):
     if device_type == "MLU":
         torch.mlu.set_device(rank)
-    else:
+    elif device_type != "CPU":
         torch.cuda.set_device(rank)
 
 
 def local_device_count():
     if device_type == "MLU":
         return torch.mlu.device_count()
+    elif device_type == "CPU":
+        # number of processes the CPU group should be split into
+        return int(os.environ.get("KAITIAN_CPU_DEVICES", 1))
     else:
         return torch.cuda.device_count()
 
 
+# DataLoader workers per rank recommended by the launcher for the CPUs the
+# container is pinned to, default outside of 'kaitian run'.
+def num_workers(default: int = 2) -> int:
+    return int(os.environ.get("KAITIAN_NUM_WORKERS", default))
+
+
+def synchronize():
+    if device_type == "MLU":
+        torch.mlu.synchronize()
+    elif device_type != "CPU":
+        torch.cuda.synchronize()
+
+
 def manual_seed(seed):
     torch.manual_seed(seed)
     if device_type == "MLU":
         torch.mlu.manual_seed(seed)
-    else:
+    elif device_type != "CPU":
         torch.cuda.manual_seed(seed)
         torch.backends.cudnn.deterministic = True
 
 
 def time_spend():
     _C.time_spend()
+
+
+def set_chunk_size(nbytes: int):
+    _C.set_chunk_size(nbytes)
+
+
+def get_chunk_size() -> int:
+    return _C.get_chunk_size()
+
+
+# Compress the payload exchanged between device types: "none", "fp16", "bf16",
+# "int8" (per-chunk scale) or "topk". All device types must use the same mode.
+# Only the gradient buckets of a DDP model with compression_hook registered
+# are compressed.
+def set_compression(mode: str, topk_ratio: float = 0.01, int8_chunk: int = 4096):
+    _C.set_compression(mode, topk_ratio, int8_chunk)
+
+
+def get_compression() -> str:
+    return _C.get_compression()
@@ -1,3 +1,4 @@
+import json
 import os
 
 import docker
@@ -7,13 +8,14 @@ from ..config import CUDA_IMAGE, MLU_IMAGE
 root = os.path.dirname(os.path.abspath(__file__))
 
 
-def run_benchmark_inner(device: str) -> float:
+# Benchmarks all given devices of one type in a single container, every device
+# in its own process at the same time. Returns the seconds of every timed
+# repetition by device number, e.g. {"cuda:0": [1.21, 1.19, ...]}.
+def run_benchmark_inner(
+    device_type: str, device_indices: list[str], repetitions: int, warmup: int
+) -> dict[str, list[float]]:
     client = docker.from_env()
-    parts = device.split(":")
-    device_type = parts[0]
-    device_index = parts[1]
-    print(f"[KaiTian][Info] {device_type} {device_index}: ", end="", flush=True)
-    name = f"kaitian_benchmark_{device.replace(':', '_')}"
+    name = f"kaitian_benchmark_{device_type}"
     try:
         container = client.containers.get(name)
         container.remove(force=True)
@@ -21,37 +23,50 @@ def run_benchmark_inner(device: str) -> float:
         pass
     device_requests = None
     devices = None
+    environment = {}
     match device_type:
         case "cuda":
             device_requests = [
                 docker.types.DeviceRequest(
-                    device_ids=[device_index], capabilities=[["gpu"]]
+                    device_ids=device_indices, capabilities=[["gpu"]]
                 )
             ]
             image = CUDA_IMAGE
-            volumes = [f"{root}/cuda.py:/cuda.py"]
-            command = ["python", "/cuda.py"]
+            # number the visible GPUs like nvidia-smi and the device ids above,
+            # not fastest first
+            environment["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
         case "mlu":
             # Compatible with MLU370
-            devices = [
-                "/dev/cambricon_ctl",
-                f"/dev/cambricon_dev{device_index}",
-                f"/dev/cambricon_ipcm{device_index}",
-            ]
+            devices = ["/dev/cambricon_ctl"]
+            for device_index in device_indices:
+                devices.append(f"/dev/cambricon_dev{device_index}")
+                devices.append(f"/dev/cambricon_ipcm{device_index}")
             image = MLU_IMAGE
-            volumes = [f"{root}/mlu.py:/mlu.py"]
-            command = ["python", "/mlu.py"]
     container_output = client.containers.run(
         name=name,
         remove=True,
         device_requests=device_requests,
         devices=devices,
+        environment=environment,
         shm_size="16G",
-        volumes=volumes,
-        working_dir="/",
+        volumes=[f"{root}:/benchmark:ro"],
+        working_dir="/benchmark",
         image=image,
-        command=command,
+        command=[
+            "python",
+            f"/benchmark/{device_type}.py",
+            "--devices",
+            str(len(device_indices)),
+            "--repetitions",
+            str(repetitions),
+            "--warmup",
+            str(warmup),
+        ],
     )
     output_lines = container_output.decode("utf-8").splitlines()
-    print(f"{output_lines[-1]} seconds", flush=True)
-    return float(output_lines[-1])
+    # the container numbers the visible devices from 0 in the given order
+    results = json.loads(output_lines[-1])
+    return {
+        f"{device_type}:{device_index}": results[str(local_index)]
+        for local_index, device_index in enumerate(device_indices)
+    }
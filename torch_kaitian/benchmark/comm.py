@@ -0,0 +1,75 @@
+import json
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+import torch_kaitian
+
+# Worker of 'kaitian bench-comm', one process per rank of a CPU group. The
+# launcher passes the sweep in KAITIAN_BENCH_CONFIG, global rank 0 appends one
+# JSON line per measurement to the file in KAITIAN_BENCH_OUTPUT.
+
+
+def bus_bandwidth_factor(op: str, world_size: int) -> float:
+    # same convention as nccl-tests
+    if op == "allreduce":
+        return 2 * (world_size - 1) / world_size
+    return 1.0
+
+
+def measure(op: str, tensor: torch.Tensor, iterations: int) -> float:
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        if op == "allreduce":
+            dist.all_reduce(tensor)
+        else:
+            dist.broadcast(tensor, src=0)
+    dist.barrier()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    bench_config = json.loads(os.environ["KAITIAN_BENCH_CONFIG"])
+    dist.init_process_group("kaitian")
+    global_rank = int(os.environ["KAITIAN_GLOBAL_RANK_START"]) + dist.get_rank()
+    world_size = int(os.environ["KAITIAN_GLOBAL_WORLD_SIZE"])
+    results = []
+    for op in bench_config["ops"]:
+        for dtype_name in bench_config["dtypes"]:
+            dtype = getattr(torch, dtype_name)
+            element_size = torch.empty(0, dtype=dtype).element_size()
+            for size in bench_config["sizes"]:
+                tensor = torch.ones(max(1, size // element_size), dtype=dtype)
+                if bench_config["warmup"] > 0:
+                    measure(op, tensor, bench_config["warmup"])
+                seconds = measure(op, tensor, bench_config["iterations"])
+                nbytes = tensor.numel() * element_size
+                algbw = nbytes / seconds / 1e9
+                results.append(
+                    {
+                        "op": op,
+                        "dtype": dtype_name,
+                        "bytes": nbytes,
+                        "groups": int(os.environ["KAITIAN_GLOO_WORLD_SIZE"]),
+                        "ranks_per_group": dist.get_world_size(),
+                        "world_size": world_size,
+                        "iterations": bench_config["iterations"],
+                        "latency_us": seconds * 1e6,
+                        "algbw_gbps": algbw,
+                        "busbw_gbps": algbw * bus_bandwidth_factor(op, world_size),
+                    }
+                )
+    if global_rank == 0:
+        with open(os.environ["KAITIAN_BENCH_OUTPUT"], "a") as file:
+            for result in results:
+                file.write(json.dumps(result) + "\n")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    if torch_kaitian.device_type != "CPU":
+        exit("[KaiTian][Error] The communication benchmark requires DEVICE=CPU.")
+    main()
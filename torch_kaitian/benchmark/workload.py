@@ -0,0 +1,99 @@
+import argparse
+import json
+import multiprocessing
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+torch.set_default_dtype(torch.float32)
+
+# Shared by cuda.py and mlu.py. Trains a small denoising CNN on synthetic data
+# that is generated on the device, so the timing only covers the training
+# steps. Every visible device runs in its own process at the same time, and
+# the last stdout line is a JSON object mapping the device index to the
+# seconds of every timed repetition.
+
+NUM_SAMPLES = 5000
+BATCH_SIZE = 300
+IMAGE_SIZE = 128
+SQUARE_SIZE = 32
+
+
+class DenoiseCNN(nn.Module):
+    def __init__(self):
+        super(DenoiseCNN, self).__init__()
+        self.conv1 = nn.Conv2d(1, 32, kernel_size=3, padding=1)
+        self.conv2 = nn.Conv2d(32, 32, kernel_size=3, padding=1)
+        self.conv3 = nn.Conv2d(32, 1, kernel_size=3, padding=1)
+        self.relu = nn.ReLU()
+
+    def forward(self, x):
+        x = self.relu(self.conv1(x))
+        x = self.relu(self.conv2(x))
+        x = self.conv3(x)
+        return x
+
+
+# noisy images of one bright square each, and the clean squares as targets
+def generate_data(num_samples: int, device: str):
+    limit = IMAGE_SIZE - SQUARE_SIZE
+    xs = torch.randint(0, limit, (num_samples, 1), device=device)
+    ys = torch.randint(0, limit, (num_samples, 1), device=device)
+    pixels = torch.arange(IMAGE_SIZE, device=device)
+    rows = (pixels >= xs) & (pixels < xs + SQUARE_SIZE)
+    cols = (pixels >= ys) & (pixels < ys + SQUARE_SIZE)
+    targets = (rows[:, :, None] & cols[:, None, :]).float().unsqueeze(1)
+    images = torch.clamp(targets + torch.randn_like(targets) * 0.1, 0, 1)
+    return images, targets
+
+
+def run_device(device_type: str, index: int, repetitions: int, warmup: int, steps: int):
+    if device_type == "mlu":
+        import torch_mlu  # noqa: F401
+    device = f"{device_type}:{index}"
+    getattr(torch, device_type).set_device(index)
+    images, targets = generate_data(NUM_SAMPLES, device)
+    model = DenoiseCNN().to(device)
+    optimizer = optim.Adam(model.parameters())
+    criterion = nn.MSELoss()
+    model.train()
+
+    def run_steps():
+        for _ in range(steps):
+            batch = torch.randint(0, NUM_SAMPLES, (BATCH_SIZE,), device=device)
+            optimizer.zero_grad()
+            output = model(images[batch])
+            loss = criterion(output, targets[batch])
+            loss.backward()
+            optimizer.step()
+        getattr(torch, device_type).synchronize()
+
+    for _ in range(warmup):
+        run_steps()
+    times = []
+    for _ in range(repetitions):
+        start_time = time.perf_counter()
+        run_steps()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def main(device_type: str):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, required=True)
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=30)
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.devices) as pool:
+        results = pool.starmap(
+            run_device,
+            [
+                (device_type, index, args.repetitions, args.warmup, args.steps)
+                for index in range(args.devices)
+            ],
+        )
+    print(json.dumps({index: times for index, times in enumerate(results)}))
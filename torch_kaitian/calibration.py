@@ -0,0 +1,53 @@
+import os
+import time
+from typing import Iterator
+
+from . import redis
+
+# Set by 'kaitian calibrate'. The DistributedSampler hands its indices through
+# measure(), which times the batches the training loop consumes and publishes
+# the samples per second of this rank once enough batches were timed. The rank
+# keeps training so that the others never wait for it in a collective, and the
+# launcher stops the containers once every rank has published. It turns the
+# rates into a per-model profile.
+_steps = os.environ.get("KAITIAN_CALIBRATE_STEPS", None)
+_warmup = int(os.environ.get("KAITIAN_CALIBRATE_WARMUP", 5))
+
+# counted across epochs, the last batch of an epoch is never timed because
+# the loop may evaluate or checkpoint before it asks for the next one
+_batches = 0
+_timed = 0
+_samples = 0
+_seconds = 0.0
+
+
+def enabled() -> bool:
+    return _steps is not None
+
+
+def _finish(global_rank: int) -> None:
+    redis.publish_calibration(global_rank, _samples, _seconds)
+    print(
+        f"[KaiTian][Info] Calibrated rank {global_rank}: "
+        f"{_samples / _seconds:.2f} samples/s over {_timed} steps.",
+        flush=True,
+    )
+
+
+def measure(indices: Iterator[int], batch_size: int, global_rank: int) -> Iterator[int]:
+    global _batches, _timed, _samples, _seconds
+    last = None
+    for position, index in enumerate(indices):
+        if position % batch_size == 0:
+            # asking for the first index of a batch means the previous batch
+            # of this epoch has been consumed
+            now = time.perf_counter()
+            if last is not None and _batches > _warmup and _timed < int(_steps):
+                _timed += 1
+                _samples += batch_size
+                _seconds += now - last
+                if _timed == int(_steps):
+                    _finish(global_rank)
+            _batches += 1
+            last = now
+        yield index
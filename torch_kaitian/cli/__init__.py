@@ -1,8 +1,18 @@
 import argparse
 import os
 
+from .. import config
+from .bench_comm import (
+    DEFAULT_DTYPES,
+    DEFAULT_GROUPS,
+    DEFAULT_OPS,
+    DEFAULT_RANKS_PER_GROUP,
+    DEFAULT_SIZES,
+    bench_comm,
+)
+from .cluster import cluster_kaitian
 from .init import init_kaitian
-from .run import run_kaitian
+from .run import pool_kaitian, run_kaitian
 
 
 class CustomHelpFormatter(argparse.HelpFormatter):
@@ -32,6 +42,18 @@ def main():
         action="store_true",
         help="Reinitialization KaiTian environment",
     )
+    parser_init.add_argument(
+        "--repetitions",
+        type=int,
+        default=5,
+        help="Timed benchmark runs per device",
+    )
+    parser_init.add_argument(
+        "--warmup",
+        type=int,
+        default=1,
+        help="Untimed benchmark runs per device",
+    )
     parser_run = subparsers.add_parser("run", help="Run the training code")
     parser_run.add_argument(
         "-f",
@@ -46,18 +68,139 @@ def main():
         help="Enable quiet mode, less output is printed",
     )
     parser_run.add_argument(
-        "-d", "--develop", action="append", help="Set development mode arguments"
+        "-d",
+        "--develop",
+        action="append",
+        default=[],
+        help="Set development mode arguments",
+    )
+    parser_run.add_argument(
+        "--metrics-port",
+        type=int,
+        default=config.METRICS_PORT,
+        help="Port of the local Prometheus endpoint, 0 disables it",
+    )
+    parser_run.add_argument(
+        "--pool",
+        action="store_true",
+        help="Run in the containers of 'kaitian pool up'",
+    )
+    parser_run.add_argument(
+        "--nodes",
+        default=None,
+        help="Nodes file of a multi-node run, see 'Multi-node' in the README",
+    )
+    parser_run.add_argument(
+        "--node-rank",
+        type=int,
+        default=None,
+        help="Index of this node in the nodes file",
+    )
+    parser_calibrate = subparsers.add_parser(
+        "calibrate", help="Measure the compute capabilities with your model"
+    )
+    parser_calibrate.add_argument(
+        "-f",
+        "--file",
+        required=True,
+        help="Your training code",
+    )
+    parser_calibrate.add_argument(
+        "--steps", type=int, default=20, help="Timed training steps per device"
+    )
+    parser_calibrate.add_argument(
+        "--warmup", type=int, default=5, help="Untimed training steps per device"
+    )
+    parser_calibrate.add_argument(
+        "--pool",
+        action="store_true",
+        help="Run in the containers of 'kaitian pool up'",
+    )
+    parser_calibrate.set_defaults(develop=[], metrics_port=0, quiet=False)
+    parser_pool = subparsers.add_parser(
+        "pool", help="Manage the warm containers used by 'run --pool'"
+    )
+    parser_pool.add_argument("action", choices=["up", "status", "down"])
+    parser_pool.add_argument(
+        "-w",
+        "--workspace",
+        default=".",
+        help="Directory mounted at /workspace, must contain the training code",
+    )
+    parser_bench_comm = subparsers.add_parser(
+        "bench-comm",
+        help="Benchmark the collectives with the DEVICE=CPU build",
+    )
+    parser_bench_comm.add_argument(
+        "--ops", default=DEFAULT_OPS, help="Comma separated collectives"
+    )
+    parser_bench_comm.add_argument(
+        "--dtypes", default=DEFAULT_DTYPES, help="Comma separated torch dtypes"
+    )
+    parser_bench_comm.add_argument(
+        "--sizes", default=DEFAULT_SIZES, help="Comma separated sizes in bytes"
+    )
+    parser_bench_comm.add_argument(
+        "--groups", default=DEFAULT_GROUPS, help="Comma separated group counts"
+    )
+    parser_bench_comm.add_argument(
+        "--ranks-per-group",
+        default=DEFAULT_RANKS_PER_GROUP,
+        help="Comma separated ranks per group",
+    )
+    parser_bench_comm.add_argument(
+        "--iterations", type=int, default=20, help="Timed iterations per size"
+    )
+    parser_bench_comm.add_argument(
+        "--warmup", type=int, default=5, help="Warmup iterations per size"
+    )
+    parser_bench_comm.add_argument(
+        "--timeout",
+        type=int,
+        default=600,
+        help="Seconds after which a configuration is aborted",
+    )
+    parser_bench_comm.add_argument(
+        "-o", "--output", default=None, help="JSON report path, stdout if unset"
     )
     known_args, unknown_args = parser.parse_known_args()
     if known_args.command == "init":
+        if known_args.repetitions < 1 or known_args.warmup < 0:
+            exit(
+                "[KaiTian][Error] --repetitions must be at least 1 and --warmup "
+                "at least 0."
+            )
         init_kaitian(known_args, unknown_args)
     elif known_args.command == "run":
         # argument check
-        if known_args.develop is None:
+        if not known_args.develop:
             if known_args.file is None:
                 exit(f"[KaiTian][Error] '-f FILE' argument is required.")
             else:
                 file = known_args.file
                 if not os.path.exists(file):
                     exit(f"[KaiTian][Error] {file} not found.")
+        if known_args.nodes is None:
+            run_kaitian(known_args, unknown_args)
+        else:
+            if known_args.node_rank is None:
+                exit(f"[KaiTian][Error] '--node-rank N' is required with --nodes.")
+            if known_args.pool or "wait" in known_args.develop:
+                exit(
+                    f"[KaiTian][Error] --nodes supports neither --pool nor "
+                    "'-d wait'."
+                )
+            cluster_kaitian(known_args, unknown_args)
+    elif known_args.command == "calibrate":
+        if not os.path.exists(known_args.file):
+            exit(f"[KaiTian][Error] {known_args.file} not found.")
         run_kaitian(known_args, unknown_args)
+    elif known_args.command == "pool":
+        pool_kaitian(known_args)
+    elif known_args.command == "bench-comm":
+        if known_args.iterations < 1 or known_args.warmup < 0:
+            exit(
+                "[KaiTian][Error] --iterations must be at least 1 and --warmup "
+                "at least 0."
+            )
+        bench_comm(known_args)
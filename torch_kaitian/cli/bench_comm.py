@@ -0,0 +1,125 @@
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = "4096,65536,1048576,16777216"
+DEFAULT_DTYPES = "float32"
+DEFAULT_OPS = "allreduce,broadcast"
+DEFAULT_GROUPS = "2"
+DEFAULT_RANKS_PER_GROUP = "1,2"
+
+
+def parse_list(value: str, cast=str) -> list:
+    return [cast(item) for item in value.split(",") if item.strip()]
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Starts groups * ranks_per_group local processes of the DEVICE=CPU build.
+# Every group has its own torch.distributed store, the groups meet through a
+# gloo FileStore in a temporary directory.
+def run_config(
+    bench_config: dict, groups: int, ranks_per_group: int, output: str, timeout: int
+):
+    world_size = groups * ranks_per_group
+    with tempfile.TemporaryDirectory(prefix="kaitian_bench_") as workdir:
+        rendezvous = os.path.join(workdir, "rendezvous")
+        os.mkdir(rendezvous)
+        processes = []
+        logs = []
+        for gloo_rank in range(groups):
+            master_port = free_port()
+            for rank in range(ranks_per_group):
+                env = dict(os.environ)
+                env.update(
+                    {
+                        "DEVICE": "CPU",
+                        "MASTER_ADDR": "127.0.0.1",
+                        "MASTER_PORT": str(master_port),
+                        "RANK": str(rank),
+                        "LOCAL_RANK": str(rank),
+                        "WORLD_SIZE": str(ranks_per_group),
+                        "KAITIAN_GLOO_RANK": str(gloo_rank),
+                        "KAITIAN_GLOO_WORLD_SIZE": str(groups),
+                        "KAITIAN_GLOO_LANES": str(ranks_per_group),
+                        "KAITIAN_GLOBAL_RANK_START": str(gloo_rank * ranks_per_group),
+                        "KAITIAN_GLOBAL_WORLD_SIZE": str(world_size),
+                        "KAITIAN_GLOO_FILE_STORE": rendezvous,
+                        "KAITIAN_GLOO_HOSTNAME": "127.0.0.1",
+                        "KAITIAN_BENCH_CONFIG": json.dumps(bench_config),
+                        "KAITIAN_BENCH_OUTPUT": output,
+                    }
+                )
+                logs.append(os.path.join(workdir, f"rank{gloo_rank}_{rank}.log"))
+                with open(logs[-1], "w") as log:
+                    processes.append(
+                        subprocess.Popen(
+                            [sys.executable, "-m", "torch_kaitian.benchmark.comm"],
+                            env=env,
+                            stdout=log,
+                            stderr=subprocess.STDOUT,
+                        )
+                    )
+        # a failed rank leaves its peers blocked, so stop everything
+        deadline = time.monotonic() + timeout
+        failed = None
+        while failed is None and any(p.poll() is None for p in processes):
+            if time.monotonic() > deadline:
+                failed = f"timed out after {timeout} seconds"
+            time.sleep(0.1)
+            for process, log in zip(processes, logs):
+                if process.poll() not in (None, 0):
+                    with open(log) as file:
+                        failed = file.read()
+                    break
+        for process, log in zip(processes, logs):
+            if failed is None and process.poll() not in (None, 0):
+                with open(log) as file:
+                    failed = file.read()
+            process.kill()
+            process.wait()
+        if failed is not None:
+            exit(
+                f"[KaiTian][Error] bench-comm failed with {groups} groups of "
+                f"{ranks_per_group} ranks:\n{failed}"
+            )
+
+
+def bench_comm(args):
+    bench_config = {
+        "ops": parse_list(args.ops),
+        "dtypes": parse_list(args.dtypes),
+        "sizes": parse_list(args.sizes, int),
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+    }
+    for op in bench_config["ops"]:
+        if op not in ("allreduce", "broadcast"):
+            exit(f"[KaiTian][Error] Unsupported op: {op}")
+    results = []
+    for groups, ranks_per_group in itertools.product(
+        parse_list(args.groups, int), parse_list(args.ranks_per_group, int)
+    ):
+        print(
+            f"[KaiTian][Info] {groups} groups x {ranks_per_group} ranks",
+            file=sys.stderr,
+            flush=True,
+        )
+        with tempfile.NamedTemporaryFile("r", suffix=".jsonl") as output:
+            run_config(bench_config, groups, ranks_per_group, output.name, args.timeout)
+            results.extend(json.loads(line) for line in output if line.strip())
+    report = json.dumps({"results": results}, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
@@ -0,0 +1,123 @@
+import datetime
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+from .. import config
+from . import redis
+
+
+# The model is identified by the training script and its arguments, so
+# 'kaitian run' finds the profile of exactly the command that was calibrated.
+def fingerprint(file: str, unknown_args: list[str]) -> str:
+    digest = hashlib.sha256(Path(file).read_bytes())
+    digest.update("\0".join(unknown_args).encode())
+    return digest.hexdigest()[:16]
+
+
+def profile_path(file: str, unknown_args: list[str]) -> Path:
+    return config.PROFILE_DIR / f"{fingerprint(file, unknown_args)}.json"
+
+
+# Turns the samples per second of every rank into compute capabilities, the
+# fastest device gets MAX_COMPUTE_CAPABILITY like in 'kaitian init'.
+def save_profile(
+    args,
+    unknown_args: list[str],
+    rank_devices: list[str],
+    calibration: dict[int, tuple[int, float]],
+):
+    missing = [
+        rank_devices[rank]
+        for rank in range(len(rank_devices))
+        if rank not in calibration
+    ]
+    if missing:
+        exit(
+            f"[KaiTian][Error] No calibration result from {', '.join(missing)}. "
+            f"Is the dataset large enough for {args.warmup + args.steps} steps "
+            f"and does the script use torch_kaitian.distributed.DistributedSampler?"
+        )
+    throughputs = {
+        device: calibration[rank][0] / calibration[rank][1]
+        for rank, device in enumerate(rank_devices)
+    }
+    max_throughput = max(throughputs.values())
+    profile = {
+        "fingerprint": fingerprint(args.file, unknown_args),
+        "file": str(Path(args.file).resolve()),
+        "args": unknown_args,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "steps": args.steps,
+        "warmup": args.warmup,
+        "devices": {
+            device: {
+                "samples_per_second": round(throughput, 2),
+                "compute_capability": max(
+                    round(
+                        throughput / max_throughput * config.MAX_COMPUTE_CAPABILITY,
+                        1,
+                    ),
+                    0.1,
+                ),
+            }
+            for device, throughput in throughputs.items()
+        },
+    }
+    config.PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = profile_path(args.file, unknown_args)
+    with open(path, "w") as file:
+        json.dump(profile, file, indent=2)
+    for device, result in profile["devices"].items():
+        print(
+            f"[KaiTian][Info] {device}: {result['samples_per_second']} samples/s, "
+            f"compute capability {result['compute_capability']}",
+            flush=True,
+        )
+    print(f"[KaiTian][Info] Profile saved to {path}", flush=True)
+
+
+# Calls stop once every rank has published its result, the ranks keep training
+# until then. Returns without stopping when done is set first, e.g. because
+# the script ended before enough steps were timed.
+def stop_when_calibrated(global_world_size: int, stop, done: threading.Event):
+    while not done.wait(0.5):
+        if len(redis.get_calibration()) >= global_world_size:
+            print(
+                "[KaiTian][Info] All ranks calibrated, stopping the script.",
+                flush=True,
+            )
+            stop()
+            return
+
+
+# Replaces the benchmark capabilities with the calibrated ones when a profile
+# of this script covers every selected device. Capabilities are relative, so a
+# partial profile cannot be mixed with the benchmark values.
+def apply_profile(
+    args,
+    unknown_args: list[str],
+    rank_devices: list[str],
+    capabilities: dict[int, float],
+) -> dict[int, float]:
+    if args.file is None:
+        return capabilities
+    path = profile_path(args.file, unknown_args)
+    if not path.is_file():
+        return capabilities
+    with open(path, "r") as file:
+        devices = json.load(file)["devices"]
+    missing = [device for device in rank_devices if device not in devices]
+    if missing:
+        print(
+            f"[KaiTian][Warning] Profile {path} does not cover "
+            f"{', '.join(missing)}, using the benchmark capabilities.",
+            flush=True,
+        )
+        return capabilities
+    print(f"[KaiTian][Info] Using calibrated capabilities from {path}", flush=True)
+    return {
+        rank: float(devices[device]["compute_capability"])
+        for rank, device in enumerate(rank_devices)
+    }
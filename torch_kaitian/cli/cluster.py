@@ -0,0 +1,295 @@
+import os
+import time
+import traceback
+from pathlib import Path
+
+import docker
+import tomlkit
+
+from .. import config
+from . import logs, metrics, redis, startup, topology
+from .run import build_image, container_spec
+
+# Multi-node runs. Every node runs 'kaitian run --nodes nodes.toml --node-rank
+# N' with the same nodes file:
+#
+#   redis_port = 6379
+#
+#   [[node]]
+#   host = "192.168.1.10"
+#   devices = ["cuda:0", "cuda:1"]
+#
+#   [[node]]
+#   host = "192.168.1.11"
+#   devices = ["mlu:0", "mlu:1"]
+#   iface = "eth0"
+#
+# Every device type of every node is a group of its own, numbered in the
+# order of the file, and its containers use the host network. Node 0 publishes
+# redis on its host address, which holds the gloo rendezvous and the
+# capability registry of the whole cluster.
+REDIS_NAME = "kaitian_cluster_redis"
+REDIS_PORT = 6379
+# first port of the intra-group stores, one per group
+MASTER_PORT = 12355
+# how long a node waits for the others to come up or to finish
+JOIN_TIMEOUT = 600.0
+FINISH_TIMEOUT = 300.0
+
+
+def container_name(node_rank: int, device_type: str) -> str:
+    return f"kaitian_node{node_rank}_{device_type}"
+
+
+# Nodes on one machine over loopback share the config directory and usually
+# the working directory, so the snapshot and the logs are named by node.
+def snapshot_file(node_rank: int) -> Path:
+    return config.CONFIG_DIR / f"capability_node{node_rank}.json"
+
+
+def log_prefix(node_rank: int) -> str:
+    return f"log_node{node_rank}"
+
+
+def load_nodes(path: str) -> tomlkit.TOMLDocument:
+    if not os.path.isfile(path):
+        exit(f"[KaiTian][Error] {path} not found.")
+    with open(path, "r") as file:
+        nodes_data = tomlkit.loads(file.read())
+    nodes = nodes_data.get("node", [])
+    if len(nodes) == 0:
+        exit(f"[KaiTian][Error] {path} lists no [[node]].")
+    for node_rank, node in enumerate(nodes):
+        if "host" not in node or len(node.get("devices", [])) == 0:
+            exit(
+                f"[KaiTian][Error] Node {node_rank} in {path} needs 'host' and "
+                "'devices'."
+            )
+    return nodes_data
+
+
+# The groups of the whole cluster with their gloo rank and first global rank.
+def plan(nodes: list) -> list[dict]:
+    groups = []
+    global_rank_start = 0
+    for node_rank, node in enumerate(nodes):
+        device_types = sorted(set(device.split(":")[0] for device in node["devices"]))
+        for device_type in device_types:
+            devices = [
+                str(device)
+                for device in node["devices"]
+                if device.split(":")[0] == device_type
+            ]
+            groups.append(
+                dict(
+                    node_rank=node_rank,
+                    device_type=device_type,
+                    devices=devices,
+                    gloo_rank=len(groups),
+                    global_rank_start=global_rank_start,
+                )
+            )
+            global_rank_start += len(devices)
+    return groups
+
+
+def wait_registry(global_world_size: int, timeout: float) -> dict[int, float]:
+    deadline = time.monotonic() + timeout
+    while True:
+        capabilities = redis.get_registered_capabilities()
+        if len(capabilities) == global_world_size:
+            return capabilities
+        if time.monotonic() > deadline:
+            raise startup.StartupError(
+                f"{len(capabilities)} of {global_world_size} ranks registered "
+                f"after {timeout}s"
+            )
+        time.sleep(0.5)
+
+
+# Node 0 reports itself only after the others, when it is done waiting.
+def wait_finished(num_nodes: int, timeout: float):
+    r = redis.get_redis_client()
+    deadline = time.monotonic() + timeout
+    while r.scard("kaitian_nodes_finished") < num_nodes - 1:
+        if time.monotonic() > deadline:
+            print(
+                "[KaiTian][Warning] Not all nodes finished, removing redis anyway.",
+                flush=True,
+            )
+            return
+        time.sleep(0.5)
+
+
+def run_node(
+    args,
+    unknown_args,
+    config_data: tomlkit.TOMLDocument,
+    nodes_data: tomlkit.TOMLDocument,
+    client=None,
+):
+    client = client or docker.from_env()
+    nodes = nodes_data["node"]
+    node = nodes[args.node_rank]
+    redis_host = str(nodes[0]["host"])
+    redis_port = int(nodes_data.get("redis_port", REDIS_PORT))
+    groups = plan(nodes)
+    local_groups = [group for group in groups if group["node_rank"] == args.node_rank]
+    # the same lane rule as on a single node, over all groups of the cluster
+    device_counts = set(len(group["devices"]) for group in groups)
+    gloo_lanes = device_counts.pop() if len(device_counts) == 1 else 1
+    global_world_size = sum(len(group["devices"]) for group in groups)
+    rank_devices = [
+        f"{device}@{nodes[group['node_rank']]['host']}"
+        for group in groups
+        for device in group["devices"]
+    ]
+    containers = {}
+    metrics_server = None
+    timeline = startup.Timeline()
+    r = redis.connect(redis_host, redis_port)
+    try:
+        if args.node_rank == 0:
+            specs = {
+                "redis": dict(
+                    detach=True,
+                    name=REDIS_NAME,
+                    image=config.REDIS_IMAGE,
+                    command="redis-server",
+                    ports={"6379/tcp": (redis_host, redis_port)},
+                )
+            }
+            probes = {"redis": startup.redis_probe(r.ping)}
+            startup.start_containers(client, specs, probes, timeline)
+        else:
+            timeline.record("redis", "wait")
+            startup.wait_ping(r.ping, f"{redis_host}:{redis_port}", JOIN_TIMEOUT)
+            timeline.record("redis", "ready")
+
+        # every node registers its own ranks from its own kaitian.toml
+        capabilities = {}
+        for group in local_groups:
+            capabilities.update(
+                redis.get_capabilities(
+                    config_data, group["global_rank_start"], group["devices"]
+                )
+            )
+        redis.register_capabilities(capabilities)
+        timeline.record("registry", "wait")
+        capabilities = wait_registry(global_world_size, JOIN_TIMEOUT)
+        timeline.record("registry", "complete")
+        if args.node_rank == 0:
+            r.set("compute_capability_version", 1)
+        redis.write_snapshot(capabilities, 1, snapshot_file(args.node_rank))
+
+        specs = {}
+        for group in local_groups:
+            device_type = group["device_type"]
+            spec = container_spec(
+                device_type,
+                [device.split(":")[1] for device in group["devices"]],
+                args,
+                group["gloo_rank"],
+                len(groups),
+                gloo_lanes,
+                global_world_size,
+                group["global_rank_start"],
+                unknown_args,
+                snapshot_file(args.node_rank),
+            )
+            del spec["network"], spec["hostname"]
+            spec["name"] = container_name(args.node_rank, device_type)
+            spec["network_mode"] = "host"
+            spec["environment"].update(
+                KAITIAN_GLOO_HOSTNAME=str(node["host"]),
+                KAITIAN_REDIS_HOST=redis_host,
+                KAITIAN_REDIS_PORT=redis_port,
+                # the groups of a host share its network namespace
+                MASTER_ADDR="127.0.0.1",
+                MASTER_PORT=MASTER_PORT + group["gloo_rank"],
+            )
+            if "iface" in node:
+                spec["environment"]["KAITIAN_GLOO_IFACE"] = str(node["iface"])
+            specs[device_type] = spec
+        topology.apply_pinning(
+            specs,
+            {group["device_type"]: group["devices"] for group in local_groups},
+            config_data,
+        )
+        try:
+            containers = startup.start_containers(client, specs, {}, timeline)
+        finally:
+            if not args.quiet:
+                timeline.print()
+        if args.node_rank == 0 and args.metrics_port:
+            metrics_server = metrics.start_server(
+                args.metrics_port, [], rank_devices, None
+            )
+
+        print("--------- Output -----------", flush=True)
+        logs.stream_logs(
+            {
+                device_type: container.logs(stream=True, follow=True)
+                for device_type, container in containers.items()
+            },
+            args.quiet,
+            log_prefix(args.node_rank),
+        )
+        print("--------- Finish -----------")
+        for device_type in containers:
+            print(
+                f"{device_type.upper()} log: "
+                f"{Path.cwd()}/{log_prefix(args.node_rank)}_{device_type}.txt",
+                flush=True,
+            )
+        if args.node_rank == 0:
+            wait_finished(len(nodes), FINISH_TIMEOUT)
+    except KeyboardInterrupt:
+        print(
+            "\n[KaiTian][Info] Received KeyboardInterrupt. Stop and clean up.",
+            flush=True,
+        )
+    except startup.StartupError as e:
+        print(f"[KaiTian][Error] Startup failed: {e}", flush=True)
+    except Exception as e:
+        print(f"[KaiTian][Error] Unknown error: {e}", flush=True)
+        tb = traceback.format_exc()
+        print(tb)
+    finally:
+        # also after a failure, node 0 would wait for this node until the
+        # timeout otherwise
+        try:
+            r.sadd("kaitian_nodes_finished", args.node_rank)
+        except Exception as e:
+            print(f"[KaiTian][Warning] Unable to report the finish: {e}", flush=True)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        names = [
+            container_name(args.node_rank, group["device_type"])
+            for group in local_groups
+        ]
+        if args.node_rank == 0:
+            names.append(REDIS_NAME)
+        for container in client.containers.list(all=True):
+            if container.attrs["Name"].strip("/") in names:
+                container.remove(force=True)
+
+
+def cluster_kaitian(args, unknown_args):
+    if not os.path.isfile(config.CONFIG_FILE):
+        exit(
+            f"[KaiTian][Error] Unable to find configuration file. Please run 'kaitian init' first."
+        )
+    with open(config.CONFIG_FILE, "r") as file:
+        config_data = tomlkit.loads(file.read())
+    nodes_data = load_nodes(args.nodes)
+    if not 0 <= args.node_rank < len(nodes_data["node"]):
+        exit(
+            f"[KaiTian][Error] --node-rank must be between 0 and "
+            f"{len(nodes_data['node']) - 1}."
+        )
+
+    if "build" in args.develop:
+        build_image(list(nodes_data["node"][args.node_rank]["devices"]))
+
+    run_node(args, unknown_args, config_data, nodes_data)
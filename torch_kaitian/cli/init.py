@@ -1,7 +1,9 @@
 import json
 import os
 import shutil
+import statistics
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import docker
@@ -153,26 +155,53 @@ def pull_images(config_data: tomlkit.TOMLDocument):
         pull_image_inner(image)
 
 
-def run_benchmark(config_data: tomlkit.TOMLDocument):
+def run_benchmark(config_data: tomlkit.TOMLDocument, repetitions: int, warmup: int):
     print("[KaiTian][Info] Running the benchmark for each device")
-    benchmark_result = {}
-    for device_type in config_data["devices"]:
-        for device, detail in config_data["devices"][device_type].items():
-            if isinstance(detail, dict):
-                benchmark_result[device] = benchmark.run_benchmark_inner(
-                    detail["device_number"]
-                )
-    min_time = min(benchmark_result.values())
+    details = {}
+    device_indices = {}
     for device_type in config_data["devices"]:
         for device, detail in config_data["devices"][device_type].items():
             if isinstance(detail, dict):
-                detail["compute_capability"] = round(
-                    min_time / benchmark_result[device] * config.MAX_COMPUTE_CAPABILITY,
-                    1,
+                details[detail["device_number"]] = detail
+                device_indices.setdefault(device_type, []).append(
+                    detail["device_number"].split(":")[1]
                 )
+    # one container per device type, all of them at the same time
+    benchmark_result = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(device_indices))) as executor:
+        futures = [
+            executor.submit(
+                benchmark.run_benchmark_inner, device_type, indices, repetitions, warmup
+            )
+            for device_type, indices in device_indices.items()
+        ]
+        for future in futures:
+            benchmark_result.update(future.result())
+    medians = {
+        device: statistics.median(times) for device, times in benchmark_result.items()
+    }
+    min_time = min(medians.values())
+    for device, times in benchmark_result.items():
+        detail = details[device]
+        capabilities = [
+            min_time / seconds * config.MAX_COMPUTE_CAPABILITY for seconds in times
+        ]
+        detail["compute_capability"] = round(
+            min_time / medians[device] * config.MAX_COMPUTE_CAPABILITY, 1
+        )
+        detail["compute_capability_variance"] = (
+            round(statistics.variance(capabilities), 4) if len(times) > 1 else 0.0
+        )
+        detail["benchmark_seconds"] = round(medians[device], 4)
+        print(
+            f"[KaiTian][Info] {device}: median {medians[device]:.3f} seconds over "
+            f"{len(times)} runs, compute capability {detail['compute_capability']} "
+            f"(variance {detail['compute_capability_variance']})",
+            flush=True,
+        )
 
 
-def create_config() -> tomlkit.TOMLDocument:
+def create_config(repetitions: int, warmup: int) -> tomlkit.TOMLDocument:
     print(f"[KaiTian][Info] Creating configuration file ({config.CONFIG_FILE})")
 
     # 1. create empty config and write creation time
@@ -180,6 +209,12 @@ def create_config() -> tomlkit.TOMLDocument:
     creation_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     config_data.add("create_time", creation_time)
     config_data.add("devices", tomlkit.table())
+    monitor = tomlkit.table()
+    monitor.add("interval_ms", config.MONITOR_INTERVAL_MS)
+    monitor.add("capacity", config.MONITOR_CAPACITY)
+    monitor.add("flush_seconds", config.MONITOR_FLUSH_SECONDS)
+    monitor.add("output", config.MONITOR_OUTPUT)
+    config_data.add("monitor", monitor)
 
     # 2. add device information
     find_devices(config_data)
@@ -188,7 +223,7 @@ def create_config() -> tomlkit.TOMLDocument:
     pull_images(config_data)
 
     # 4. run benchmark for each device
-    run_benchmark(config_data)
+    run_benchmark(config_data, repetitions, warmup)
 
     # 5. done
     return config_data
@@ -200,7 +235,7 @@ def init_kaitian(args, unknown_args):
 
     if not os.path.isfile(config.CONFIG_FILE) or args.refresh:
         # configuration file does not exist or is forcibly overwritten
-        config_data = create_config()
+        config_data = create_config(args.repetitions, args.warmup)
         with open(config.CONFIG_FILE, "w") as file:
             file.write(tomlkit.dumps(config_data))
     else:
@@ -0,0 +1,172 @@
+import asyncio
+import codecs
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import config
+
+# longest partial line kept while waiting for its newline
+MAX_LINE_BYTES = 64 * 1024
+
+
+# Appends to <prefix>_<type>.txt through a userspace buffer that is flushed
+# periodically, and rotates to .1, .2, ... once the file reaches max_bytes.
+class LogFile:
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, "w", buffering=64 * 1024)
+        self.size = 0
+
+    def write(self, line: str):
+        data = line + "\n"
+        if self.max_bytes and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", buffering=64 * 1024)
+        self.size = 0
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Token bucket on the console lines of one container. Lines over the rate are
+# only written to the log file, and how many were held back is printed once
+# the bucket refills.
+class ConsoleLimiter:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+
+class LogStream:
+    def __init__(self, device_type: str, quiet: bool, log_prefix: str):
+        self.device_type = device_type
+        self.quiet = quiet
+        self.log_file = LogFile(
+            f"{log_prefix}_{device_type}.txt", config.LOG_MAX_BYTES, config.LOG_BACKUPS
+        )
+        self.limiter = ConsoleLimiter(
+            config.LOG_CONSOLE_LINES_PER_SECOND, config.LOG_CONSOLE_BURST
+        )
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+
+    def feed(self, chunk: bytes):
+        lines = (self.partial + self.decoder.decode(chunk)).split("\n")
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE_BYTES:
+            lines.append(self.partial)
+            self.partial = ""
+        for line in lines:
+            self.emit(line.rstrip("\r"))
+
+    def emit(self, line: str):
+        self.log_file.write(line)
+        if self.quiet or not self.limiter.allow():
+            return
+        if self.limiter.suppressed:
+            sys.stdout.write(
+                f"[{self.device_type}] ... {self.limiter.suppressed} lines only "
+                f"in {self.log_file.path}\n"
+            )
+            self.limiter.suppressed = 0
+        sys.stdout.write(f"[{self.device_type}] {line}\n")
+
+    def close(self):
+        if self.partial:
+            self.emit(self.partial)
+        self.log_file.close()
+
+
+async def _follow(chunks, stream: LogStream, executor: ThreadPoolExecutor):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+        except Exception:
+            # the stream breaks when the container is removed
+            return
+        if chunk is None:
+            return
+        stream.feed(chunk)
+
+
+async def _flush_periodically(streams: list[LogStream]):
+    while True:
+        await asyncio.sleep(config.LOG_FLUSH_SECONDS)
+        for stream in streams:
+            stream.log_file.flush()
+        sys.stdout.flush()
+
+
+async def _multiplex(
+    sources: dict, quiet: bool, log_prefix: str, executor: ThreadPoolExecutor
+):
+    streams = {
+        device_type: LogStream(device_type, quiet, log_prefix)
+        for device_type in sources
+    }
+    flusher = asyncio.create_task(_flush_periodically(list(streams.values())))
+    try:
+        await asyncio.gather(
+            *(
+                _follow(chunks, streams[device_type], executor)
+                for device_type, chunks in sources.items()
+            )
+        )
+    finally:
+        flusher.cancel()
+        for stream in streams.values():
+            stream.close()
+            if stream.limiter.suppressed:
+                print(
+                    f"[{stream.device_type}] ... {stream.limiter.suppressed} lines "
+                    f"only in {stream.log_file.path}"
+                )
+        sys.stdout.flush()
+
+
+# Follows the output streams of all device types, container logs or 'docker
+# exec' output, in the calling process. The docker SDK only offers blocking
+# streams, so one reader thread per stream hands the chunks to the event loop,
+# and everything else happens on the loop. Memory does not grow with the
+# length of the run. Every device type is logged to <log_prefix>_<type>.txt.
+def stream_logs(sources: dict, quiet: bool, log_prefix: str = "log"):
+    executor = ThreadPoolExecutor(
+        max_workers=len(sources), thread_name_prefix="kaitian_logs"
+    )
+    try:
+        asyncio.run(_multiplex(sources, quiet, log_prefix, executor))
+    finally:
+        # readers of still running containers return once they are removed
+        executor.shutdown(wait=False)
@@ -0,0 +1,136 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import monitor, redis
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name -> (type, help)
+METRICS = {
+    "kaitian_device_utilization_percent": ("gauge", "Device utilization"),
+    "kaitian_device_memory_used_mib": ("gauge", "Device memory in use"),
+    "kaitian_device_pcie_rx_mbps": ("gauge", "PCIe receive throughput"),
+    "kaitian_device_pcie_tx_mbps": ("gauge", "PCIe transmit throughput"),
+    "kaitian_samples_total": ("counter", "Samples handed to the rank"),
+    "kaitian_batches_total": ("counter", "Batches handed to the rank"),
+    "kaitian_batch_size": ("gauge", "Current batch size of the rank"),
+    "kaitian_compute_capability": ("gauge", "Registered compute capability"),
+    "kaitian_batch_share": ("gauge", "Share of the global batch of the rank"),
+    "kaitian_collective_calls_total": ("counter", "Collectives run by the rank"),
+    "kaitian_collective_seconds_total": (
+        "counter",
+        "Time spent in collectives by the rank",
+    ),
+    "kaitian_collective_phase_seconds_total": (
+        "counter",
+        "Time spent in every phase of the collectives by the rank",
+    ),
+    "kaitian_metrics_push_timestamp_seconds": (
+        "gauge",
+        "Time of the last push from the rank",
+    ),
+}
+
+DEVICE_METRICS = {
+    "utilization": "kaitian_device_utilization_percent",
+    "memory_used": "kaitian_device_memory_used_mib",
+    "pcie_rx": "kaitian_device_pcie_rx_mbps",
+    "pcie_tx": "kaitian_device_pcie_tx_mbps",
+}
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+# Renders the Prometheus text format from the latest monitor sample and what
+# the ranks pushed to redis. Ranks that have not pushed yet are left out.
+def render(devices: list[str], rank_devices: list[str], latest) -> str:
+    samples = {name: [] for name in METRICS}
+    if latest is not None:
+        values = latest[:]
+        for column, device in enumerate(devices):
+            for index, field in enumerate(monitor.FIELDS):
+                value = values[column * len(monitor.FIELDS) + index]
+                # NaN until the tool reported the field
+                if value == value:
+                    samples[DEVICE_METRICS[field]].append(
+                        (_labels(device=device), value)
+                    )
+
+    for rank, capability in redis.get_registered_capabilities().items():
+        labels = _labels(rank=rank, device=rank_devices[rank])
+        samples["kaitian_compute_capability"].append((labels, capability))
+
+    # The share comes from the batch sizes the ranks actually use, which the
+    # rebalancer changes without touching the registry. It is left out until
+    # every rank has pushed.
+    pushed = redis.get_metrics()
+    total_batch_size = sum(metrics["batch_size"] for metrics in pushed.values())
+    if len(pushed) == len(rank_devices) and total_batch_size > 0:
+        for rank, metrics in sorted(pushed.items()):
+            samples["kaitian_batch_share"].append(
+                (
+                    _labels(rank=rank, device=rank_devices[rank]),
+                    metrics["batch_size"] / total_batch_size,
+                )
+            )
+
+    for rank, metrics in sorted(pushed.items()):
+        labels = _labels(rank=rank, device=rank_devices[rank])
+        samples["kaitian_samples_total"].append((labels, metrics["samples"]))
+        samples["kaitian_batches_total"].append((labels, metrics["batches"]))
+        samples["kaitian_batch_size"].append((labels, metrics["batch_size"]))
+        samples["kaitian_metrics_push_timestamp_seconds"].append(
+            (labels, metrics["time"])
+        )
+        for op, collective in metrics["collectives"].items():
+            op_labels = f"{labels},{_labels(op=op)}"
+            samples["kaitian_collective_calls_total"].append(
+                (op_labels, collective["calls"])
+            )
+            samples["kaitian_collective_seconds_total"].append(
+                (op_labels, collective["us"] / 1e6)
+            )
+            for phase, us in collective["phases"].items():
+                samples["kaitian_collective_phase_seconds_total"].append(
+                    (f"{op_labels},{_labels(phase=phase)}", us / 1e6)
+                )
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples[name]:
+            lines.append(f"{name}{{{labels}}} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Serves /metrics on localhost from a daemon thread of the launcher.
+def start_server(port: int, devices: list[str], rank_devices: list[str], latest):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            try:
+                body = render(devices, rank_devices, latest).encode()
+            except Exception as e:
+                self.send_error(503, str(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(
+        f"[KaiTian][Info] Serving metrics on http://127.0.0.1:{port}/metrics",
+        flush=True,
+    )
+    return server
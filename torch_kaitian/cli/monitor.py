@@ -1,89 +1,359 @@
+import csv
 import re
+import shutil
 import subprocess
+import threading
 import time
 
 import matplotlib.pyplot as plt
 import numpy as np
+import tomlkit
 from matplotlib.ticker import MaxNLocator
 
+from .. import config
 
-def run_monitor(stop_flag):
+# Every sample holds these fields per device, NaN where a tool does not report
+# one. Memory is in MiB, PCIe throughput in MB/s.
+FIELDS = ("utilization", "memory_used", "pcie_rx", "pcie_tx")
+
+
+# Parsers turn the output of a tool, line by line, into updates of the form
+# {device_index: {field: value}}. They keep no reference to a process, so they
+# can be fed recorded output:
+#   parse_recorded(CnmonParser(), open("cnmon.txt").read())
+class NvidiaSmiQueryParser:
+    def feed(self, line: str) -> dict[int, dict[str, float]]:
+        parts = [part.strip() for part in line.split(",")]
+        if len(parts) != 3 or not parts[0].isdigit():
+            return {}
+        return {
+            int(parts[0]): {
+                "utilization": _to_float(parts[1]),
+                "memory_used": _to_float(parts[2]),
+            }
+        }
+
+
+# 'nvidia-smi dmon -s t' prints one row per GPU and interval:
+#   # gpu   rxpci   txpci
+#   # Idx    MB/s    MB/s
+#       0      12       3
+class NvidiaSmiDmonParser:
+    def feed(self, line: str) -> dict[int, dict[str, float]]:
+        parts = line.split()
+        if line.startswith("#") or len(parts) != 3 or not parts[0].isdigit():
+            return {}
+        return {
+            int(parts[0]): {
+                "pcie_rx": _to_float(parts[1]),
+                "pcie_tx": _to_float(parts[2]),
+            }
+        }
+
+
+# The cnmon table spends two rows per card, the first one carries the card
+# index and the utilization, the second one the memory usage.
+class CnmonParser:
+    CARD = re.compile(r"\|\s(\d+)\s+/\s+.+?\|\s+(\d+)%\s+.*?\|")
+    MEMORY = re.compile(r"(\d+)\s*MiB\s*/\s*\d+\s*MiB")
+
+    def __init__(self):
+        self.card = None
+
+    def feed(self, line: str) -> dict[int, dict[str, float]]:
+        match = self.CARD.search(line)
+        if match is not None:
+            self.card = int(match.group(1))
+            return {self.card: {"utilization": float(match.group(2))}}
+        match = self.MEMORY.search(line)
+        if match is not None and self.card is not None:
+            card, self.card = self.card, None
+            return {card: {"memory_used": float(match.group(1))}}
+        return {}
+
+
+def _to_float(value: str) -> float:
     try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
 
-        def get_cuda_utilization():
-            result = subprocess.run(
-                [
-                    "nvidia-smi",
-                    "--query-gpu=utilization.gpu",
-                    "--format=csv,noheader,nounits",
-                ],
-                capture_output=True,
+def parse_recorded(parser, text: str) -> dict[int, dict[str, float]]:
+    updates = {}
+    for line in text.splitlines():
+        for index, values in parser.feed(line).items():
+            updates.setdefault(index, {}).update(values)
+    return updates
+
+
+# A long-lived tool process whose stdout is parsed as it streams, or, for tools
+# without a loop mode, a command that is rerun every interval by its own
+# thread. Either way the latest values land in the shared Latest table.
+class Source:
+    def __init__(self, device_type: str, command: list[str], parser, streaming: bool):
+        self.device_type = device_type
+        self.command = command
+        self.parser = parser
+        self.streaming = streaming
+        self.process = None
+
+    def run(self, latest: "Latest", interval: float, stop: threading.Event):
+        if self.streaming:
+            self.process = subprocess.Popen(
+                self.command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
                 text=True,
             )
-            lines = result.stdout.strip().split("\n")
-            for i, line in enumerate(lines):
-                cuda_data[i].append(int(line))
+            for line in self.process.stdout:
+                latest.update(self.device_type, self.parser.feed(line))
+            return
+        while not stop.is_set():
+            start_time = time.monotonic()
+            result = subprocess.run(self.command, capture_output=True, text=True)
+            for line in result.stdout.splitlines():
+                latest.update(self.device_type, self.parser.feed(line))
+            stop.wait(max(interval - (time.monotonic() - start_time), 0))
 
-        def get_mlu_utilization():
-            result = subprocess.run(["cnmon"], capture_output=True, text=True)
-            lines = re.findall(r"\|\s\d+\s+/\s+.+?\|\s+(\d+)%\s+.*?\|", result.stdout)
-            for i, line in enumerate(lines):
-                mlu_data[i].append(int(line))
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
 
-        cuda_data = [[] for _ in range(2)]
-        mlu_data = [[] for _ in range(2)]
 
-        while not stop_flag.value:
-            start_time = time.time()
-            get_cuda_utilization()
-            get_mlu_utilization()
-            elapsed = time.time() - start_time
-            time.sleep(max(1 - elapsed, 0))
-
-        plt.figure(figsize=(10, 6))
-
-        # def moving_average(data, window_size):
-        #     cumsum_vec = np.cumsum(np.insert(data, 0, 0))
-        #     ma_vec = (cumsum_vec[window_size:] - cumsum_vec[:-window_size]) / window_size
-        #     ma_vec = np.insert(ma_vec, 0, [ma_vec[0]] * (window_size - 1))
-        #     return ma_vec
-
-        # window_size = 50
-        # # smoothed_single_losses = moving_average(single_losses, window_size)
-        # smoothed_mlu_data = moving_average(mlu_data, window_size)
-
-        for index, data in enumerate(cuda_data):
-            plt.plot(data, label=f"GPU{index}")
-            # Calculate and plot average utilization
-            if data:
-                avg_util = np.mean(data)
-                plt.axhline(
-                    y=avg_util,
-                    color="r",
-                    linestyle="--",
-                    label=f"GPU{index} Average: {avg_util:.2f}%",
-                )
+def cuda_sources(interval_ms: int) -> list[Source]:
+    return [
+        Source(
+            "cuda",
+            [
+                "nvidia-smi",
+                "--query-gpu=index,utilization.gpu,memory.used",
+                "--format=csv,noheader,nounits",
+                f"--loop-ms={interval_ms}",
+            ],
+            NvidiaSmiQueryParser(),
+            streaming=True,
+        ),
+        # dmon cannot sample faster than once a second
+        Source(
+            "cuda",
+            ["nvidia-smi", "dmon", "-s", "t", "-d", "1"],
+            NvidiaSmiDmonParser(),
+            streaming=True,
+        ),
+    ]
+
+
+def mlu_sources(interval_ms: int) -> list[Source]:
+    return [Source("mlu", ["cnmon"], CnmonParser(), streaming=False)]
+
+
+# device type -> (tool, factory of its sources)
+SOURCES = {
+    "cuda": ("nvidia-smi", cuda_sources),
+    "mlu": ("cnmon", mlu_sources),
+}
+
 
-        for index, data in enumerate(mlu_data):
-            plt.plot(data, label=f"MLU{index}")
-            # Calculate and plot average utilization
-            if data:
-                avg_util = np.mean(data)
-                plt.axhline(
-                    y=avg_util,
-                    color="b",
-                    linestyle="--",
-                    label=f"MLU{index} Average: {avg_util:.2f}%",
+# Most recent value of every field, written by the source threads and copied
+# into the ring buffer once per interval. A field that was not updated for
+# stale_seconds, e.g. because its tool died, is copied as NaN.
+class Latest:
+    def __init__(self, devices: list[str], stale_seconds: float):
+        self.columns = {device: column for column, device in enumerate(devices)}
+        self.values = np.full((len(devices), len(FIELDS)), np.nan)
+        self.updated = np.full((len(devices), len(FIELDS)), -np.inf)
+        self.stale_seconds = stale_seconds
+        self.lock = threading.Lock()
+
+    def update(self, device_type: str, updates: dict[int, dict[str, float]]):
+        now = time.monotonic()
+        with self.lock:
+            for index, values in updates.items():
+                column = self.columns.get(f"{device_type}:{index}", None)
+                if column is None:
+                    continue
+                for field, value in values.items():
+                    self.values[column, FIELDS.index(field)] = value
+                    self.updated[column, FIELDS.index(field)] = now
+
+    def copy(self) -> np.ndarray:
+        with self.lock:
+            values = self.values.copy()
+            values[time.monotonic() - self.updated > self.stale_seconds] = np.nan
+            return values
+
+
+# Fixed-size storage of the last `capacity` samples of all devices.
+class RingBuffer:
+    def __init__(self, capacity: int, num_devices: int):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.full((capacity, num_devices, len(FIELDS)), np.nan)
+        # number of samples ever appended
+        self.count = 0
+
+    def append(self, timestamp: float, values: np.ndarray):
+        slot = self.count % self.capacity
+        self.times[slot] = timestamp
+        self.values[slot] = values
+        self.count += 1
+
+    # samples appended since the given count that were not overwritten yet,
+    # oldest first
+    def since(self, count: int) -> tuple[np.ndarray, np.ndarray]:
+        start = max(count, self.count - self.capacity)
+        slots = np.arange(start, self.count) % self.capacity
+        return self.times[slots], self.values[slots]
+
+
+def monitor_settings(config_data: tomlkit.TOMLDocument) -> dict:
+    settings = {
+        "interval_ms": config.MONITOR_INTERVAL_MS,
+        "capacity": config.MONITOR_CAPACITY,
+        "flush_seconds": config.MONITOR_FLUSH_SECONDS,
+        "output": config.MONITOR_OUTPUT,
+        "stale_seconds": config.MONITOR_STALE_SECONDS,
+        "plot_points": config.MONITOR_PLOT_POINTS,
+    }
+    for key, value in config_data.get("monitor", {}).items():
+        if key in settings:
+            settings[key] = type(settings[key])(value)
+    settings["devices"] = [
+        str(detail["device_number"])
+        for device_type in config_data["devices"]
+        for _, detail in config_data["devices"][device_type].items()
+        if isinstance(detail, dict)
+    ]
+    return settings
+
+
+def write_csv(path: str, devices: list[str], times: np.ndarray, values: np.ndarray):
+    with open(path, "a", newline="") as file:
+        writer = csv.writer(file)
+        for timestamp, sample in zip(times, values):
+            for device, row in zip(devices, sample):
+                writer.writerow(
+                    [f"{timestamp:.3f}", device]
+                    + ["" if np.isnan(value) else f"{value:g}" for value in row]
                 )
 
-        plt.xlabel("Time (seconds)")
-        plt.ylabel("Utilization (%)")
-        plt.title("Accelerators Utilization Over Time")
-        plt.ylim(0, 100)
-        plt.gca().xaxis.set_major_locator(MaxNLocator(integer=True))
-        plt.legend()
-        plt.grid(True)
-        plt.savefig("utilization.png")
-        plt.close()
+
+def _csv_rows(path: str):
+    with open(path, "r", newline="") as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        yield from reader
+
+
+# The samples written by write_csv, averaged into at most `bins` equal time
+# bins, so that plotting a run of any length takes O(bins) memory. Missing
+# values are left out of the averages, a bin without any value is NaN.
+def read_csv(path: str, devices: list[str], bins: int) -> tuple[np.ndarray, np.ndarray]:
+    columns = {device: column for column, device in enumerate(devices)}
+    first = last = None
+    for timestamp, *_ in _csv_rows(path):
+        first = float(timestamp) if first is None else min(first, float(timestamp))
+        last = float(timestamp) if last is None else max(last, float(timestamp))
+    if first is None:
+        return np.zeros(0), np.zeros((0, len(devices), len(FIELDS)))
+
+    width = (last - first) / bins or 1.0
+    time_sums = np.zeros(bins)
+    time_counts = np.zeros(bins)
+    sums = np.zeros((bins, len(devices), len(FIELDS)))
+    counts = np.zeros((bins, len(devices), len(FIELDS)))
+    for timestamp, device, *row in _csv_rows(path):
+        timestamp = float(timestamp)
+        slot = min(int((timestamp - first) / width), bins - 1)
+        time_sums[slot] += timestamp
+        time_counts[slot] += 1
+        if device not in columns:
+            continue
+        for index, value in enumerate(row):
+            if value:
+                sums[slot, columns[device], index] += float(value)
+                counts[slot, columns[device], index] += 1
+    used = time_counts > 0
+    with np.errstate(invalid="ignore"):
+        return time_sums[used] / time_counts[used], sums[used] / counts[used]
+
+
+def plot_utilization(devices: list[str], times: np.ndarray, values: np.ndarray):
+    plt.figure(figsize=(10, 6))
+    seconds = times - times[0] if len(times) else times
+    for column, device in enumerate(devices):
+        data = values[:, column, FIELDS.index("utilization")]
+        if np.all(np.isnan(data)):
+            continue
+        (line,) = plt.plot(seconds, data, label=device.upper())
+        # Calculate and plot average utilization
+        avg_util = np.nanmean(data)
+        plt.axhline(
+            y=avg_util,
+            color=line.get_color(),
+            linestyle="--",
+            label=f"{device.upper()} Average: {avg_util:.2f}%",
+        )
+    plt.xlabel("Time (seconds)")
+    plt.ylabel("Utilization (%)")
+    plt.title("Accelerators Utilization Over Time")
+    plt.ylim(0, 100)
+    plt.gca().xaxis.set_major_locator(MaxNLocator(integer=True))
+    plt.legend()
+    plt.grid(True)
+    plt.savefig("utilization.png")
+    plt.close()
+
+
+# The latest sample is also copied into `shared`, a multiprocessing.Array of
+# len(devices) * len(FIELDS) doubles, for the metrics endpoint of the launcher.
+def run_monitor(stop_flag, settings: dict, shared=None):
+    devices = settings["devices"]
+    interval = settings["interval_ms"] / 1000
+    latest = Latest(devices, settings["stale_seconds"])
+    ring = RingBuffer(settings["capacity"], len(devices))
+    stop = threading.Event()
+    sources = []
+    for device_type, (tool, factory) in SOURCES.items():
+        if not any(device.startswith(f"{device_type}:") for device in devices):
+            continue
+        if shutil.which(tool) is None:
+            print(f"[KaiTian][Warning] {tool} not found, {device_type} not monitored.")
+            continue
+        sources.extend(factory(settings["interval_ms"]))
+    threads = [
+        threading.Thread(target=source.run, args=(latest, interval, stop), daemon=True)
+        for source in sources
+    ]
+    for thread in threads:
+        thread.start()
+
+    with open(settings["output"], "w", newline="") as file:
+        csv.writer(file).writerow(["time", "device", *FIELDS])
+    flushed = 0
+    last_flush = time.monotonic()
+    try:
+        while not stop_flag.value:
+            start_time = time.monotonic()
+            values = latest.copy()
+            ring.append(time.time(), values)
+            if shared is not None:
+                shared[:] = values.ravel().tolist()
+            if start_time - last_flush >= settings["flush_seconds"]:
+                write_csv(settings["output"], devices, *ring.since(flushed))
+                flushed, last_flush = ring.count, start_time
+            time.sleep(max(interval - (time.monotonic() - start_time), 0))
     except KeyboardInterrupt:
         pass
+    finally:
+        stop.set()
+        for source in sources:
+            source.stop()
+        write_csv(settings["output"], devices, *ring.since(flushed))
+        # the ring only holds the last `capacity` samples, the file all of them
+        plot_utilization(
+            devices,
+            *read_csv(settings["output"], devices, settings["plot_points"]),
+        )
@@ -0,0 +1,224 @@
+import fcntl
+from pathlib import Path
+
+import docker
+
+from .. import config
+from . import redis, startup, topology
+
+# Opt-in pool of long-lived containers, started by 'kaitian pool up'. Every
+# 'kaitian run --pool' executes the training script in them through
+# 'docker exec' with the environment of that run, so container creation and
+# device setup are paid once. The containers keep running the image's idle
+# command; the workspace is mounted at /workspace and its data directory at
+# /data.
+LABEL = "kaitian.pool"
+REDIS_NAME = "kaitian_pool_redis"
+WORKSPACE = "/workspace"
+PID_FILE = "/tmp/kaitian_run.pid"
+LOCK_FILE = config.CONFIG_DIR / "pool.lock"
+
+
+def container_name(device_type: str) -> str:
+    return f"kaitian_pool_{device_type}"
+
+
+def pool_containers(client) -> dict:
+    return {
+        container.labels[LABEL]: container
+        for container in client.containers.list(all=True, filters={"label": LABEL})
+    }
+
+
+# The devices the pool was started with, in the order of the device list.
+def pool_devices(client) -> list[str]:
+    device_list = []
+    for device_type, container in pool_containers(client).items():
+        if device_type != "redis":
+            device_list.extend(container.labels["kaitian.devices"].split(","))
+    return device_list
+
+
+def pool_up(args, device_list: list[str], config_data, client=None):
+    client = client or docker.from_env()
+    if pool_containers(client):
+        exit("[KaiTian][Error] The pool is already up, see 'kaitian pool status'.")
+    if len(device_list) == 0:
+        exit(f"[KaiTian][Error] No device specified for use.")
+    try:
+        client.networks.get("kaitian")
+    except docker.errors.NotFound:
+        client.networks.create("kaitian", driver="bridge")
+    workspace = Path(args.workspace).resolve()
+    specs = {
+        "redis": dict(
+            detach=True,
+            network="kaitian",
+            name=REDIS_NAME,
+            labels={LABEL: "redis"},
+            image=config.REDIS_IMAGE,
+            command="redis-server",
+        )
+    }
+    for device_type in sorted(set(device.split(":")[0] for device in device_list)):
+        devices = [device for device in device_list if device_type in device]
+        specs[device_type] = dict(
+            detach=True,
+            network="kaitian",
+            name=container_name(device_type),
+            hostname=device_type,
+            labels={
+                LABEL: device_type,
+                "kaitian.devices": ",".join(devices),
+                "kaitian.workspace": str(workspace),
+            },
+            shm_size="16G",
+            # the directory, not the file, so that every run sees the
+            # snapshot the launcher replaced
+            volumes=[
+                f"{workspace}:{WORKSPACE}",
+                f"{workspace}/data:/data",
+                f"/home/lin/.cache/torch/hub/checkpoints:/root/.cache/torch/hub/checkpoints",
+                f"{config.CAPABILITY_SNAPSHOT_FILE.parent}:"
+                f"{Path(config.CONTAINER_CAPABILITY_SNAPSHOT_FILE).parent}:ro",
+            ],
+            working_dir="/",
+            **startup.device_options(
+                device_type, [device.split(":")[1] for device in devices]
+            ),
+        )
+    topology.apply_pinning(
+        specs,
+        {
+            device_type: [device for device in device_list if device_type in device]
+            for device_type in specs
+            if device_type != "redis"
+        },
+        config_data,
+    )
+    timeline = startup.Timeline()
+    probes = {
+        "redis": startup.redis_probe(
+            lambda: redis.get_redis_client(client, REDIS_NAME).ping()
+        )
+    }
+    try:
+        startup.start_containers(client, specs, probes, timeline)
+    except startup.StartupError as e:
+        pool_down(args, client)
+        exit(f"[KaiTian][Error] Starting the pool failed: {e}")
+    finally:
+        timeline.print()
+    print(f"[KaiTian][Info] Pool is up with {', '.join(device_list)}", flush=True)
+
+
+def pool_status(args, client=None):
+    client = client or docker.from_env()
+    containers = pool_containers(client)
+    if not containers:
+        print("[KaiTian][Info] No pool is running.")
+        return
+    for device_type, container in sorted(containers.items()):
+        state = container.attrs["State"]
+        print(
+            f"{container.name:<22} {container.status:<10} "
+            f"since {state['StartedAt'][:19]}  "
+            f"{container.labels.get('kaitian.devices', '')}"
+        )
+    workspace = next(
+        container.labels["kaitian.workspace"]
+        for device_type, container in containers.items()
+        if device_type != "redis"
+    )
+    print(f"Workspace: {workspace}")
+    try:
+        busy = redis.get_redis_client(client, REDIS_NAME).exists("kaitian_pool_run")
+        print(f"Run in progress: {'yes' if busy else 'no'}")
+    except Exception as e:
+        print(f"Redis: {e}")
+
+
+def pool_down(args, client=None):
+    client = client or docker.from_env()
+    for container in pool_containers(client).values():
+        container.remove(force=True)
+        print(f"[KaiTian][Info] Removed {container.name}", flush=True)
+    try:
+        client.networks.get("kaitian").remove()
+    except docker.errors.APIError:
+        # still used by a non-pool run
+        pass
+
+
+# Takes the pool for one run: only one run may use it at a time, and the
+# registry and the gloo rendezvous keys of the previous run are dropped.
+# Returns the device containers and the lock, which is held until closed.
+def acquire(client):
+    containers = pool_containers(client)
+    if not containers:
+        exit("[KaiTian][Error] No pool is running, start one with 'kaitian pool up'.")
+    not_running = [c.name for c in containers.values() if c.status != "running"]
+    if not_running:
+        exit(f"[KaiTian][Error] Pool containers not running: {', '.join(not_running)}")
+    LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    lock = open(LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        exit("[KaiTian][Error] Another run is using the pool.")
+    r = redis.get_redis_client(client, REDIS_NAME)
+    r.flushall()
+    r.set("kaitian_pool_run", 1)
+    containers.pop("redis")
+    return containers, lock
+
+
+def exec_command(container, args, unknown_args) -> list[str]:
+    workspace = Path(container.labels["kaitian.workspace"])
+    file_path = Path(args.file).resolve()
+    if not file_path.is_relative_to(workspace):
+        exit(
+            f"[KaiTian][Error] {file_path} is not inside the pool workspace "
+            f"{workspace}."
+        )
+    script = f"{WORKSPACE}/{file_path.relative_to(workspace)}"
+    # a session of its own, so that stop() reaches the worker processes too
+    return [
+        "setsid",
+        "-w",
+        "sh",
+        "-c",
+        f'echo $$ > {PID_FILE} && exec "$@"',
+        "kaitian",
+        "python",
+        script,
+    ] + unknown_args
+
+
+# Starts the run in one pool container and returns its output stream.
+def exec_run(client, container, command: list[str], environment: dict):
+    environment = dict(environment, KAITIAN_REDIS_HOST=REDIS_NAME)
+    exec_id = client.api.exec_create(
+        container.id, command, environment=environment, workdir="/"
+    )["Id"]
+    return client.api.exec_start(exec_id, stream=True)
+
+
+# Ends what is left of a run, e.g. after Ctrl-C in the launcher.
+def stop(containers: dict):
+    for container in containers.values():
+        container.exec_run(
+            [
+                "sh",
+                "-c",
+                f"[ -f {PID_FILE} ] && kill -TERM -- -$(cat {PID_FILE}); "
+                f"rm -f {PID_FILE}",
+            ]
+        )
+
+
+def release(client, lock):
+    try:
+        redis.get_redis_client(client, REDIS_NAME).delete("kaitian_pool_run")
+    finally:
+        lock.close()
@@ -1,3 +1,6 @@
+import json
+from pathlib import Path
+
 import docker
 import redis
 import tomlkit
@@ -8,11 +11,11 @@ redis_client = None
 
 
 # CLI environment is not in the kaitian network, So we need to manually find the IP address
-def get_redis_client():
+def get_redis_client(client=None, name: str = "kaitian_redis"):
     global redis_client
     if redis_client is None:
-        client = docker.from_env()
-        redis_container = client.containers.get("kaitian_redis")
+        client = client or docker.from_env()
+        redis_container = client.containers.get(name)
         ip = redis_container.attrs["NetworkSettings"]["Networks"]["kaitian"][
             "IPAddress"
         ]
@@ -25,15 +28,96 @@ def get_redis_client():
     return redis_client
 
 
-def set_capability(global_rank_start: int, devices: list[str], device_type: str):
-    r = get_redis_client()
-    devices = [device.replace(":", "") for device in devices]
-    with open(config.CONFIG_FILE, "r") as file:
-        config_data = tomlkit.loads(file.read())
+# Redis of a multi-node run, published on a host address of the first node.
+def connect(host: str, port: int):
+    global redis_client
+    redis_client = redis.Redis(
+        host=host,
+        port=port,
+        socket_timeout=5,
+        socket_connect_timeout=5,
+        decode_responses=True,
+    )
+    return redis_client
+
 
+def get_capabilities(
+    config_data: tomlkit.TOMLDocument, global_rank_start: int, devices: list[str]
+) -> dict[int, float]:
+    capabilities = {}
     for index, device in enumerate(devices):
-        compute_capability = str(
-            config_data["devices"][device_type][device]["compute_capability"]
+        device_type, device_index = device.split(":")
+        capabilities[global_rank_start + index] = float(
+            config_data["devices"][device_type][f"{device_type}{device_index}"][
+                "compute_capability"
+            ]
         )
-        global_rank = str(global_rank_start + index)
-        r.hset("compute_capability", global_rank, compute_capability)
+    return capabilities
+
+
+def get_calibration() -> dict[int, tuple[int, float]]:
+    r = get_redis_client()
+    calibration = {}
+    for global_rank, value in r.hgetall("calibration").items():
+        num_samples, seconds = value.split(",")
+        calibration[int(global_rank)] = (int(num_samples), float(seconds))
+    return calibration
+
+
+def get_metrics() -> dict[int, dict]:
+    r = get_redis_client()
+    return {
+        int(global_rank): json.loads(value)
+        for global_rank, value in r.hgetall("metrics").items()
+    }
+
+
+def get_registered_capabilities() -> dict[int, float]:
+    r = get_redis_client()
+    return {
+        int(global_rank): float(value)
+        for global_rank, value in r.hgetall("compute_capability").items()
+    }
+
+
+# Write all ranks in one round trip and bump the version, which tells the
+# training processes that their snapshot is outdated.
+def set_capabilities(capabilities: dict[int, float]) -> int:
+    r = get_redis_client()
+    pipe = r.pipeline()
+    pipe.delete("compute_capability")
+    pipe.hset(
+        "compute_capability",
+        mapping={str(rank): str(value) for rank, value in capabilities.items()},
+    )
+    pipe.incr("compute_capability_version")
+    version = pipe.execute()[-1]
+    write_snapshot(capabilities, version)
+    return version
+
+
+# Adds the ranks of one node to the registry, which the other nodes fill in
+# with their own ranks.
+def register_capabilities(capabilities: dict[int, float]):
+    r = get_redis_client()
+    r.hset(
+        "compute_capability",
+        mapping={str(rank): str(value) for rank, value in capabilities.items()},
+    )
+
+
+def write_snapshot(
+    capabilities: dict[int, float],
+    version: int,
+    path: Path = config.CAPABILITY_SNAPSHOT_FILE,
+):
+    snapshot = {
+        "version": version,
+        "compute_capability": {
+            str(rank): str(value) for rank, value in capabilities.items()
+        },
+    }
+    tmp_file = path.with_suffix(".tmp")
+    with open(tmp_file, "w") as file:
+        json.dump(snapshot, file)
+    tmp_file.replace(path)
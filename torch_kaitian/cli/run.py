@@ -1,6 +1,7 @@
 import multiprocessing
 import os
 import subprocess
+import threading
 import traceback
 from pathlib import Path
 
@@ -8,30 +9,59 @@ import docker
 import tomlkit
 
 from .. import config
-from . import monitor, redis
+from . import calibrate, logs, metrics, monitor, pool, redis, startup, topology
 
 
-def run_container(
-    device_type: str,
-    device_ids: list[str],
+# Environment of the training processes of one device type in one run.
+def run_environment(
     args,
     gloo_rank: int,
     gloo_world_size: int,
+    gloo_lanes: int,
     global_world_size: int,
     global_rank_start: int,
-    unknown_args,
-):
-    print(f"[KaiTian][Info] Running {device_type} container...")
-    client = docker.from_env()
+) -> dict:
     environment = {
         "KAITIAN_GLOO_RANK": gloo_rank,
         "KAITIAN_GLOO_WORLD_SIZE": gloo_world_size,
+        "KAITIAN_GLOO_LANES": gloo_lanes,
         "KAITIAN_GLOBAL_WORLD_SIZE": global_world_size,
         "KAITIAN_GLOBAL_RANK_START": global_rank_start,
+        "KAITIAN_CAPABILITY_SNAPSHOT": config.CONTAINER_CAPABILITY_SNAPSHOT_FILE,
     }
+    if args.metrics_port:
+        environment["KAITIAN_METRICS_PUSH_SECONDS"] = config.METRICS_PUSH_SECONDS
+    if args.command == "calibrate":
+        environment["KAITIAN_CALIBRATE_STEPS"] = args.steps
+        environment["KAITIAN_CALIBRATE_WARMUP"] = args.warmup
+    return environment
+
+
+# Keyword arguments of client.containers.run for one device type.
+def container_spec(
+    device_type: str,
+    device_ids: list[str],
+    args,
+    gloo_rank: int,
+    gloo_world_size: int,
+    gloo_lanes: int,
+    global_world_size: int,
+    global_rank_start: int,
+    unknown_args,
+    snapshot_file: Path = config.CAPABILITY_SNAPSHOT_FILE,
+):
+    environment = run_environment(
+        args,
+        gloo_rank,
+        gloo_world_size,
+        gloo_lanes,
+        global_world_size,
+        global_rank_start,
+    )
+    snapshot_volume = f"{snapshot_file}:{config.CONTAINER_CAPABILITY_SNAPSHOT_FILE}:ro"
     if "wait" in args.develop:
         kaitian_path = Path(__file__).resolve().parent.parent.parent
-        volumes = [f"{kaitian_path}:/kaitian"]
+        volumes = [f"{kaitian_path}:/kaitian", snapshot_volume]
         command = None
     else:
         file_path = Path(args.file).resolve()
@@ -39,106 +69,156 @@ def run_container(
             f"{file_path}:/{file_path.name}",
             f"{file_path.parent}/data:/data",
             f"/home/lin/.cache/torch/hub/checkpoints:/root/.cache/torch/hub/checkpoints",
+            snapshot_volume,
         ]
         command = ["python", f"/{file_path.name}"] + unknown_args
-    device_requests = None
-    devices = None
-    match device_type:
-        case "cuda":
-            device_requests = [
-                docker.types.DeviceRequest(
-                    device_ids=device_ids, capabilities=[["gpu"]]
-                )
-            ]
-            image = config.CUDA_IMAGE
-        case "mlu":
-            # Compatible with MLU370
-            devices = ["/dev/cambricon_ctl"]
-            for i in device_ids:
-                devices.extend([f"/dev/cambricon_dev{i}", f"/dev/cambricon_ipcm{i}"])
-            image = config.MLU_IMAGE
-    return client.containers.run(
+    return dict(
         detach=True,
         network="kaitian",
         name=f"kaitian_{device_type}",
         hostname=device_type,
         environment=environment,
-        device_requests=device_requests,
-        devices=devices,
         shm_size="16G",
         volumes=volumes,
         working_dir="/",
-        image=image,
         command=command,
+        **startup.device_options(device_type, device_ids),
     )
 
 
-def stream_logs(container, device_type):
-    try:
-        logs = []
-        for line in container.logs(stream=True, follow=True):
-            logs.append(line.decode().strip())
-            print(f"[{device_type}] {line.decode().strip()}", flush=True)
-    except:
-        pass
-    finally:
-        with open(f"log_{device_type}.txt", "w") as log_file:
-            log_file.write("\n".join(logs))
-
-
-def docker_run(args, unknown_args, device_list: list[str]):
+def docker_run(
+    args,
+    unknown_args,
+    config_data: tomlkit.TOMLDocument,
+    device_list: list[str],
+    client=None,
+):
     if len(device_list) == 0:
         exit(f"[KaiTian][Error] No device specified for use.")
-    client = docker.from_env()
+    client = client or docker.from_env()
     containers = {}
+    pool_lock = None
 
-    # create network
-    try:
-        network = client.networks.get("kaitian")
-    except docker.errors.NotFound:
-        network = client.networks.create("kaitian", driver="bridge")
+    # create network, the pool brings its own
+    if not args.pool:
+        try:
+            network = client.networks.get("kaitian")
+        except docker.errors.NotFound:
+            network = client.networks.create("kaitian", driver="bridge")
 
     # create monitor
+    monitor_settings = monitor.monitor_settings(config_data)
+    monitor_latest = None
+    monitor_process = None
+    metrics_server = None
     if "wait" not in args.develop:
         monitor_stop_flag = multiprocessing.Value("b", False)
+        monitor_latest = multiprocessing.Array(
+            "d", len(monitor_settings["devices"]) * len(monitor.FIELDS)
+        )
         monitor_process = multiprocessing.Process(
-            target=monitor.run_monitor, args=(monitor_stop_flag,)
+            target=monitor.run_monitor,
+            args=(monitor_stop_flag, monitor_settings, monitor_latest),
         )
         monitor_process.start()
 
-    # create redis server
-    client.containers.run(
-        detach=True,
-        network="kaitian",
-        name=f"kaitian_redis",
-        image=config.REDIS_IMAGE,
-        command="redis-server",
-    )
-
-    # create accelerator container
     device_types = set(device.split(":")[0] for device in device_list)
     gloo_world_size = len(device_types)
+    # every local rank gets its own gloo lane when all device types have the
+    # same number of devices, otherwise only the leaders talk to each other
+    device_counts = set(
+        sum(1 for device in device_list if device.startswith(device_type))
+        for device_type in device_types
+    )
+    gloo_lanes = device_counts.pop() if len(device_counts) == 1 else 1
     global_world_size = len(device_list)
     global_rank_start = 0
     try:
+        if args.pool:
+            # before the snapshot is replaced under a running pool job
+            containers, pool_lock = pool.acquire(client)
+
+        # the capabilities of all ranks, registered at once
+        capabilities = {}
+        rank_devices = []
+        for device_type in device_types:
+            devices = [device for device in device_list if device_type in device]
+            capabilities.update(
+                redis.get_capabilities(config_data, len(capabilities), devices)
+            )
+            rank_devices.extend(devices)
+        if args.command == "calibrate":
+            # every rank trains with the original batch size
+            capabilities = {
+                rank: config.MAX_COMPUTE_CAPABILITY for rank in capabilities
+            }
+        else:
+            capabilities = calibrate.apply_profile(
+                args, unknown_args, rank_devices, capabilities
+            )
+        # The snapshot is bind-mounted, so it has to exist before the
+        # containers start. The registry of the fresh redis gets version 1 once
+        # the capabilities are written below.
+        redis.write_snapshot(capabilities, 1)
+
+        # start redis and all accelerator containers at once, the ranks wait
+        # for redis in the gloo rendezvous themselves
+        specs = {
+            "redis": dict(
+                detach=True,
+                network="kaitian",
+                name=f"kaitian_redis",
+                image=config.REDIS_IMAGE,
+                command="redis-server",
+            )
+        }
+        type_devices = {}
         for gloo_rank, device_type in enumerate(device_types):
             devices = [device for device in device_list if device_type in device]
-            redis.set_capability(global_rank_start, devices, device_type)
+            type_devices[device_type] = devices
             device_ids = [device.split(":")[1] for device in devices]
-            containers[device_type] = run_container(
+            specs[device_type] = container_spec(
                 device_type,
                 device_ids,
                 args,
                 gloo_rank,
                 gloo_world_size,
+                gloo_lanes,
                 global_world_size,
                 global_rank_start,
                 unknown_args,
             )
-            device_count = sum(
-                1 for device in device_list if device.startswith(device_type)
+            global_rank_start += len(devices)
+        # a pool was pinned when it came up, its runs only get num_workers
+        topology.apply_pinning(specs, type_devices, config_data)
+        if not args.pool:
+            timeline = startup.Timeline()
+            probes = {
+                "redis": startup.redis_probe(
+                    lambda: redis.get_redis_client(client).ping()
+                )
+            }
+            try:
+                containers = startup.start_containers(client, specs, probes, timeline)
+            finally:
+                if not args.quiet:
+                    timeline.print()
+            containers.pop("redis")
+        version = redis.set_capabilities(capabilities)
+        if version != 1:
+            print(
+                f"[KaiTian][Warning] Capability registry at version {version}, "
+                "the ranks may read outdated capabilities.",
+                flush=True,
+            )
+        if args.metrics_port:
+            metrics_server = metrics.start_server(
+                args.metrics_port,
+                monitor_settings["devices"],
+                rank_devices,
+                monitor_latest,
             )
-            global_rank_start += device_count
+
         if "wait" in args.develop:
             print("[KaiTian][Info] Detected 'wait' development argument.", flush=True)
             print(
@@ -151,17 +231,42 @@ def docker_run(args, unknown_args, device_list: list[str]):
             )
             return
         # get output
-        print("--------- Output -----------")
-        log_processes = []
-        for device_type, container in containers.items():
-            process = multiprocessing.Process(
-                target=stream_logs, args=(container, device_type)
-            )
-            process.start()
-            log_processes.append(process)
-        for process in log_processes:
-            process.join()
+        print("--------- Output -----------", flush=True)
+        if args.pool:
+            streams = {
+                device_type: pool.exec_run(
+                    client,
+                    container,
+                    pool.exec_command(container, args, unknown_args),
+                    specs[device_type]["environment"],
+                )
+                for device_type, container in containers.items()
+            }
+        else:
+            streams = {
+                device_type: container.logs(stream=True, follow=True)
+                for device_type, container in containers.items()
+            }
+        streamed = threading.Event()
+        if args.command == "calibrate":
+            if args.pool:
+                stop = lambda: pool.stop(containers)
+            else:
+                stop = lambda: [container.stop() for container in containers.values()]
+            threading.Thread(
+                target=calibrate.stop_when_calibrated,
+                args=(global_world_size, stop, streamed),
+                daemon=True,
+            ).start()
+        try:
+            logs.stream_logs(streams, args.quiet)
+        finally:
+            streamed.set()
         print("--------- Finish -----------")
+        if args.command == "calibrate":
+            calibrate.save_profile(
+                args, unknown_args, rank_devices, redis.get_calibration()
+            )
         for device_type in device_types:
             print(
                 f"{device_type.upper()} log: {Path.cwd()}/log_{device_type}.txt",
@@ -172,25 +277,40 @@ def docker_run(args, unknown_args, device_list: list[str]):
             "\n[KaiTian][Info] Received KeyboardInterrupt. Stop and clean up.",
             flush=True,
         )
+    except startup.StartupError as e:
+        print(f"[KaiTian][Error] Startup failed: {e}", flush=True)
     except Exception as e:
         print(f"[KaiTian][Error] Unknown error: {e}", flush=True)
         tb = traceback.format_exc()
         print(tb)
     finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
         if "wait" in args.develop:
             return
-        # clean up
-        all_containers = client.containers.list(all=True)
-        container_names = [f"kaitian_{device_type}" for device_type in device_types]
-        for container in all_containers:
-            container_name = container.attrs["Name"].strip("/")
-            if container_name in container_names or container_name == "kaitian_redis":
-                container.remove(force=True)
-        network.remove()
+        try:
+            if args.pool:
+                # the containers stay up for the next run
+                if pool_lock is not None:
+                    pool.stop(containers)
+                    pool.release(client, pool_lock)
+            else:
+                clean_up(client, network, device_types)
+        finally:
+            # also after exit() in a check, the monitor would keep the run alive
+            if monitor_process is not None:
+                monitor_stop_flag.value = True
+                monitor_process.join()
 
-    if "wait" not in args.develop:
-        monitor_stop_flag.value = True
-        monitor_process.join()
+
+def clean_up(client, network, device_types: set[str]):
+    all_containers = client.containers.list(all=True)
+    container_names = [f"kaitian_{device_type}" for device_type in device_types]
+    for container in all_containers:
+        container_name = container.attrs["Name"].strip("/")
+        if container_name in container_names or container_name == "kaitian_redis":
+            container.remove(force=True)
+    network.remove()
 
 
 def check_environment_variable(config_data: tomlkit.TOMLDocument) -> list[str]:
@@ -289,10 +409,30 @@ def run_kaitian(args, unknown_args):
     with open(config.CONFIG_FILE, "r") as file:
         config_data = tomlkit.loads(file.read())
 
-    # get the specified device to use
-    device_list = check_environment_variable(config_data)
+    # get the specified device to use, a pool runs on the devices it was
+    # started with
+    if args.pool:
+        device_list = pool.pool_devices(docker.from_env())
+    else:
+        device_list = check_environment_variable(config_data)
 
     if "build" in args.develop:
         build_image(device_list)
 
-    docker_run(args, unknown_args, device_list)
+    docker_run(args, unknown_args, config_data, device_list)
+
+
+def pool_kaitian(args):
+    match args.action:
+        case "up":
+            if not os.path.isfile(config.CONFIG_FILE):
+                exit(
+                    f"[KaiTian][Error] Unable to find configuration file. Please run 'kaitian init' first."
+                )
+            with open(config.CONFIG_FILE, "r") as file:
+                config_data = tomlkit.loads(file.read())
+            pool.pool_up(args, check_environment_variable(config_data), config_data)
+        case "status":
+            pool.pool_status(args)
+        case "down":
+            pool.pool_down(args)
@@ -0,0 +1,127 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+import redis
+
+from .. import config
+
+# Starting the containers of a job. Everything talks to docker through the
+# client that is passed in, and to redis through the ping callable, so the
+# orchestration runs against fakes as well:
+#   containers = start_containers(FakeClient(), specs, {"redis": probe}, timeline)
+
+
+class StartupError(Exception):
+    pass
+
+
+# Seconds since the launcher began starting the job, per container and event.
+class Timeline:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.events = []
+
+    def record(self, name: str, event: str):
+        self.events.append((time.monotonic() - self.start, name, event))
+
+    def print(self):
+        print("--------- Startup ----------")
+        for seconds, name, event in sorted(self.events):
+            print(f"{seconds:7.2f}s  {name:<8} {event}")
+        print(flush=True)
+
+
+def wait_running(container, timeout: float):
+    # Containers without a HEALTHCHECK are ready once they run, the others
+    # once docker reports them healthy.
+    deadline = time.monotonic() + timeout
+    while True:
+        container.reload()
+        state = container.attrs["State"]
+        if container.status == "exited":
+            # a script may well finish before the probe looks at it
+            if state.get("ExitCode") == 0:
+                return
+            logs = container.logs(tail=20).decode(errors="replace")
+            raise StartupError(
+                f"{container.name} exited with {state.get('ExitCode')}:\n{logs}"
+            )
+        health = state.get("Health", None)
+        if container.status == "running" and (
+            health is None or health["Status"] == "healthy"
+        ):
+            return
+        if time.monotonic() > deadline:
+            raise StartupError(f"{container.name} not ready after {timeout}s")
+        time.sleep(0.1)
+
+
+# ping() is called until it returns True or the deadline passes
+def wait_ping(ping, name: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if ping():
+                return
+        except redis.exceptions.RedisError:
+            pass
+        if time.monotonic() > deadline:
+            raise StartupError(f"{name} does not answer PING")
+        time.sleep(0.1)
+
+
+def redis_probe(ping):
+    def probe(container, timeout: float):
+        wait_running(container, timeout)
+        wait_ping(ping, container.name, timeout)
+
+    return probe
+
+
+# Runs every spec (keyword arguments of client.containers.run) at the same
+# time and waits until all of them pass their probe, wait_running by default.
+def start_containers(
+    client,
+    specs: dict[str, dict],
+    probes: dict,
+    timeline: Timeline,
+    timeout: float = 120.0,
+) -> dict:
+    containers = {}
+
+    def start(name: str):
+        timeline.record(name, "create")
+        containers[name] = client.containers.run(**specs[name])
+        timeline.record(name, "started")
+        probes.get(name, wait_running)(containers[name], timeout)
+        timeline.record(name, "ready")
+
+    with ThreadPoolExecutor(max_workers=len(specs)) as executor:
+        futures = [executor.submit(start, name) for name in specs]
+        errors = [future.exception() for future in futures]
+    errors = [error for error in errors if error is not None]
+    if errors:
+        raise StartupError("\n".join(str(error) for error in errors))
+    return containers
+
+
+# Image and device access of the container of one device type.
+def device_options(device_type: str, device_ids: list[str]) -> dict:
+    device_requests = None
+    devices = None
+    match device_type:
+        case "cuda":
+            device_requests = [
+                docker.types.DeviceRequest(
+                    device_ids=device_ids, capabilities=[["gpu"]]
+                )
+            ]
+            image = config.CUDA_IMAGE
+        case "mlu":
+            # Compatible with MLU370
+            devices = ["/dev/cambricon_ctl"]
+            for i in device_ids:
+                devices.extend([f"/dev/cambricon_dev{i}", f"/dev/cambricon_ipcm{i}"])
+            image = config.MLU_IMAGE
+    return dict(device_requests=device_requests, devices=devices, image=image)
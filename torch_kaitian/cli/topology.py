@@ -0,0 +1,195 @@
+import os
+from pathlib import Path
+
+import tomlkit
+
+from .. import config
+
+# CPU and memory pinning of the device containers. The bus IDs recorded by
+# 'kaitian init' are looked up in sysfs to find the NUMA node of every device,
+# and the CPUs of a NUMA node are split between the containers in proportion
+# to their devices on it. Everything reads below sysfs_root, so a fixture tree
+# works as well:
+#   plan_pinning({"cuda": ["0000:3b:00.0"]}, "tests/fixtures/sys")
+
+
+def parse_cpulist(cpulist: str) -> list[int]:
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus: list[int]) -> str:
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+# nvidia-smi reports 00000000:3B:00.0, sysfs names it 0000:3b:00.0
+def normalize_bus_id(bus_id: str) -> str | None:
+    try:
+        domain, bus, slot = bus_id.strip().split(":")
+        device, function = slot.split(".")
+        return (
+            f"{int(domain, 16):04x}:{int(bus, 16):02x}:"
+            f"{int(device, 16):02x}.{int(function, 16):x}"
+        )
+    except ValueError:
+        return None
+
+
+def _read(path: Path) -> str | None:
+    try:
+        return path.read_text()
+    except OSError:
+        return None
+
+
+# None if the device or its NUMA node is unknown, e.g. on a single socket
+def numa_node(bus_id: str, sysfs_root=config.SYSFS_ROOT) -> int | None:
+    bus_id = normalize_bus_id(bus_id)
+    if bus_id is None:
+        return None
+    node = _read(Path(sysfs_root) / "bus" / "pci" / "devices" / bus_id / "numa_node")
+    if node is None or int(node) < 0:
+        return None
+    return int(node)
+
+
+def node_cpus(node: int, sysfs_root=config.SYSFS_ROOT) -> list[int]:
+    cpulist = _read(
+        Path(sysfs_root) / "devices" / "system" / "node" / f"node{node}" / "cpulist"
+    )
+    return parse_cpulist(cpulist or "")
+
+
+def online_cpus(sysfs_root=config.SYSFS_ROOT) -> list[int]:
+    cpulist = _read(Path(sysfs_root) / "devices" / "system" / "cpu" / "online")
+    return parse_cpulist(cpulist or "")
+
+
+# The cpus grouped by physical core, so that hyperthreads of one core end up
+# in the same container. Without topology information every CPU is a core.
+def cores(cpus: list[int], sysfs_root=config.SYSFS_ROOT) -> list[list[int]]:
+    grouped = {}
+    for cpu in cpus:
+        siblings = _read(
+            Path(sysfs_root)
+            / "devices"
+            / "system"
+            / "cpu"
+            / f"cpu{cpu}"
+            / "topology"
+            / "thread_siblings_list"
+        )
+        key = min(parse_cpulist(siblings or "") or [cpu])
+        grouped.setdefault(key, []).append(cpu)
+    return [grouped[key] for key in sorted(grouped)]
+
+
+# Largest remainder split of the cores by shares, in the order of shares.
+def split(cpu_cores: list[list[int]], shares: dict[str, int]) -> dict[str, list[int]]:
+    total = sum(shares.values())
+    counts = {key: len(cpu_cores) * share // total for key, share in shares.items()}
+    by_remainder = sorted(
+        shares, key=lambda key: len(cpu_cores) * shares[key] % total, reverse=True
+    )
+    for key in by_remainder[: len(cpu_cores) - sum(counts.values())]:
+        counts[key] += 1
+    parts = {}
+    start = 0
+    for key in shares:
+        parts[key] = [
+            cpu for core in cpu_cores[start : start + counts[key]] for cpu in core
+        ]
+        start += counts[key]
+    return parts
+
+
+# Maps every device type to its cpuset_cpus, cpuset_mems (None without NUMA
+# information) and the recommended DataLoader workers per rank, one CPU of
+# every rank being left to the training process itself and at most
+# config.MAX_NUM_WORKERS. Device types that get no CPU are left out and run
+# unpinned.
+def plan_pinning(
+    bus_ids: dict[str, list[str]], sysfs_root=config.SYSFS_ROOT
+) -> dict[str, dict]:
+    nodes = {
+        device_type: [numa_node(bus_id, sysfs_root) for bus_id in device_bus_ids]
+        for device_type, device_bus_ids in bus_ids.items()
+    }
+    if any(node is None for device_nodes in nodes.values() for node in device_nodes):
+        pools = {None: online_cpus(sysfs_root)}
+        nodes = {
+            device_type: [None] * len(device_nodes)
+            for device_type, device_nodes in nodes.items()
+        }
+    else:
+        numa_nodes = sorted(set(node for ns in nodes.values() for node in ns))
+        pools = {node: node_cpus(node, sysfs_root) for node in numa_nodes}
+
+    cpus = {device_type: [] for device_type in bus_ids}
+    for node, pool in pools.items():
+        shares = {
+            device_type: device_nodes.count(node)
+            for device_type, device_nodes in sorted(nodes.items())
+            if node in device_nodes
+        }
+        for device_type, part in split(cores(pool, sysfs_root), shares).items():
+            cpus[device_type].extend(part)
+
+    pinning = {}
+    for device_type, device_cpus in cpus.items():
+        if not device_cpus:
+            continue
+        mems = sorted(set(node for node in nodes[device_type] if node is not None))
+        pinning[device_type] = {
+            "cpuset_cpus": format_cpulist(device_cpus),
+            "cpuset_mems": ",".join(map(str, mems)) if mems else None,
+            "num_workers": min(
+                config.MAX_NUM_WORKERS,
+                max(1, len(device_cpus) // len(bus_ids[device_type]) - 1),
+            ),
+        }
+    return pinning
+
+
+# Adds the pinning of every device type to its container spec, unless
+# KAITIAN_PINNING=0. devices maps the device types to their device numbers.
+def apply_pinning(
+    specs: dict[str, dict],
+    devices: dict[str, list[str]],
+    config_data: tomlkit.TOMLDocument,
+    sysfs_root=config.SYSFS_ROOT,
+):
+    if os.environ.get("KAITIAN_PINNING", "1") == "0":
+        return
+    bus_ids = {}
+    for device_type, device_numbers in devices.items():
+        bus_ids[device_type] = []
+        for device in device_numbers:
+            device_index = device.split(":")[1]
+            bus_ids[device_type].append(
+                str(
+                    config_data["devices"][device_type][f"{device_type}{device_index}"][
+                        "bus_id"
+                    ]
+                )
+            )
+    for device_type, pin in plan_pinning(bus_ids, sysfs_root).items():
+        spec = specs[device_type]
+        spec["cpuset_cpus"] = pin["cpuset_cpus"]
+        if pin["cpuset_mems"] is not None:
+            spec["cpuset_mems"] = pin["cpuset_mems"]
+        environment = spec.setdefault("environment", {})
+        environment["KAITIAN_NUM_WORKERS"] = pin["num_workers"]
@@ -0,0 +1,36 @@
+import torch
+import torch.distributed as dist
+
+__all__ = [
+    "CompressionState",
+    "compression_hook",
+]
+
+
+# State of compression_hook. The process group defaults to the default group.
+class CompressionState:
+    def __init__(self, process_group=None) -> None:
+        self.process_group = process_group
+        # parameters of every bucket, DDP rebuilds the buckets after the first
+        # iteration
+        self.layouts = {}
+
+
+# DDP communication hook that compresses the gradient buckets on the hop
+# between device types with the mode of torch_kaitian.set_compression. Other
+# allreduces, e.g. of the loss or metrics, are never compressed:
+#   model.register_comm_hook(CompressionState(), compression_hook)
+def compression_hook(
+    state: CompressionState, bucket: dist.GradBucket
+) -> torch.futures.Future[torch.Tensor]:
+    from . import _C
+
+    process_group = state.process_group or dist.distributed_c10d._get_default_group()
+    tensor = bucket.buffer()
+    layout = tuple(id(parameter) for parameter in bucket.parameters())
+    reset = state.layouts.get(bucket.index()) != layout
+    state.layouts[bucket.index()] = layout
+    # the same pre-division as the built-in allreduce of DDP
+    tensor.div_(process_group.size())
+    work = _C.allreduce_bucket(process_group, tensor, bucket.index(), reset)
+    return work.get_future().then(lambda future: future.value()[0])
@@ -13,3 +13,36 @@ MAX_COMPUTE_CAPABILITY = 10.0
 
 CONFIG_DIR = Path.home() / ".config" / "kaitian"
 CONFIG_FILE = CONFIG_DIR / "kaitian.toml"
+
+# read-only snapshot of the capability registry, mounted into every container
+CAPABILITY_SNAPSHOT_FILE = CONFIG_DIR / "capability.json"
+CONTAINER_CAPABILITY_SNAPSHOT_FILE = "/etc/kaitian/capability.json"
+
+# read for the NUMA nodes of the devices when pinning the containers
+SYSFS_ROOT = Path("/sys")
+# upper bound of the recommended DataLoader workers per rank
+MAX_NUM_WORKERS = 8
+
+# per-model capability profiles written by 'kaitian calibrate'
+PROFILE_DIR = CONFIG_DIR / "profiles"
+
+# defaults of the [monitor] table in kaitian.toml
+MONITOR_INTERVAL_MS = 500
+MONITOR_CAPACITY = 7200
+MONITOR_FLUSH_SECONDS = 10
+MONITOR_OUTPUT = "monitor.csv"
+# fields not updated for this long are reported as NaN
+MONITOR_STALE_SECONDS = 5.0
+# utilization.png averages the samples into at most this many points
+MONITOR_PLOT_POINTS = 2000
+
+# local Prometheus endpoint of 'kaitian run', 0 disables it
+METRICS_PORT = 9400
+METRICS_PUSH_SECONDS = 5
+
+# log files of 'kaitian run' and their console echo
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_BACKUPS = 3
+LOG_FLUSH_SECONDS = 1.0
+LOG_CONSOLE_LINES_PER_SECOND = 20
+LOG_CONSOLE_BURST = 100
@@ -1,15 +1,24 @@
 import math
 import os
-from typing import Iterator, TypeVar
+from typing import TYPE_CHECKING, Iterator, Optional, TypeVar
 
 import torch
 import torch.distributed as dist
 from torch.utils.data.distributed import Dataset, Sampler
 
-from . import config, redis
+from . import calibration, config, metrics, redis
+
+if TYPE_CHECKING:
+    from .rebalance import Rebalancer
 
 T_co = TypeVar("T_co", covariant=True)
 
+SHUFFLE_MODES = ("randperm", "streaming")
+# number of indices generated at a time in streaming mode
+STREAMING_CHUNK_SIZE = 65536
+FEISTEL_ROUNDS = 4
+FEISTEL_MULTIPLIER = 0x9E3779B1
+
 
 def global_rank() -> int:
     local_rank = dist.get_rank()
@@ -36,8 +45,8 @@ def calc_optimized_batch_size(global_rank: int, ori_batch_size: int) -> int:
     # reference:
     # https://sebastianraschka.com/blog/2022/batch-size-2.html
     # https://wandb.ai/datenzauberai/Batch-Size-Testing/reports/Do-Batch-Sizes-Actually-Need-To-Be-Powers-of-2---VmlldzoyMDkwNDQx
-    batch_size = round(
-        ori_batch_size * compute_capability / config.MAX_COMPUTE_CAPABILITY
+    batch_size = max(
+        1, round(ori_batch_size * compute_capability / config.MAX_COMPUTE_CAPABILITY)
     )
     return batch_size
 
@@ -67,6 +76,52 @@ def calc_iteration_times(dataset_len: int, ori_batch_size: int) -> int:
     return iterations
 
 
+def calc_partition_table(
+    dataset_len: int, ori_batch_size: int
+) -> tuple[int, list[tuple[int, int]]]:
+    # Walk all ranks once and return (iterations, [(offset, length), ...]),
+    # where rank i owns indices[offset:offset + length] of the padded indices.
+    batch_sizes = [
+        calc_optimized_batch_size(rank, ori_batch_size)
+        for rank in range(global_world_size())
+    ]
+    iterations = math.ceil(dataset_len / sum(batch_sizes))
+    table = []
+    offset = 0
+    for batch_size in batch_sizes:
+        length = iterations * batch_size
+        table.append((offset, length))
+        offset += length
+    return iterations, table
+
+
+def _feistel_round(right: torch.Tensor, key: int, half_bits: int) -> torch.Tensor:
+    # right < 2**31 and FEISTEL_MULTIPLIER < 2**32, so the product fits in int64
+    t = (right ^ key) * FEISTEL_MULTIPLIER
+    t = t ^ (t >> 15)
+    return t & ((1 << half_bits) - 1)
+
+
+def _feistel_permute(
+    x: torch.Tensor, n: int, keys: list[int], half_bits: int
+) -> torch.Tensor:
+    # Keyed bijection over [0, n): a balanced Feistel network permutes
+    # [0, 4**half_bits), and cycle walking maps values that fall outside
+    # [0, n) back into it.
+    mask = (1 << half_bits) - 1
+    out = x.clone()
+    pending = torch.ones_like(out, dtype=torch.bool)
+    while pending.any():
+        v = out[pending]
+        left, right = v >> half_bits, v & mask
+        for key in keys:
+            left, right = right, left ^ _feistel_round(right, key, half_bits)
+        v = (left << half_bits) | right
+        out[pending] = v
+        pending = out >= n
+    return out
+
+
 class DistributedSampler(Sampler[T_co]):
     def __init__(
         self,
@@ -74,63 +129,141 @@ class DistributedSampler(Sampler[T_co]):
         batch_size: int,
         shuffle: bool = True,
         seed: int = 0,
+        shuffle_mode: str = "randperm",
+        rebalancer: Optional["Rebalancer"] = None,
         # drop_last always is False
     ) -> None:
+        if shuffle_mode not in SHUFFLE_MODES:
+            raise ValueError(
+                "Invalid shuffle_mode {}, shuffle_mode should be one of {}".format(
+                    shuffle_mode, SHUFFLE_MODES
+                )
+            )
         num_replicas = global_world_size()
         rank = global_rank()
-        dataset_len = len(dataset)
         if rank >= num_replicas or rank < 0:
             raise ValueError(
                 "Invalid rank {}, rank should be in the interval"
                 " [0, {}]".format(rank, num_replicas - 1)
             )
         self.dataset = dataset
+        self.dataset_len = len(dataset)
         self.num_replicas = num_replicas
         self.global_rank = rank
         self.epoch = 0
         self.batch_size = batch_size
-        self.optimized_batch_size = calc_optimized_batch_size(rank, batch_size)
-        self.iterations = calc_iteration_times(dataset_len, batch_size)
-        self.num_samples = get_num_samples(dataset_len, self.global_rank, batch_size)
-        self.total_size = self.iterations * get_total_optimized_batch_size(batch_size)
         self.shuffle = shuffle
         self.seed = seed
+        self.shuffle_mode = shuffle_mode
+        self.rebalancer = rebalancer
+        self._capabilities = None
+        self._update_partition()
 
         # print(
         #     f"global_rank: {self.global_rank}, optimized_batch_size: {self.optimized_batch_size}, num_samples: {self.num_samples}, iterations:{self.iterations}, total_size: {self.total_size}"
         # )
 
+    def _update_partition(self) -> None:
+        # The partition table only depends on the compute capabilities, so it
+        # is rebuilt only when they change instead of on every epoch.
+        capabilities = tuple(
+            redis.get_compute_capability(rank) for rank in range(self.num_replicas)
+        )
+        if capabilities == self._capabilities:
+            return
+        self._capabilities = capabilities
+        self.iterations, self.partition_table = calc_partition_table(
+            self.dataset_len, self.batch_size
+        )
+        self.offset, self.num_samples = self.partition_table[self.global_rank]
+        self.optimized_batch_size = self.num_samples // self.iterations
+        self.total_size = sum(length for _, length in self.partition_table)
+
     def __iter__(self) -> Iterator[T_co]:
+        indices = self._iter_indices()
+        if metrics.enabled():
+            indices = metrics.count(
+                indices, self.optimized_batch_size, self.global_rank
+            )
+        if calibration.enabled():
+            return calibration.measure(
+                indices, self.optimized_batch_size, self.global_rank
+            )
+        return indices
+
+    def _iter_indices(self) -> Iterator[T_co]:
+        if self.shuffle and self.shuffle_mode == "streaming":
+            return self._iter_streaming()
+
         if self.shuffle:
             g = torch.Generator()
             g.manual_seed(self.seed + self.epoch)
-            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+            indices = torch.randperm(self.dataset_len, generator=g)
         else:
-            indices = list(range(len(self.dataset)))
+            indices = torch.arange(self.dataset_len)
 
-        padding_size = self.total_size - len(indices)
-        if padding_size <= len(indices):
-            indices += indices[:padding_size]
+        # subsample: the padded indices are indices[i % dataset_len] for i in
+        # [0, total_size), so only this rank's window is ever materialized.
+        if self.offset + self.num_samples <= self.dataset_len:
+            indices = indices.narrow(0, self.offset, self.num_samples)
         else:
-            indices += (indices * math.ceil(padding_size / len(indices)))[:padding_size]
-
-        assert len(indices) == self.total_size
-
-        # subsample
-        start_index = 0
-        for i in range(global_world_size()):
-            if i == self.global_rank:
-                break
-            start_index += get_num_samples(len(self.dataset), i, self.batch_size)
-        end_index = start_index + self.num_samples
-        indices = indices[start_index:end_index]
+            positions = torch.arange(self.offset, self.offset + self.num_samples)
+            indices = indices[positions % self.dataset_len]
 
         assert len(indices) == self.num_samples
 
-        return iter(indices)
+        return iter(indices.tolist())
+
+    def _iter_streaming(self) -> Iterator[T_co]:
+        # Same padding semantics as randperm mode, but the permutation is
+        # evaluated position by position, so memory does not depend on the
+        # dataset size.
+        half_bits = max(1, math.ceil(math.log2(max(self.dataset_len, 2)) / 2))
+        if half_bits > 31:
+            raise ValueError(
+                "Dataset of length {} is too large for streaming shuffle".format(
+                    self.dataset_len
+                )
+            )
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        keys = torch.randint(0, 1 << half_bits, (FEISTEL_ROUNDS,), generator=g).tolist()
+        end = self.offset + self.num_samples
+        for start in range(self.offset, end, STREAMING_CHUNK_SIZE):
+            positions = torch.arange(start, min(start + STREAMING_CHUNK_SIZE, end))
+            indices = _feistel_permute(
+                positions % self.dataset_len, self.dataset_len, keys, half_bits
+            )
+            yield from indices.tolist()
 
     def __len__(self) -> int:
         return self.num_samples
 
     def set_epoch(self, epoch: int) -> None:
         self.epoch = epoch
+        redis.refresh()
+        if self.rebalancer is not None:
+            self.rebalancer.rebalance(epoch)
+        self._update_partition()
+
+
+# Yields batches of the sampler's current optimized batch size, so the
+# DataLoader follows the partition after a rebalance:
+#   DataLoader(dataset, batch_sampler=DistributedBatchSampler(sampler))
+class DistributedBatchSampler(Sampler[list[int]]):
+    def __init__(self, sampler: DistributedSampler) -> None:
+        self.sampler = sampler
+
+    def __iter__(self) -> Iterator[list[int]]:
+        batch_size = self.sampler.optimized_batch_size
+        batch = []
+        for index in self.sampler:
+            batch.append(index)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __len__(self) -> int:
+        return self.sampler.iterations
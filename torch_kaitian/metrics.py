@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+import time
+from typing import Iterator
+
+from . import redis
+
+# Set by 'kaitian run' while it serves metrics. The DistributedSampler hands
+# its indices through count(), and a daemon thread pushes the counters and the
+# collective telemetry of this rank to redis every KAITIAN_METRICS_PUSH_SECONDS
+# for the launcher to serve.
+_push_seconds = os.environ.get("KAITIAN_METRICS_PUSH_SECONDS", None)
+
+_samples = 0
+_batches = 0
+_batch_size = 0
+_pusher = None
+
+
+def enabled() -> bool:
+    return _push_seconds is not None
+
+
+def _collectives() -> dict:
+    if not os.environ.get("DEVICE", None):
+        return {}
+    from . import _C
+
+    collectives = {}
+    for histogram in _C.get_telemetry_histograms():
+        op = collectives.setdefault(histogram.op, {"calls": 0, "us": 0, "phases": {}})
+        op["calls"] += histogram.calls
+        op["us"] += histogram.total_us
+        for phase, us in histogram.phases.items():
+            op["phases"][phase] = op["phases"].get(phase, 0) + us
+    return collectives
+
+
+def _push(global_rank: int) -> None:
+    while True:
+        time.sleep(float(_push_seconds))
+        # metrics must never break the training
+        try:
+            redis.publish_metrics(
+                global_rank,
+                json.dumps(
+                    {
+                        "time": time.time(),
+                        "samples": _samples,
+                        "batches": _batches,
+                        "batch_size": _batch_size,
+                        "collectives": _collectives(),
+                    }
+                ),
+            )
+        except Exception:
+            pass
+
+
+def count(indices: Iterator[int], batch_size: int, global_rank: int) -> Iterator[int]:
+    global _samples, _batches, _batch_size, _pusher
+    if _pusher is None:
+        _pusher = threading.Thread(target=_push, args=(global_rank,), daemon=True)
+        _pusher.start()
+    _batch_size = batch_size
+    for position, index in enumerate(indices):
+        if position % batch_size == 0:
+            _batches += 1
+        _samples += 1
+        yield index
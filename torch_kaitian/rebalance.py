@@ -0,0 +1,119 @@
+import os
+import time
+from contextlib import contextmanager
+
+from . import config, distributed, redis, synchronize
+
+
+# Microseconds all collectives of this process have spent in the gloo hop
+# between the groups, 0 without the backend or with KAITIAN_TELEMETRY=off.
+def _inter_us() -> int:
+    if not os.environ.get("DEVICE", None):
+        return 0
+    from . import _C
+
+    return sum(histogram.phases["inter"] for histogram in _C.get_telemetry_histograms())
+
+
+# Adjust the per-rank batch split from measured step times. Wrap the
+# forward/backward of every training step with step() and pass the rebalancer
+# to DistributedSampler. At each set_epoch the step times of the previous epoch
+# are exchanged through redis and every rank derives the same new compute
+# capabilities from them.
+#
+# Under DDP the backward of a fast group blocks in the gradient allreduce
+# until the slow group catches up, so the wall time of a step is about the
+# same on every rank. The time the step spent in the gloo hop is therefore
+# left out, which leaves the compute time of the rank.
+class Rebalancer:
+    def __init__(
+        self, damping: float = 0.5, tolerance: float = 0.05, timeout: float = 300.0
+    ) -> None:
+        if not 0.0 < damping <= 1.0:
+            raise ValueError(
+                "Invalid damping {}, damping should be in the interval (0, 1]".format(
+                    damping
+                )
+            )
+        # fraction of the way to move towards the measured capabilities
+        self.damping = damping
+        # relative step time spread below which the split is left alone
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.global_rank = distributed.global_rank()
+        self.world_size = distributed.global_world_size()
+        self.num_samples = 0
+        self.seconds = 0.0
+        self.previous_epoch = None
+
+    @contextmanager
+    def step(self, num_samples: int):
+        synchronize()
+        start = time.perf_counter()
+        inter_us = _inter_us()
+        yield
+        synchronize()
+        seconds = time.perf_counter() - start
+        # negative after a reset_telemetry() within the step
+        waited = max(_inter_us() - inter_us, 0) / 1e6
+        self.record(num_samples, max(seconds - waited, 0.0))
+
+    def record(self, num_samples: int, seconds: float) -> None:
+        self.num_samples += num_samples
+        self.seconds += seconds
+
+    def _gather(self, epoch: int) -> dict[int, tuple[int, float]]:
+        redis.publish_step_time(epoch, self.global_rank, self.num_samples, self.seconds)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            step_times = redis.get_step_times(epoch)
+            if len(step_times) == self.world_size:
+                return step_times
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"[KaiTian][Error] Timed out waiting for step times of epoch {epoch}."
+                )
+            time.sleep(0.1)
+
+    def rebalance(self, epoch: int) -> None:
+        # Every rank publishes, even without recorded steps, so that all of
+        # them decide together whether to skip.
+        step_times = self._gather(epoch)
+        self.num_samples = 0
+        self.seconds = 0.0
+        # All ranks have published this epoch, so all of them are done with
+        # the previous one.
+        if self.global_rank == 0 and self.previous_epoch is not None:
+            redis.delete_step_times(self.previous_epoch)
+        self.previous_epoch = epoch
+
+        ranks = range(self.world_size)
+        if any(step_times[rank][0] == 0 or step_times[rank][1] <= 0 for rank in ranks):
+            return
+        capabilities = [redis.get_compute_capability(rank) for rank in ranks]
+        seconds = [step_times[rank][1] for rank in ranks]
+        throughputs = [step_times[rank][0] / step_times[rank][1] for rank in ranks]
+        imbalance = (max(seconds) - min(seconds)) / max(seconds)
+        if imbalance < self.tolerance:
+            return
+
+        max_throughput = max(throughputs)
+        updated = []
+        for capability, throughput in zip(capabilities, throughputs):
+            target = throughput / max_throughput * config.MAX_COMPUTE_CAPABILITY
+            updated.append(capability + self.damping * (target - capability))
+        scale = config.MAX_COMPUTE_CAPABILITY / max(updated)
+        updated = [max(round(c * scale, 1), 0.1) for c in updated]
+
+        # Step time scales with the batch size, so this is the expected
+        # spread once the new split is applied.
+        expected = [s * n / o for s, n, o in zip(seconds, updated, capabilities)]
+        expected_imbalance = (max(expected) - min(expected)) / max(expected)
+        for rank, capability in zip(ranks, updated):
+            redis.set_compute_capability(rank, capability)
+        if self.global_rank == 0:
+            print(
+                f"[KaiTian][Info] Epoch {epoch} rebalance: imbalance {imbalance:.1%} -> {expected_imbalance:.1%} (expected), "
+                f"compute capability {capabilities} -> {updated}",
+                flush=True,
+            )
@@ -1,16 +1,30 @@
+import json
+import os
+
 import redis
 
-__all__ = ["get_compute_capability"]
+__all__ = [
+    "get_compute_capability",
+    "refresh",
+    "set_compute_capability",
+    "publish_step_time",
+    "get_step_times",
+    "delete_step_times",
+    "publish_calibration",
+    "publish_metrics",
+]
 
 redis_client = None
 data = None
+version = None
 
 
 def _get_redis_client():
     global redis_client
     if redis_client is None:
         redis_client = redis.Redis(
-            host="kaitian_redis",
+            host=os.environ.get("KAITIAN_REDIS_HOST", "kaitian_redis"),
+            port=int(os.environ.get("KAITIAN_REDIS_PORT", 6379)),
             socket_timeout=5,
             socket_connect_timeout=5,
             decode_responses=True,
@@ -18,14 +32,85 @@ def _get_redis_client():
     return redis_client
 
 
+def _load_snapshot():
+    path = os.environ.get("KAITIAN_CAPABILITY_SNAPSHOT", None)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _load_redis():
+    r = _get_redis_client()
+    pipe = r.pipeline()
+    pipe.get("compute_capability_version")
+    pipe.hgetall("compute_capability")
+    version_, data_ = pipe.execute()
+    return int(version_ or 0), data_
+
+
+# The snapshot written by the launcher is preferred, so neither the training
+# processes nor the DataLoader workers need a redis connection.
 def _get_data():
-    global data
+    global data, version
     if data is None:
-        r = _get_redis_client()
-        data = r.hgetall("compute_capability")
+        snapshot = _load_snapshot()
+        if snapshot is not None:
+            version, data = snapshot["version"], snapshot["compute_capability"]
+        else:
+            version, data = _load_redis()
     return data
 
 
+# Reload from redis only if the registry version moved past the local one.
+# The launcher writes the snapshot before the registry, so the registry may
+# still be behind it.
+def refresh() -> bool:
+    global data, version
+    _get_data()
+    latest = int(_get_redis_client().get("compute_capability_version") or 0)
+    if latest <= version:
+        return False
+    version, data = _load_redis()
+    return True
+
+
 def get_compute_capability(global_rank: int) -> float:
     data = _get_data()
     return float(data[str(global_rank)])
+
+
+def set_compute_capability(global_rank: int, compute_capability: float):
+    # Only updates the local view, every rank is expected to derive the same
+    # value (see torch_kaitian.rebalance).
+    data = _get_data()
+    data[str(global_rank)] = str(compute_capability)
+
+
+def publish_step_time(epoch: int, global_rank: int, num_samples: int, seconds: float):
+    r = _get_redis_client()
+    r.hset(f"step_time:{epoch}", str(global_rank), f"{num_samples},{seconds}")
+
+
+def get_step_times(epoch: int) -> dict[int, tuple[int, float]]:
+    r = _get_redis_client()
+    step_times = {}
+    for global_rank, value in r.hgetall(f"step_time:{epoch}").items():
+        num_samples, seconds = value.split(",")
+        step_times[int(global_rank)] = (int(num_samples), float(seconds))
+    return step_times
+
+
+def delete_step_times(epoch: int):
+    r = _get_redis_client()
+    r.delete(f"step_time:{epoch}")
+
+
+def publish_calibration(global_rank: int, num_samples: int, seconds: float):
+    r = _get_redis_client()
+    r.hset("calibration", str(global_rank), f"{num_samples},{seconds}")
+
+
+def publish_metrics(global_rank: int, metrics: str):
+    r = _get_redis_client()
+    r.hset("metrics", str(global_rank), metrics)
@@ -0,0 +1,85 @@
+import json
+import os
+
+__all__ = [
+    "get_telemetry",
+    "reset_telemetry",
+    "export_chrome_trace",
+]
+
+# One trace track per phase, below the track of the collectives.
+PHASES = ("intra_reduce", "d2h", "inter", "h2d", "intra_broadcast")
+
+
+def get_telemetry():
+    from . import _C
+
+    return _C.get_telemetry()
+
+
+def reset_telemetry():
+    from . import _C
+
+    _C.reset_telemetry()
+
+
+def _trace_pid():
+    rank_start = os.environ.get("KAITIAN_GLOBAL_RANK_START", None)
+    local_rank = os.environ.get("LOCAL_RANK", os.environ.get("RANK", None))
+    if rank_start is None or local_rank is None:
+        return os.getpid()
+    return int(rank_start) + int(local_rank)
+
+
+# Writes the recorded collectives as a Chrome trace (chrome://tracing or
+# ui.perfetto.dev). Timestamps start at the launch of each process, so traces
+# of different ranks are only roughly aligned.
+def export_chrome_trace(path: str, snapshot=None) -> None:
+    if snapshot is None:
+        snapshot = get_telemetry()
+    pid = _trace_pid()
+    events = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": tid,
+            "args": {"name": name},
+        }
+        for tid, name in enumerate(("collectives",) + PHASES)
+    ]
+    for record in snapshot.records:
+        events.append(
+            {
+                "name": record.op,
+                "cat": "collective",
+                "ph": "X",
+                "ts": record.start_us,
+                "dur": record.duration_us,
+                "pid": pid,
+                "tid": 0,
+                "args": {"bytes": record.bytes, "dtype": record.dtype},
+            }
+        )
+        for phase, (start_us, duration_us) in record.phases.items():
+            events.append(
+                {
+                    "name": phase,
+                    "cat": "phase",
+                    "ph": "X",
+                    "ts": record.start_us + start_us,
+                    "dur": duration_us,
+                    "pid": pid,
+                    "tid": PHASES.index(phase) + 1,
+                    "args": {"op": record.op},
+                }
+            )
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"dropped_records": snapshot.dropped},
+            },
+            file,
+        )